@@ -0,0 +1,152 @@
+"""
+Memory comparison of the masks.npy dict, the memory-mapped corpus and the compact corpus.
+
+Every format is opened in a fresh process, which then samples slices through
+`get_random_mask_slice` like the merge step does. Run from the Data_Simulation_Pipeline
+directory on the extracted masks.npy:
+    python -m benchmarks.corpus_memory_benchmark ../../Data/EMIDEC/masks.npy --samples 2000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+from typing import Dict, Any
+from mask_extractor.MaskCorpus import MaskCorpus
+from mask_extractor.extract_masks import get_random_mask_slice
+from mask_writer.MaskCodec import load_masks_npy
+
+CORPUS_FORMATS = ('npy', 'memmap', 'compact')
+
+
+def _rss_bytes() -> int:
+    """
+    Get the current resident set size of this process.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Peak instead of current RSS where /proc is not available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _measure_format(corpus_format: str, path: str, samples: int, seed: int) -> Dict[str, Any]:
+    """
+    Open a corpus and sample slices from it, measuring time and resident memory.
+
+    Args:
+        corpus_format (str): One of `CORPUS_FORMATS`
+        path (str): masks.npy path for 'npy', otherwise the corpus data file
+        samples (int): Number of `get_random_mask_slice` calls per mask type
+        seed (int): Seed of `np.random`
+
+    Returns:
+        Dict[str, Any]: Open time, resident memory after opening and after sampling, and time per sample
+    """
+    baseline = _rss_bytes()
+    start = time.perf_counter()
+    if corpus_format == 'npy':
+        all_masks = load_masks_npy(path)
+    else:
+        all_masks = MaskCorpus(path)
+    open_seconds = time.perf_counter() - start
+    opened = _rss_bytes()
+
+    np.random.seed(seed)
+    start = time.perf_counter()
+    checksum = 0
+    for _ in range(samples):
+        for mask_type in ('mayocardium_masks', 'infarction_masks'):
+            mask, blood_pool_mask = get_random_mask_slice(all_masks, mask_type)
+            checksum += int(mask.sum()) + int(blood_pool_mask.sum())
+    sample_seconds = time.perf_counter() - start
+
+    return {
+        'open_ms': open_seconds * 1000,
+        'rss_after_open_mb': (opened - baseline) / 2 ** 20,
+        'rss_after_sampling_mb': (_rss_bytes() - baseline) / 2 ** 20,
+        'sample_us': sample_seconds / max(2 * samples, 1) * 1e6,
+        'checksum': checksum
+    }
+
+
+def benchmark_corpus_memory(np_data_path: str, work_dir: str, samples: int = 2000,
+                            seed: int = 0) -> Dict[str, Any]:
+    """
+    Convert a masks.npy dict into both corpus formats and compare the three formats.
+
+    The dict sizes are the summed `nbytes` of the arrays of all four mask types and of
+    `standard_mask` alone, the on-disk sizes include the corpus indexes. Equal checksums
+    show that all formats returned the same slices.
+
+    Args:
+        np_data_path (str): Path of the masks.npy corpus
+        work_dir (str): Directory the corpora are written to
+        samples (int): Number of `get_random_mask_slice` calls per mask type and format
+        seed (int): Seed of the sampling
+
+    Returns:
+        Dict[str, Any]: Sizes and measurements per format
+    """
+    all_masks = load_masks_npy(np_data_path)
+    nbytes = {mask_type: sum(np.asarray(mask).nbytes for case_masks in all_masks.values()
+                             for mask in case_masks[mask_type])
+              for mask_type in next(iter(all_masks.values()))}
+    paths = {'npy': Path(np_data_path)}
+    for corpus_format in ('memmap', 'compact'):
+        compact = corpus_format == 'compact'
+        paths[corpus_format] = Path(work_dir) / MaskCorpus.corpus_path_for(np_data_path, compact).name
+        MaskCorpus.write(all_masks, paths[corpus_format], compact=compact)
+    slices = sum(len(case_masks['standard_mask']) for case_masks in all_masks.values())
+    del all_masks
+
+    results = {'slices': slices,
+               'dict_mb': sum(nbytes.values()) / 2 ** 20,
+               'label_maps_mb': nbytes.get('standard_mask', 0) / 2 ** 20}
+    context = multiprocessing.get_context('spawn')
+    for corpus_format in CORPUS_FORMATS:
+        disk_bytes = paths[corpus_format].stat().st_size
+        if corpus_format != 'npy':
+            disk_bytes += MaskCorpus.index_path_for(paths[corpus_format]).stat().st_size
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            measurement = executor.submit(_measure_format, corpus_format, str(paths[corpus_format]),
+                                          samples, seed).result()
+        results[corpus_format] = dict(measurement, disk_mb=disk_bytes / 2 ** 20)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the memory use of the mask corpus formats.")
+    parser.add_argument('np_data_path', type=str, help='Path of the masks.npy file.')
+    parser.add_argument('--samples', type=int, default=2000, help='Sampled slices per mask type and format.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the sampling.')
+    parser.add_argument('--work-dir', type=str, default=None,
+                        help='Directory for the converted corpora, a temporary directory by default.')
+    parser.add_argument('--json', type=str, default=None, help='Optional path to write the results to.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        results = benchmark_corpus_memory(args.np_data_path, args.work_dir or temp_dir, args.samples, args.seed)
+
+    print(f"{results['slices']} slices: {results['dict_mb']:.1f} MB of masks in the dict, "
+          f"{results['label_maps_mb']:.1f} MB of them label maps")
+    for corpus_format in CORPUS_FORMATS:
+        result = results[corpus_format]
+        print(f"{corpus_format}: {result['disk_mb']:.1f} MB on disk, open {result['open_ms']:.1f} ms, "
+              f"RSS +{result['rss_after_open_mb']:.1f} MB after open, "
+              f"+{result['rss_after_sampling_mb']:.1f} MB after sampling, "
+              f"{result['sample_us']:.1f} us per sample (checksum {result['checksum']})")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
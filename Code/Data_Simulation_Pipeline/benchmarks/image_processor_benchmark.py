@@ -0,0 +1,174 @@
+"""
+Benchmarks of the ImageProcessor hot spots against their reference implementations.
+
+Run from the Data_Simulation_Pipeline directory:
+    python -m benchmarks.image_processor_benchmark --repeats 20
+"""
+import argparse
+import json
+import random
+import time
+import numpy as np
+import cv2
+from typing import Callable, Dict, Any, Tuple
+from mask_simulator.ImageProcessor import ImageProcessor
+
+
+def time_call(function: Callable[[], Any], repeats: int) -> Dict[str, float]:
+    """
+    Time repeated calls of a function.
+
+    Args:
+        function: Function without arguments to time
+        repeats: Number of timed calls
+
+    Returns:
+        Dict[str, float]: Median and mean time per call in milliseconds
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {'median_ms': float(np.median(timings)), 'mean_ms': float(np.mean(timings))}
+
+
+def benchmark_deformation(image_size: int = 250, repeats: int = 20, seed: int = 0) -> Dict[str, Any]:
+    """
+    Compare the vectorized and per-pixel `apply_random_deformation` on the ring and cavity masks.
+
+    Besides timing, the foreground area left after deformation is averaged over the
+    repeats to check that both implementations behave the same statistically.
+
+    Args:
+        image_size: Height and width of the benchmark masks
+        repeats: Number of calls per implementation and mask
+        seed: Seed of `random` and `np.random`
+
+    Returns:
+        Dict[str, Any]: Timings, mean deformed areas and speedup per mask
+    """
+    center = (image_size // 2, image_size // 2)
+    outer_radius = image_size // 3
+    ring_mask = np.zeros((image_size, image_size), dtype=np.uint8)
+    cv2.circle(ring_mask, center, outer_radius, (255), thickness=30)
+    cavity_mask = np.zeros_like(ring_mask)
+    cv2.circle(cavity_mask, center, outer_radius - 15, (255), thickness=-1)
+
+    results = {}
+    for name, mask, max_offset in (('ring', ring_mask, 1), ('cavity', cavity_mask, 3)):
+        results[name] = {'foreground_pixels': int(np.count_nonzero(mask))}
+        for method in ImageProcessor.DEFORMATION_METHODS:
+            processor = ImageProcessor(deformation_method=method)
+            random.seed(seed)
+            np.random.seed(seed)
+            areas = []
+            timing = time_call(
+                lambda: areas.append(np.count_nonzero(processor.apply_random_deformation(mask, max_offset))),
+                repeats
+            )
+            results[name][method] = dict(timing, mean_deformed_area=float(np.mean(areas)))
+        results[name]['speedup'] = results[name]['loop']['median_ms'] / results[name]['vectorized']['median_ms']
+    return results
+
+
+def _seeded_runs(function: Callable[[], np.ndarray], repeats: int, seed: int) -> Tuple[Dict[str, float], float]:
+    """
+    Time repeated calls with `random` and `np.random` reseeded before every call.
+
+    Args:
+        function: Function without arguments returning a mask
+        repeats: Number of timed calls
+        seed: Seed used before call i is seed + i
+
+    Returns:
+        Tuple[Dict[str, float], float]: Timings and the mean non-zero area of the returned masks
+    """
+    timings, areas = [], []
+    for i in range(repeats):
+        random.seed(seed + i)
+        np.random.seed(seed + i)
+        start = time.perf_counter()
+        result = function()
+        timings.append((time.perf_counter() - start) * 1000)
+        areas.append(np.count_nonzero(result))
+    return {'median_ms': float(np.median(timings)), 'mean_ms': float(np.mean(timings))}, float(np.mean(areas))
+
+
+def benchmark_region_growing(image_size: int = 250, repeats: int = 20, seed: int = 0,
+                             number_of_seeds: int = 80, energy: int = 30) -> Dict[str, Any]:
+    """
+    Compare the frontier and list-queue region growing in `spread_region_with_bias` and `add_no_flow`.
+
+    Both run on the same simulated myocardium and seeds, with the random generators
+    reseeded identically before every call. The mean painted area is reported to
+    check that the spreading behaves the same.
+
+    Args:
+        image_size: Height and width of the simulated image
+        repeats: Number of calls per implementation
+        seed: Seed of the simulated image and of the timed calls
+        number_of_seeds: Number of seeds for region growing
+        energy: Energy level for region spreading
+
+    Returns:
+        Dict[str, Any]: Timings, mean painted areas and speedup per function
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    processor = ImageProcessor()
+    array = processor.generate_ring_with_cavity_and_cloud_infarctions(
+        height=image_size, width=image_size,
+        outer_radius_max=image_size // 3, outer_radius_min=image_size // 4,
+        ring_thick_max=40, ring_thick_min=15
+    )
+    initial_seed, center_x, center_y = processor.select_initial_seed(array=array)
+    selected_seeds = processor.generate_seeds(initial_seed, center_x, center_y, number_of_seeds,
+                                              2, np.pi / 4, array)
+    infarction = processor.spread_region_with_bias(selected_seeds, energy, array)
+    infarction_clusters = processor.filter_clusters_by_size(processor.morphological_processing(infarction), 70)
+
+    results = {'spread_region_with_bias': {}, 'add_no_flow': {}}
+    for method in ImageProcessor.REGION_GROWING_METHODS:
+        method_processor = ImageProcessor(region_growing_method=method)
+        timing, area = _seeded_runs(
+            lambda: method_processor.spread_region_with_bias(selected_seeds, energy, array) == 255,
+            repeats, seed)
+        results['spread_region_with_bias'][method] = dict(timing, mean_painted_area=area)
+        timing, area = _seeded_runs(lambda: method_processor.add_no_flow(infarction_clusters), repeats, seed)
+        results['add_no_flow'][method] = dict(timing, mean_painted_area=area)
+
+    for result in results.values():
+        result['speedup'] = result['queue']['median_ms'] / result['frontier']['median_ms']
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ImageProcessor implementations.")
+    parser.add_argument('--image-size', type=int, default=250, help='Height and width of the benchmark masks.')
+    parser.add_argument('--repeats', type=int, default=20, help='Timed calls per implementation.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random generators.')
+    parser.add_argument('--json', type=str, default=None, help='Optional path to write the results to.')
+    args = parser.parse_args()
+
+    results = {'deformation': benchmark_deformation(args.image_size, args.repeats, args.seed)}
+    for name, result in results['deformation'].items():
+        print(f"deformation/{name}: loop {result['loop']['median_ms']:.2f} ms, "
+              f"vectorized {result['vectorized']['median_ms']:.2f} ms ({result['speedup']:.1f}x), "
+              f"deformed area {result['loop']['mean_deformed_area']:.0f} vs "
+              f"{result['vectorized']['mean_deformed_area']:.0f} of {result['foreground_pixels']} pixels")
+
+    results['region_growing'] = benchmark_region_growing(args.image_size, args.repeats, args.seed)
+    for name, result in results['region_growing'].items():
+        print(f"region_growing/{name}: queue {result['queue']['median_ms']:.2f} ms, "
+              f"frontier {result['frontier']['median_ms']:.2f} ms ({result['speedup']:.1f}x), "
+              f"painted area {result['queue']['mean_painted_area']:.0f} vs "
+              f"{result['frontier']['mean_painted_area']:.0f} pixels")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Compression ratio and decode throughput of the mask codecs against plain .npy files.
+
+The masks are taken from a masks.npy corpus (its label maps) or from a directory of
+generated .npy masks, written once as .npy files and once per codec as .mask files, then
+read back. Run from the Data_Simulation_Pipeline directory:
+    python -m benchmarks.mask_codec_benchmark ../../Data/EMIDEC/masks.npy --limit 2000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+from typing import Dict, List, Any
+from mask_writer.MaskCodec import (CODEC_METHODS, MASK_EXTENSION, encode_mask, decode_mask, save_mask, load_mask,
+                                   load_masks_npy)
+from mask_writer.ShardedMaskDataset import open_mask_dataset
+
+
+def load_benchmark_masks(source: str, limit: int = None) -> List[np.ndarray]:
+    """
+    Get the masks to benchmark.
+
+    Args:
+        source (str): masks.npy corpus, whose `standard_mask` slices are used, or a
+            directory of generated masks
+        limit (int): Maximum number of masks
+
+    Returns:
+        List[np.ndarray]: Masks
+    """
+    if Path(source).is_dir():
+        dataset = open_mask_dataset(source)
+        return [dataset[index] for index in range(min(len(dataset), limit or len(dataset)))]
+    all_masks = load_masks_npy(source)
+    masks = [np.asarray(mask) for case_masks in all_masks.values() for mask in case_masks['standard_mask']]
+    return masks[:limit]
+
+
+def _read_seconds(paths: List[Path], read) -> float:
+    start = time.perf_counter()
+    for path in paths:
+        read(path)
+    return time.perf_counter() - start
+
+
+def benchmark_mask_codecs(masks: List[np.ndarray], work_dir: str, repeats: int = 3) -> Dict[str, Any]:
+    """
+    Measure every codec and plain .npy files on the same masks.
+
+    In-memory times are for `encode_mask`/`decode_mask` on buffers; file times read every
+    file back from the (warm) page cache, best of `repeats` passes. Throughputs are in
+    MB of decoded masks per second.
+
+    Args:
+        masks (List[np.ndarray]): Masks to store
+        work_dir (str): Directory the files are written to
+        repeats (int): Number of timed read passes
+
+    Returns:
+        Dict[str, Any]: Sizes and timings per format
+    """
+    raw_bytes = sum(mask.nbytes for mask in masks)
+    raw_mb = raw_bytes / 2 ** 20
+    results = {'masks': len(masks), 'raw_mb': raw_mb}
+
+    npy_dir = Path(work_dir) / 'npy'
+    npy_dir.mkdir(parents=True, exist_ok=True)
+    npy_paths = [npy_dir / f"{index:06d}.npy" for index in range(len(masks))]
+    for path, mask in zip(npy_paths, masks):
+        np.save(path, mask)
+    seconds = min(_read_seconds(npy_paths, np.load) for _ in range(repeats))
+    results['npy'] = {'file_mb': sum(os.path.getsize(path) for path in npy_paths) / 2 ** 20,
+                      'read_us': seconds / len(masks) * 1e6, 'read_mb_per_s': raw_mb / seconds}
+
+    for method in CODEC_METHODS:
+        start = time.perf_counter()
+        buffers = [encode_mask(mask, method) for mask in masks]
+        encode_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        decoded = [decode_mask(buffer) for buffer in buffers]
+        decode_seconds = time.perf_counter() - start
+        if not all(np.array_equal(original, mask) for original, mask in zip(masks, decoded)):
+            raise AssertionError(f"{method} did not restore the masks")
+
+        method_dir = Path(work_dir) / method
+        method_dir.mkdir(parents=True, exist_ok=True)
+        paths = [method_dir / f"{index:06d}{MASK_EXTENSION}" for index in range(len(masks))]
+        for path, mask in zip(paths, masks):
+            save_mask(path, mask, method)
+        read_seconds = min(_read_seconds(paths, load_mask) for _ in range(repeats))
+        encoded_bytes = sum(buffer.nbytes for buffer in buffers)
+        results[method] = {
+            'ratio': raw_bytes / max(encoded_bytes, 1),
+            'file_mb': sum(os.path.getsize(path) for path in paths) / 2 ** 20,
+            'encode_us': encode_seconds / len(masks) * 1e6,
+            'decode_us': decode_seconds / len(masks) * 1e6,
+            'decode_mb_per_s': raw_mb / decode_seconds,
+            'read_us': read_seconds / len(masks) * 1e6,
+            'read_mb_per_s': raw_mb / read_seconds
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the mask codecs with plain .npy files.")
+    parser.add_argument('source', type=str, help='masks.npy corpus or a directory of generated masks.')
+    parser.add_argument('--limit', type=int, default=None, help='Maximum number of masks.')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed read passes, the best is reported.')
+    parser.add_argument('--json', type=str, default=None, help='Optional path to write the results to.')
+    args = parser.parse_args()
+
+    masks = load_benchmark_masks(args.source, args.limit)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        results = benchmark_mask_codecs(masks, temp_dir, args.repeats)
+
+    print(f"{results['masks']} masks, {results['raw_mb']:.1f} MB raw")
+    print(f"npy: {results['npy']['file_mb']:.1f} MB in files, read {results['npy']['read_us']:.1f} us per mask "
+          f"({results['npy']['read_mb_per_s']:.0f} MB/s)")
+    for method in CODEC_METHODS:
+        result = results[method]
+        print(f"{method}: {result['ratio']:.1f}x smaller, {result['file_mb']:.2f} MB in files, "
+              f"encode {result['encode_us']:.1f} us, decode {result['decode_us']:.1f} us per mask "
+              f"({result['decode_mb_per_s']:.0f} MB/s), read {result['read_us']:.1f} us per mask "
+              f"({result['read_mb_per_s']:.0f} MB/s)")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+"""
+Reproducible benchmark suite of the simulation pipeline on a synthetic corpus.
+
+Times the stages of both generation modes (deformation, region growing, morphology,
+alignment, stats and writing) and the end-to-end throughput of the merged masks and
+the simulated images, with the random generators reseeded before every timed call.
+No EMIDEC data is needed: the corpus comes from `benchmarks.synthetic_corpus`. The
+results are written as JSON together with the commit and library versions, and can
+be compared with an earlier run. Run from the Data_Simulation_Pipeline directory:
+    python -m benchmarks.pipeline_benchmark --json pipeline.json --baseline previous.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+import numpy as np
+import cv2
+from typing import Callable, Dict, List, Any
+from benchmarks.synthetic_corpus import make_synthetic_corpus
+from mask_simulator.ImageProcessor import ImageProcessor
+from mask_simulator.generate_simulated_mask import generate_cardiac_image, iter_cardiac_images
+from mask_merger.MaskAlignment import MaskAlignment
+from mask_merger.merge_masks import iter_merged_masks
+from mask_extractor.extract_masks import get_random_mask_slice
+from mask_writer.MaskWriter import MaskWriter
+from stats_calculator.stats_calculator import StatsCalculator
+
+# Default settings of input_config_paramters.json, scaled to the synthetic slices
+IMAGE_SETTINGS = dict(number_of_seeds=80, energy=30, max_radius_step=2, max_theta_step=np.pi / 4,
+                      min_cluster_size=70, min_no_flow_size=30, ring_thick_max=40, ring_thick_min=15,
+                      background_color=0, blood_pool_color=30, mayocardium_color=60,
+                      infarction_color=100, no_flow_color=130)
+RATIO_LIMITS = dict(infarct_to_myo_upper_limit=0.5, infarct_to_myo_lower_limit=0.1,
+                    noflow_to_infarct_upper_limit=0.4, noflow_to_infarct_lower_limit=0.1)
+
+
+def time_seeded(function: Callable[[int], Any], repeats: int, seed: int) -> Dict[str, float]:
+    """
+    Time repeated calls with `random` and `np.random` reseeded before every call.
+
+    Args:
+        function: Function of the call number
+        repeats: Number of timed calls
+        seed: Seed used before call i is seed + i
+
+    Returns:
+        Dict[str, float]: Median, mean and minimum time per call in milliseconds
+    """
+    timings = []
+    for i in range(repeats):
+        random.seed(seed + i)
+        np.random.seed(seed + i)
+        start = time.perf_counter()
+        function(i)
+        timings.append((time.perf_counter() - start) * 1000)
+    return {'median_ms': float(np.median(timings)), 'mean_ms': float(np.mean(timings)),
+            'min_ms': float(np.min(timings)), 'calls': repeats}
+
+
+def _simulated_myocardium(image_size: int, seed: int) -> np.ndarray:
+    random.seed(seed)
+    np.random.seed(seed)
+    return ImageProcessor().generate_ring_with_cavity_and_cloud_infarctions(
+        height=image_size, width=image_size, outer_radius_max=image_size // 3, outer_radius_min=image_size // 4,
+        ring_thick_max=IMAGE_SETTINGS['ring_thick_max'], ring_thick_min=IMAGE_SETTINGS['ring_thick_min'])
+
+
+def benchmark_image_stages(image_size: int = 250, repeats: int = 20, seed: int = 0) -> Dict[str, Any]:
+    """
+    Time the `ImageProcessor` stages of `generate_cardiac_image` on a simulated myocardium.
+
+    Args:
+        image_size: Height and width of the simulated image
+        repeats: Number of timed calls per stage
+        seed: Seed of the simulated image and of the timed calls
+
+    Returns:
+        Dict[str, Any]: Timings of deformation, seeding, region growing, morphology and
+            cluster filtering
+    """
+    processor = ImageProcessor()
+    array = _simulated_myocardium(image_size, seed)
+    ring = (array == 150).astype(np.uint8) * 255
+    initial_seed, center_x, center_y = processor.select_initial_seed(array=array)
+    seeds = processor.generate_seeds(initial_seed, center_x, center_y, IMAGE_SETTINGS['number_of_seeds'],
+                                     IMAGE_SETTINGS['max_radius_step'], IMAGE_SETTINGS['max_theta_step'], array)
+    infarction = processor.spread_region_with_bias(seeds, IMAGE_SETTINGS['energy'], array)
+    closed = processor.morphological_processing(infarction)
+    clusters = processor.filter_clusters_by_size(closed, IMAGE_SETTINGS['min_cluster_size'])
+
+    return {
+        'deformation': time_seeded(lambda _: processor.apply_random_deformation(ring, 1), repeats, seed),
+        'seeds': time_seeded(lambda _: processor.generate_seeds(
+            initial_seed, center_x, center_y, IMAGE_SETTINGS['number_of_seeds'],
+            IMAGE_SETTINGS['max_radius_step'], IMAGE_SETTINGS['max_theta_step'], array), repeats, seed),
+        'region_growing': time_seeded(
+            lambda _: processor.spread_region_with_bias(seeds, IMAGE_SETTINGS['energy'], array), repeats, seed),
+        'no_flow_growing': time_seeded(lambda _: processor.add_no_flow(clusters), repeats, seed),
+        'morphology': time_seeded(lambda _: processor.morphological_processing(infarction), repeats, seed),
+        'cluster_filter': time_seeded(
+            lambda _: processor.filter_clusters_by_size(closed, IMAGE_SETTINGS['min_cluster_size']), repeats, seed)
+    }
+
+
+def benchmark_alignment(all_masks: Dict[str, Any], search_range: int = 10, rotation_step: int = 30,
+                        repeats: int = 5, seed: int = 0) -> Dict[str, Any]:
+    """
+    Time every alignment search engine on the same random slice pairs of the corpus.
+
+    Args:
+        all_masks: Dictionary containing all masks organized by case
+        search_range: Search range for alignment
+        rotation_step: Step of the rotation angles in degrees
+        repeats: Number of slice pairs
+        seed: Seed of the slice pairs
+
+    Returns:
+        Dict[str, Any]: Timings, evaluations per search and mean Dice coefficient of the
+            best alignment per engine
+    """
+    np.random.seed(seed)
+    random.seed(seed)
+    pairs = [(get_random_mask_slice(all_masks, 'mayocardium_masks')[0],
+              get_random_mask_slice(all_masks, 'infarction_masks')[0]) for _ in range(repeats)]
+    rotation_angles = np.arange(0, 360, rotation_step)
+    alignment = MaskAlignment()
+    centers = [alignment.calculate_mask_rad_and_position(myocardium)[0] for myocardium, _ in pairs]
+
+    results = {}
+    for method in MaskAlignment.ALIGNMENT_METHODS:
+        evaluations, scores = [], []
+
+        def align(i):
+            params = alignment.align(pairs[i][0], pairs[i][1], centers[i], search_range, rotation_angles, method)
+            evaluations.append(alignment.last_search_stats['evaluations'])
+            scores.append(params['metrics']['dice_coefficient'] if params['metrics'] else 0.0)
+
+        # The exhaustive search prints every candidate
+        with contextlib.redirect_stdout(io.StringIO()):
+            timing = time_seeded(align, repeats, seed)
+        results[method] = dict(timing, evaluations=float(np.mean(evaluations)), mean_dice=float(np.mean(scores)))
+    return results
+
+
+def benchmark_stats(all_masks: Dict[str, Any], image_size: int = 250, repeats: int = 20,
+                    seed: int = 0) -> Dict[str, Any]:
+    """
+    Time `StatsCalculator.process_mask` on finished simulated images.
+
+    Args:
+        all_masks: Dictionary containing all masks organized by case
+        image_size: Height and width of the simulated images
+        repeats: Number of timed calls
+        seed: Seed of the images and of the timed calls
+
+    Returns:
+        Dict[str, Any]: Timings
+    """
+    images = _simulated_images(all_masks, image_size, repeats, seed)
+    stats_calculator = StatsCalculator(infarction_val=IMAGE_SETTINGS['infarction_color'],
+                                       myocardium_val=IMAGE_SETTINGS['mayocardium_color'],
+                                       no_flow_val=IMAGE_SETTINGS['no_flow_color'])
+    return time_seeded(lambda i: stats_calculator.process_mask(images[i], **RATIO_LIMITS), repeats, seed)
+
+
+def _simulated_images(all_masks: Dict[str, Any], image_size: int, count: int, seed: int) -> List[np.ndarray]:
+    images = []
+    for i in range(count):
+        random.seed(seed + i)
+        np.random.seed(seed + i)
+        image, _ = generate_cardiac_image(all_masks=all_masks, image_size=(image_size, image_size),
+                                          show_plots=False, **IMAGE_SETTINGS)
+        images.append(image)
+    return images
+
+
+def benchmark_writing(all_masks: Dict[str, Any], work_dir: str, masks: int = 200,
+                      output_writers: int = 1) -> Dict[str, Any]:
+    """
+    Time `MaskWriter` on the label maps of the corpus for every output format.
+
+    Args:
+        all_masks: Dictionary containing all masks organized by case
+        work_dir: Directory the masks are written to
+        masks: Number of masks written per format
+        output_writers: Background writer threads (0 writes inline)
+
+    Returns:
+        Dict[str, Any]: Masks per second and bytes written per format
+    """
+    label_maps = [mask for case_masks in all_masks.values() for mask in case_masks['standard_mask']]
+    label_maps = [label_maps[i % len(label_maps)] for i in range(masks)]
+    results = {}
+    for name, output_format, mask_codec in (('npy', 'npy', None), ('png', 'png', None),
+                                            ('mask_rle', 'npy', 'rle'), ('shards', 'shards', None)):
+        output_dir = os.path.join(work_dir, name)
+        os.makedirs(output_dir)
+        start = time.perf_counter()
+        writer = MaskWriter(output_format, output_writers, mask_codec=mask_codec)
+        for i, mask in enumerate(label_maps):
+            writer.submit(output_dir, f"mask_{i:06d}", mask)
+        writer.close()
+        elapsed = time.perf_counter() - start
+        written = sum(entry.stat().st_size for entry in os.scandir(output_dir))
+        results[name] = {'masks_per_s': masks / elapsed, 'ms_per_mask': 1000 * elapsed / masks,
+                         'bytes_per_mask': written / masks}
+    return results
+
+
+def benchmark_end_to_end(all_masks: Dict[str, Any], image_size: int = 250, masks: int = 20,
+                         seed: int = 0, workers: int = 1, search_range: int = 10,
+                         rotation_step: int = 30, alignment_method: str = 'exhaustive') -> Dict[str, Any]:
+    """
+    Generate merged masks and simulated images (real and simulated myocardium, and the batched
+    engine) without writing them.
+
+    Args:
+        all_masks: Dictionary containing all masks organized by case
+        image_size: Height and width of the simulated images
+        masks: Number of masks per mode
+        seed: Seed of the runs
+        workers: Worker processes per run
+        search_range: Search range for alignment
+        rotation_step: Step of the rotation angles in degrees
+        alignment_method: Alignment search engine of the merge mode
+
+    Returns:
+        Dict[str, Any]: Masks per second per mode
+    """
+    runs = {
+        'merged': lambda: iter_merged_masks(
+            all_masks, masks, search_range, np.arange(0, 360, rotation_step), False,
+            alignment_method=alignment_method, workers=workers, seed=seed, output_format='none'),
+    }
+    for mayocardium_type in ('real', 'simulated'):
+        runs[f"simulated_{mayocardium_type}"] = lambda mayocardium_type=mayocardium_type: iter_cardiac_images(
+            masks, None, all_masks, mayocardium_type=mayocardium_type, image_size=(image_size, image_size),
+            show_plots=False, workers=workers, seed=seed, output_format='none',
+            **IMAGE_SETTINGS, **RATIO_LIMITS)
+    runs['simulated_batched'] = lambda: iter_cardiac_images(
+        masks, None, all_masks, mayocardium_type='simulated', image_size=(image_size, image_size),
+        show_plots=False, workers=workers, seed=seed, output_format='none', engine='batched',
+        **IMAGE_SETTINGS, **RATIO_LIMITS)
+
+    results = {}
+    for name, run in runs.items():
+        # The pipeline prints a line per mask, which would drown the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            generated = sum(1 for _ in run())
+            elapsed = time.perf_counter() - start
+        results[name] = {'masks': generated, 'seconds': elapsed, 'masks_per_s': generated / elapsed}
+    return results
+
+
+def _environment() -> Dict[str, Any]:
+    """
+    Describe the code and machine a run was made on.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'timestamp': datetime.now(timezone.utc).isoformat(), 'commit': commit,
+            'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count()}
+
+
+def _flatten(results: Dict[str, Any], prefix: str = '') -> Dict[str, float]:
+    """
+    Map 'section/stage/metric' to every median time and throughput of a result dict.
+    """
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}/"))
+        elif key in ('median_ms', 'masks_per_s'):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare_results(results: Dict[str, Any], baseline: Dict[str, Any]) -> Dict[str, float]:
+    """
+    Speedup of every timing in `results` over the same timing in `baseline`.
+
+    Args:
+        results: Output of this run
+        baseline: Output of an earlier run with the same arguments
+
+    Returns:
+        Dict[str, float]: Speedup per 'section/stage/metric'; above 1 is faster
+    """
+    current, previous = _flatten(results['benchmarks']), _flatten(baseline['benchmarks'])
+    speedups = {}
+    for key in current.keys() & previous.keys():
+        if key.endswith('median_ms'):
+            speedups[key] = previous[key] / max(current[key], 1e-9)
+        else:
+            speedups[key] = current[key] / max(previous[key], 1e-9)
+    return dict(sorted(speedups.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the simulation pipeline on a synthetic corpus.")
+    parser.add_argument('--cases', type=int, default=20, help='Cases of the synthetic corpus.')
+    parser.add_argument('--slices', type=int, default=8, help='Slices per case.')
+    parser.add_argument('--corpus-size', type=int, default=128, help='Height and width of the corpus slices.')
+    parser.add_argument('--image-size', type=int, default=250, help='Height and width of the simulated images.')
+    parser.add_argument('--repeats', type=int, default=20, help='Timed calls per stage.')
+    parser.add_argument('--alignment-repeats', type=int, default=5, help='Slice pairs per alignment engine.')
+    parser.add_argument('--masks', type=int, default=20, help='Masks per end-to-end run.')
+    parser.add_argument('--write-masks', type=int, default=200, help='Masks written per output format.')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes of the end-to-end runs.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the corpus and of the timed calls.')
+    parser.add_argument('--skip', type=str, nargs='*', default=[],
+                        choices=['image_stages', 'alignment', 'stats', 'writing', 'end_to_end'],
+                        help='Sections to leave out.')
+    parser.add_argument('--json', type=str, default=None, help='Optional path to write the results to.')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='Results of an earlier run to print the speedups against.')
+    args = parser.parse_args()
+    # Rejected attempts are logged as warnings, which would drown the results
+    logging.basicConfig(level=logging.ERROR)
+
+    all_masks = make_synthetic_corpus(args.cases, args.slices, (args.corpus_size, args.corpus_size), args.seed)
+    sections = {
+        'image_stages': lambda: benchmark_image_stages(args.image_size, args.repeats, args.seed),
+        'alignment': lambda: benchmark_alignment(all_masks, repeats=args.alignment_repeats, seed=args.seed),
+        'stats': lambda: benchmark_stats(all_masks, args.image_size, args.repeats, args.seed),
+        'writing': lambda: benchmark_writing(all_masks, temp_dir, args.write_masks),
+        'end_to_end': lambda: benchmark_end_to_end(all_masks, args.image_size, args.masks, args.seed, args.workers)
+    }
+    results = {'environment': _environment(), 'arguments': vars(args), 'benchmarks': {}}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name, benchmark in sections.items():
+            if name not in args.skip:
+                results['benchmarks'][name] = benchmark()
+
+    for key, value in _flatten(results['benchmarks']).items():
+        unit = 'ms' if key.endswith('median_ms') else 'masks/s'
+        print(f"{key.rsplit('/', 1)[0]}: {value:.2f} {unit}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        results['speedup_vs_baseline'] = compare_results(results, baseline)
+        print(f"Speedup against {args.baseline} (commit {baseline['environment'].get('commit')}):")
+        for key, speedup in results['speedup_vs_baseline'].items():
+            print(f"- {key.rsplit('/', 1)[0]}: {speedup:.2f}x")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Synthetic EMIDEC-like mask corpus for the benchmarks, so no patient data is needed.
+
+Every slice is a label map with the EMIDEC values (0 background, 1 blood pool,
+2 myocardium, 3 infarction, 4 no-reflow): an elliptic myocardium ring around the
+blood pool, with an infarct sector and a no-reflow core in the pathological cases.
+The slices go through `MaskExtractor.extract_masks_from_nd_arrays`, so the dict has
+exactly the layout of an extracted masks.npy.
+"""
+import numpy as np
+import cv2
+from typing import Dict, Any, Tuple
+from mask_extractor.MaskExtractor import MaskExtractor
+
+
+def make_label_map(rng: np.random.Generator, image_size: Tuple[int, int] = (128, 128),
+                   pathological: bool = True) -> np.ndarray:
+    """
+    Draw one synthetic short-axis label map.
+
+    Args:
+        rng (np.random.Generator): Random generator of the slice
+        image_size (Tuple[int, int]): Height and width of the slice
+        pathological (bool): Add an infarction and, mostly, a no-reflow core
+
+    Returns:
+        np.ndarray: uint8 label map
+    """
+    height, width = image_size
+    size = min(height, width)
+    label_map = np.zeros((height, width), dtype=np.uint8)
+    center = (int(width // 2 + rng.integers(-size // 16, size // 16 + 1)),
+              int(height // 2 + rng.integers(-size // 16, size // 16 + 1)))
+    outer = (int(rng.integers(size // 5, size // 4 + 1)), int(rng.integers(size // 5, size // 4 + 1)))
+    thickness = int(rng.integers(max(2, size // 18), max(3, size // 10) + 1))
+    inner = (max(1, outer[0] - thickness), max(1, outer[1] - thickness))
+    angle = float(rng.uniform(0, 180))
+    cv2.ellipse(label_map, center, outer, angle, 0, 360, 2, thickness=-1)
+    cv2.ellipse(label_map, center, inner, angle, 0, 360, 1, thickness=-1)
+
+    if pathological:
+        # Infarct: a sector of the ring, transmural or only subendocardial
+        start = float(rng.uniform(0, 360))
+        extent = float(rng.uniform(30, 120))
+        sector = np.zeros_like(label_map)
+        cv2.ellipse(sector, center, outer, angle, start, start + extent, 1, thickness=-1)
+        depth = float(rng.uniform(0.5, 1.0))
+        reach = (int(inner[0] + depth * thickness), int(inner[1] + depth * thickness))
+        transmural = np.zeros_like(label_map)
+        cv2.ellipse(transmural, center, reach, angle, 0, 360, 1, thickness=-1)
+        label_map[(sector > 0) & (transmural > 0) & (label_map == 2)] = 3
+        if rng.random() < 0.7:
+            # No-reflow core in the middle of the infarct
+            middle = np.deg2rad(angle + start + extent / 2)
+            radius = (inner[0] + inner[1]) / 2 + thickness * depth / 2
+            core_center = (int(center[0] + radius * np.cos(middle)), int(center[1] + radius * np.sin(middle)))
+            core = np.zeros_like(label_map)
+            cv2.circle(core, core_center, max(2, thickness // 3), 1, thickness=-1)
+            label_map[(core > 0) & (label_map == 3)] = 4
+    return label_map
+
+
+def make_synthetic_corpus(cases: int = 20, slices: int = 8, image_size: Tuple[int, int] = (128, 128),
+                          seed: int = 0) -> Dict[str, Any]:
+    """
+    Build a masks.npy-style dict of synthetic cases.
+
+    Every other case is pathological ('Case_P...'), the others are normal ('Case_N...'),
+    as the infarction sampling only draws from case ids containing 'P'. The same
+    arguments always give the same corpus.
+
+    Args:
+        cases (int): Number of cases
+        slices (int): Slices per case
+        image_size (Tuple[int, int]): Height and width of the slices
+        seed (int): Seed of the corpus
+
+    Returns:
+        Dict[str, Any]: Dictionary containing all masks organized by case
+    """
+    rng = np.random.default_rng(seed)
+    extractor = MaskExtractor('.')
+    all_masks = {}
+    for case in range(cases):
+        pathological = case % 2 == 0
+        case_id = f"Case_{'P' if pathological else 'N'}{case:03d}"
+        # MaskExtractor reads the label map from channel 1 of the EMIDEC arrays
+        nd_arrays = [np.stack([np.zeros(image_size, dtype=np.uint8),
+                               make_label_map(rng, image_size, pathological)], axis=-1)
+                     for _ in range(slices)]
+        all_masks[case_id] = extractor.extract_masks_from_nd_arrays(nd_arrays)
+    return all_masks
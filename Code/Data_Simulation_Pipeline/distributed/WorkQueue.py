@@ -0,0 +1,300 @@
+import contextlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Any, Iterator, Optional, Tuple, Union
+from mask_writer.ShardedMaskDataset import write_atomic
+
+# Folders of the output directory: the queues of the steps and the output of every node
+QUEUE_DIR = 'work_queue'
+NODES_DIR = 'nodes'
+PLAN_FILE = 'plan.json'
+LEASE_SUFFIX = '.lease'
+DONE_SUFFIX = '.done'
+
+
+def default_node_id() -> str:
+    """
+    Get a node id unique among the processes sharing a queue: host name and process id.
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def batch_file_name(batch: int, suffix: str) -> str:
+    """
+    Get the lease or done file name of a batch.
+    """
+    return f"batch_{batch:06d}{suffix}"
+
+
+class WorkQueue:
+    """
+    Work queue of one generation step on a shared file system, without a broker.
+
+    The mask indices of the step are split into batches of `batch_size` consecutive
+    indices. A node claims a batch by creating `batch_<n>.lease` in the queue directory
+    with `os.link`, which is atomic on NFS, so exactly one node wins each batch. While
+    a node works on a batch a heartbeat thread touches the lease every third of
+    `lease_seconds`; a lease older than `lease_seconds` belongs to a crashed node and is
+    taken over by the next node looking for work. A finished batch gets a
+    `batch_<n>.done` record naming the node that holds its masks, created the same way.
+
+    Lease ages are compared with the clock of the node that reads them, so the clocks
+    of the nodes must agree to well within `lease_seconds`. A batch taken over from a
+    node that was only slow may be generated twice; both copies are identical as
+    every mask index has its own random stream, and the done record decides which one
+    is merged.
+
+    `plan.json` fixes the number of masks and the batch size when the first node
+    creates the queue; nodes started with other values are refused.
+    """
+
+    def __init__(self, queue_dir: Union[str, Path], number: int, batch_size: int = 64,
+                 lease_seconds: float = 600, node_id: Optional[str] = None):
+        """
+        Initialize the WorkQueue, creating the queue or joining the existing one.
+
+        Args:
+            queue_dir (Union[str, Path]): Queue directory of the step on the shared file system
+            number (int): Number of masks of the step
+            batch_size (int): Mask indices per batch
+            lease_seconds (float): Age after which the lease of a batch is taken over
+            node_id (Optional[str]): Name of this node in the leases and done records;
+                host name and process id when None
+        """
+        self.queue_dir = Path(queue_dir)
+        self.queue_dir.mkdir(parents=True, exist_ok=True)
+        self.lease_seconds = float(lease_seconds)
+        self.node_id = node_id or default_node_id()
+        plan = self._join({'number': int(number), 'batch_size': max(1, int(batch_size))})
+        self.number = plan['number']
+        self.batch_size = plan['batch_size']
+        self.batch_count = -(-self.number // self.batch_size)
+
+    @classmethod
+    def open(cls, queue_dir: Union[str, Path], lease_seconds: float = 600,
+             node_id: Optional[str] = None) -> "WorkQueue":
+        """
+        Open an existing queue with the plan of the node that created it.
+        """
+        with open(Path(queue_dir) / PLAN_FILE) as file:
+            plan = json.load(file)
+        return cls(queue_dir, plan['number'], plan['batch_size'], lease_seconds, node_id)
+
+    def _join(self, plan: Dict[str, int]) -> Dict[str, int]:
+        plan_path = self.queue_dir / PLAN_FILE
+        if not plan_path.exists():
+            # Written aside and linked into place, so concurrent first nodes agree on one plan
+            draft = self.queue_dir / f"{PLAN_FILE}.{self.node_id}"
+            write_atomic(draft, lambda file: file.write(json.dumps(plan).encode()))
+            with contextlib.suppress(FileExistsError):
+                os.link(draft, plan_path)
+            os.remove(draft)
+        with open(plan_path) as file:
+            stored = json.load(file)
+        if stored != plan:
+            raise ValueError(f"{self.queue_dir} holds a queue of {stored['number']} masks in batches of "
+                             f"{stored['batch_size']}, not {plan['number']} in batches of {plan['batch_size']}")
+        return stored
+
+    def batch_indices(self, batch: int) -> range:
+        """
+        Get the mask indices of a batch.
+        """
+        return range(batch * self.batch_size, min(self.number, (batch + 1) * self.batch_size))
+
+    def _path(self, batch: int, suffix: str) -> Path:
+        return self.queue_dir / batch_file_name(batch, suffix)
+
+    def _lease_age(self, lease_path: Path) -> Optional[float]:
+        try:
+            return time.time() - lease_path.stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def claim(self) -> Optional[int]:
+        """
+        Claim the first batch that is neither done nor leased by a live node.
+
+        Returns:
+            Optional[int]: Claimed batch, None when every batch is done or leased
+        """
+        for batch in range(self.batch_count):
+            if self._path(batch, DONE_SUFFIX).exists():
+                continue
+            lease_path = self._path(batch, LEASE_SUFFIX)
+            age = self._lease_age(lease_path)
+            if age is not None:
+                if self._read(lease_path).get('node') == self.node_id and self.renew(batch):
+                    # Left behind by this node before it was restarted
+                    return batch
+                if age < self.lease_seconds or not self._break_lease(lease_path):
+                    continue
+            if self._create_lease(batch):
+                if not self._path(batch, DONE_SUFFIX).exists():
+                    return batch
+                # Finished and released by another node since the check above
+                lease_path.unlink(missing_ok=True)
+        return None
+
+    def _create_lease(self, batch: int) -> bool:
+        draft = self.queue_dir / f"{batch_file_name(batch, LEASE_SUFFIX)}.{self.node_id}"
+        lease = {'node': self.node_id, 'claimed': time.time()}
+        write_atomic(draft, lambda file: file.write(json.dumps(lease).encode()))
+        try:
+            os.link(draft, self._path(batch, LEASE_SUFFIX))
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(draft)
+
+    def _break_lease(self, lease_path: Path) -> bool:
+        # Renaming is atomic, so of all nodes finding the expired lease only one removes it
+        expired_path = lease_path.with_name(f"{lease_path.name}.expired.{self.node_id}")
+        try:
+            os.rename(lease_path, expired_path)
+        except FileNotFoundError:
+            return False
+        age = self._lease_age(expired_path)
+        if age is not None and age < self.lease_seconds:
+            # Renewed since it was checked, give it back
+            with contextlib.suppress(FileExistsError):
+                os.link(expired_path, lease_path)
+            os.remove(expired_path)
+            return False
+        owner = self._read(expired_path).get('node')
+        os.remove(expired_path)
+        logging.warning(f"Lease of {lease_path.name} held by {owner} expired, re-issuing the batch")
+        return True
+
+    @staticmethod
+    def _read(path: Path) -> Dict[str, Any]:
+        try:
+            with open(path) as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def renew(self, batch: int) -> bool:
+        """
+        Refresh the lease of a claimed batch.
+
+        Returns:
+            bool: False when the lease was taken over by another node
+        """
+        lease_path = self._path(batch, LEASE_SUFFIX)
+        if self._read(lease_path).get('node') != self.node_id:
+            return False
+        try:
+            os.utime(lease_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    @contextlib.contextmanager
+    def hold(self, batch: int) -> Iterator[None]:
+        """
+        Keep the lease of a claimed batch alive while the block runs.
+        """
+        stopped = threading.Event()
+
+        def heartbeat():
+            while not stopped.wait(self.lease_seconds / 3):
+                if not self.renew(batch):
+                    logging.warning(f"Lease of batch {batch} was taken over by another node")
+                    return
+
+        thread = threading.Thread(target=heartbeat, name=f"lease-{batch}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def complete(self, batch: int, summary: Dict[str, Any] = None) -> None:
+        """
+        Record a batch as done by this node, unless another node finished it first, and
+        release its lease.
+
+        Args:
+            batch (int): Claimed batch
+            summary (Dict[str, Any]): Extra fields of the done record, e.g. the elapsed time
+        """
+        record = dict(summary or {}, node=self.node_id, batch=batch, indices=len(self.batch_indices(batch)),
+                      finished=time.time())
+        draft = self.queue_dir / f"{batch_file_name(batch, DONE_SUFFIX)}.{self.node_id}"
+        write_atomic(draft, lambda file: file.write(json.dumps(record).encode()))
+        # The first node to finish a re-issued batch keeps it
+        with contextlib.suppress(FileExistsError):
+            os.link(draft, self._path(batch, DONE_SUFFIX))
+        os.remove(draft)
+        if self._read(self._path(batch, LEASE_SUFFIX)).get('node') == self.node_id:
+            self._path(batch, LEASE_SUFFIX).unlink(missing_ok=True)
+
+    def batches(self) -> Iterator[Tuple[int, range]]:
+        """
+        Claim batches until none is left, holding the lease of each while it is processed.
+
+        Yields:
+            Tuple[int, range]: Batch and its mask indices; the batch is recorded as done
+                once the loop body returns
+        """
+        while (batch := self.claim()) is not None:
+            start_time = time.perf_counter()
+            with self.hold(batch):
+                yield batch, self.batch_indices(batch)
+            self.complete(batch, {'elapsed': time.perf_counter() - start_time})
+
+    def done_records(self) -> Dict[int, Dict[str, Any]]:
+        """
+        Get the done records by batch.
+        """
+        records = {}
+        for batch in range(self.batch_count):
+            record = self._read(self._path(batch, DONE_SUFFIX))
+            if record:
+                records[batch] = record
+        return records
+
+    def progress(self) -> Dict[str, Any]:
+        """
+        Summarize the queue.
+
+        Returns:
+            Dict[str, Any]: Batch and mask counts (done, leased, expired and pending
+                batches), and per node the batches and masks done and the batches leased
+        """
+        done = self.done_records()
+        leased, expired = [], []
+        nodes: Dict[str, Dict[str, Any]] = {}
+        for batch in range(self.batch_count):
+            if batch in done:
+                node = nodes.setdefault(done[batch]['node'], {'batches': 0, 'masks': 0, 'seconds': 0.0, 'leased': []})
+                node['batches'] += 1
+                node['masks'] += done[batch]['indices']
+                node['seconds'] += done[batch].get('elapsed', 0.0)
+                continue
+            lease_path = self._path(batch, LEASE_SUFFIX)
+            age = self._lease_age(lease_path)
+            if age is None:
+                continue
+            (leased if age < self.lease_seconds else expired).append(batch)
+            owner = self._read(lease_path).get('node', '?')
+            nodes.setdefault(owner, {'batches': 0, 'masks': 0, 'seconds': 0.0, 'leased': []})['leased'].append(batch)
+        return {
+            'number': self.number,
+            'batch_size': self.batch_size,
+            'batches': self.batch_count,
+            'done': len(done),
+            'done_masks': sum(record['indices'] for record in done.values()),
+            'leased': leased,
+            'expired': expired,
+            'pending': self.batch_count - len(done) - len(leased) - len(expired),
+            'nodes': nodes
+        }
@@ -0,0 +1,228 @@
+"""
+Coordinator of a distributed run: progress of the work queues and merge of the node outputs.
+
+Nodes started with `python main.py <config> --distributed` share the `output_dir` of the
+config on a shared file system and write their masks to `<output_dir>/nodes/<node id>/`
+(see `WorkQueue`). Run from the Data_Simulation_Pipeline directory:
+    python -m distributed.coordinator <config> status
+    python -m distributed.coordinator <config> merge
+    python -m distributed.coordinator <config> run-local --nodes 4
+`merge` moves the masks of every finished step into `<output_dir>/<step>/`, the layout
+of a single-machine run, together with one `run_manifest.json` merged from the node
+manifests. `run-local` starts processes standing in for nodes, reports their progress
+and merges once they are done.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+import numpy as np
+from typing import Callable, Dict, List, Any, Optional
+from distributed.WorkQueue import WorkQueue, QUEUE_DIR, NODES_DIR
+from mask_writer.RunManifest import RunManifest, MANIFEST_FILE, mask_index
+from mask_writer.ShardedMaskDataset import (ShardedMaskDataset, INDEX_FILE, TEMP_SUFFIX, save_atomic,
+                                            shard_file_name)
+
+# Generation steps and the folder of their generated images in the streaming mode
+STEPS = {'merged_masks': 'final_generated_merged', 'simulated_masks': 'final_generated_simulated'}
+
+
+def output_index(file_name: str) -> Optional[int]:
+    """
+    Get the mask index of an output file or shard entry, also of generated images.
+    """
+    name = os.path.splitext(file_name)[0]
+    return mask_index(name[:-len('_generated')] if name.endswith('_generated') else name)
+
+
+def open_queues(output_dir: str, lease_seconds: float = 600) -> Dict[str, WorkQueue]:
+    """
+    Open the work queues of the steps the nodes have started.
+    """
+    queues = {}
+    for step in STEPS:
+        queue_dir = Path(output_dir) / QUEUE_DIR / step
+        if queue_dir.exists():
+            queues[step] = WorkQueue.open(queue_dir, lease_seconds, node_id='coordinator')
+    return queues
+
+
+def print_status(output_dir: str, lease_seconds: float = 600) -> Dict[str, Dict[str, Any]]:
+    """
+    Print the progress of every step and node.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: `WorkQueue.progress` by step
+    """
+    status = {}
+    for step, queue in open_queues(output_dir, lease_seconds).items():
+        progress = status[step] = queue.progress()
+        print(f"{step}: {progress['done_masks']}/{progress['number']} masks, {progress['done']}/{progress['batches']} "
+              f"batches done, {len(progress['leased'])} leased, {len(progress['expired'])} expired, "
+              f"{progress['pending']} pending")
+        for node, counts in sorted(progress['nodes'].items()):
+            rate = counts['masks'] / counts['seconds'] if counts['seconds'] else 0.0
+            print(f"- {node}: {counts['batches']} batches, {counts['masks']} masks ({rate:.2f} masks/s)"
+                  + (f", working on batch {', '.join(map(str, counts['leased']))}" if counts['leased'] else ""))
+    if not status:
+        print(f"No work queue in {output_dir}")
+    return status
+
+
+def merge_directory(sources: Dict[str, Path], target: Path, keep: Callable[[str, int], bool]) -> int:
+    """
+    Move the masks of the node folders into one folder.
+
+    Loose files are renamed into `target`; shards are renamed after the shards already in
+    `target`, or rewritten without the masks that are not kept, and the index is rebuilt.
+
+    Args:
+        sources (Dict[str, Path]): Folder of every node
+        target (Path): Merged folder
+        keep (Callable[[str, int], bool]): Whether the mask of an index is taken from a node
+
+    Returns:
+        int: Number of masks moved
+    """
+    target.mkdir(parents=True, exist_ok=True)
+    moved = set()
+    for node, source in sorted(sources.items()):
+        if ShardedMaskDataset.is_sharded(source):
+            for shard in ShardedMaskDataset.shard_numbers(source):
+                shard_numbers = ShardedMaskDataset.shard_numbers(target)
+                shard_path = target / shard_file_name(shard_numbers[-1] + 1 if shard_numbers else 0)
+                with np.load(source / shard_file_name(shard)) as data:
+                    names = data['names'].astype(str)
+                    kept = np.array([keep(node, output_index(name)) for name in names], dtype=bool)
+                    if kept.all():
+                        os.replace(source / shard_file_name(shard), shard_path)
+                    elif kept.any():
+                        save_atomic(shard_path, masks=data['masks'][kept], names=names[kept],
+                                    label_counts=data['label_counts'][kept])
+                        os.remove(source / shard_file_name(shard))
+                moved.update(output_index(name) for name in names[kept])
+            (source / INDEX_FILE).unlink(missing_ok=True)
+            continue
+        for entry in os.scandir(source):
+            if entry.name == MANIFEST_FILE or entry.name.endswith(TEMP_SUFFIX):
+                continue
+            index = output_index(entry.name)
+            if index is not None and keep(node, index):
+                os.replace(entry.path, target / entry.name)
+                moved.add(index)
+    if ShardedMaskDataset.shard_numbers(target):
+        # Rebuilt from the shards now in the folder
+        ShardedMaskDataset.read_index(target)
+    return len(moved)
+
+
+def merge_step(output_dir: str, step: str, queue: WorkQueue) -> int:
+    """
+    Merge the output and the manifests of one finished step.
+
+    Every batch is taken from the node named in its done record, so a batch generated
+    twice after its lease expired is only merged once.
+
+    Args:
+        output_dir (str): Output directory of the run
+        step (str): 'merged_masks' or 'simulated_masks'
+        queue (WorkQueue): Work queue of the step
+
+    Returns:
+        int: Number of masks merged
+    """
+    records = queue.done_records()
+    if len(records) < queue.batch_count:
+        raise ValueError(f"{step}: {queue.batch_count - len(records)} of {queue.batch_count} batches are not done yet")
+    owners = {index: record['node'] for batch, record in records.items() for index in queue.batch_indices(batch)}
+    keep = lambda node, index: owners.get(index) == node
+    nodes_dir = Path(output_dir) / NODES_DIR
+    nodes = sorted({record['node'] for record in records.values()})
+
+    # The node manifests must describe the same run, their union is the manifest of the step
+    manifests = {}
+    for node in nodes:
+        with open(nodes_dir / node / step / MANIFEST_FILE) as file:
+            manifests[node] = json.load(file)
+    first = manifests[nodes[0]]
+    for node, manifest in manifests.items():
+        if manifest['seed'] != first['seed'] or manifest['settings'] != first['settings']:
+            raise ValueError(f"{step}: node {node} ran with another seed or other settings than node {nodes[0]}")
+
+    target = Path(output_dir) / step
+    merged = merge_directory({node: nodes_dir / node / step for node in nodes}, target, keep)
+    generated_sources = {node: nodes_dir / node / STEPS[step] for node in nodes
+                         if (nodes_dir / node / STEPS[step]).exists()}
+    if generated_sources:
+        merge_directory(generated_sources, Path(output_dir) / STEPS[step], keep)
+    RunManifest(target, first['seed'], queue.number, first['settings'], completed=owners.keys()).save()
+    print(f"{step}: merged {merged} masks of {len(nodes)} nodes into {target}")
+    return merged
+
+
+def merge_run(output_dir: str, lease_seconds: float = 600) -> Dict[str, int]:
+    """
+    Merge every step of a distributed run.
+
+    Returns:
+        Dict[str, int]: Number of masks merged by step
+    """
+    return {step: merge_step(output_dir, step, queue)
+            for step, queue in open_queues(output_dir, lease_seconds).items()}
+
+
+def run_local(config_path: str, output_dir: str, nodes: int, lease_seconds: float = 600,
+              poll_seconds: float = 10) -> List[int]:
+    """
+    Run a distributed run with local processes standing in for the nodes, then merge it.
+
+    Args:
+        config_path (str): Config of the run
+        output_dir (str): Output directory of the config
+        nodes (int): Number of node processes
+        lease_seconds (float): Lease expiry of the config, for the progress report
+        poll_seconds (float): Seconds between two progress reports
+
+    Returns:
+        List[int]: Exit code of every node
+    """
+    main_path = Path(__file__).resolve().parent.parent / 'main.py'
+    processes = [subprocess.Popen([sys.executable, str(main_path), config_path, '--distributed',
+                                   '--node-id', f"local-{node}"], stdout=subprocess.DEVNULL)
+                 for node in range(nodes)]
+    while any(process.poll() is None for process in processes):
+        time.sleep(poll_seconds)
+        print_status(output_dir, lease_seconds)
+    exit_codes = [process.returncode for process in processes]
+    print(f"Nodes finished with exit codes {exit_codes}")
+    print_status(output_dir, lease_seconds)
+    if not any(exit_codes):
+        merge_run(output_dir, lease_seconds)
+    return exit_codes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the progress of a distributed run and merge its output.")
+    parser.add_argument('config_path', type=str, help='Path to the JSON configuration file of the run.')
+    parser.add_argument('command', choices=('status', 'merge', 'run-local'))
+    parser.add_argument('--nodes', type=int, default=2, help='Node processes started by run-local.')
+    parser.add_argument('--poll-seconds', type=float, default=10, help='Seconds between progress reports of run-local.')
+    args = parser.parse_args()
+
+    with open(args.config_path) as file:
+        paths = json.load(file)['paths']
+    output_dir = paths['output_dir']
+    lease_seconds = paths.get('lease_seconds', 600)
+    if args.command == 'status':
+        print_status(output_dir, lease_seconds)
+    elif args.command == 'merge':
+        merge_run(output_dir, lease_seconds)
+    else:
+        sys.exit(1 if any(run_local(args.config_path, output_dir, args.nodes, lease_seconds, args.poll_seconds)) else 0)
+
+
+if __name__ == "__main__":
+    main()
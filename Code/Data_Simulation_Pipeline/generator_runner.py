@@ -2,46 +2,108 @@ import os
 import numpy as np
 import tensorflow as tf
 import matplotlib.pyplot as plt
+from typing import Iterable, Iterator, Tuple
+from mask_writer.MaskWriter import MaskWriter
+from mask_writer.ShardedMaskDataset import ShardedMaskDataset, open_mask_dataset
+from instrumentation.Profiler import profiler
 
-def run_generator(masks_dir, model_path, output_dir):
-    def load_mask_dataset(masks_path):
-        masks = []
-        filenames = []
-        mask_files = sorted(f for f in os.listdir(masks_path) if f.endswith('.npy'))
+def load_generator(model_path):
+    return tf.keras.models.load_model(model_path, compile=False)
 
-        for mask_file in mask_files:
-            mask_path = os.path.join(masks_path, mask_file)
-            mask = np.load(mask_path).astype(np.float32)
-            if mask.ndim == 2:
-                mask = np.expand_dims(mask, axis=-1)
-            masks.append(mask)
-            filenames.append(mask_file)
+def generate_images(generator, named_masks: Iterable[Tuple[str, np.ndarray]],
+                    batch_size: int = 16) -> Iterator[Tuple[str, np.ndarray]]:
+    """
+    Run the generator on a stream of masks in batches.
 
-        masks = tf.convert_to_tensor(masks, dtype=tf.float32)
-        return masks, filenames
+    Only one batch of masks and images is held at a time, so memory does not depend on
+    the number of masks. Masks of different shapes go into separate batches.
 
-    masks_tensor, filenames = load_mask_dataset(masks_dir)
-    test_dataset = tf.data.Dataset.from_tensor_slices(masks_tensor).batch(1).prefetch(tf.data.AUTOTUNE)
+    Args:
+        generator: Loaded generator model
+        named_masks (Iterable[Tuple[str, np.ndarray]]): (name, mask) pairs, e.g. from
+            `iter_merged_masks` or a mask dataset
+        batch_size (int): Number of masks per generator call
 
-    generator = tf.keras.models.load_model(model_path, compile=False)
+    Yields:
+        Tuple[str, np.ndarray]: Mask name and its generated image
+    """
+    def run_batch(names, masks):
+        with profiler.stage('inference'):
+            generated = generator(np.stack(masks), training=False).numpy()
+        return zip(names, generated)
+
+    names, masks = [], []
+    for name, mask in named_masks:
+        mask = np.asarray(mask).astype(np.float32)
+        if mask.ndim == 2:
+            mask = np.expand_dims(mask, axis=-1)
+        if masks and (len(masks) >= batch_size or mask.shape != masks[0].shape):
+            yield from run_batch(names, masks)
+            names, masks = [], []
+        names.append(name)
+        masks.append(mask)
+    if masks:
+        yield from run_batch(names, masks)
+
+def save_generated_images(generated_images: Iterable[Tuple[str, np.ndarray]], output_dir, sharded=False) -> int:
+    """
+    Save generated images as <name>_generated.npy (raw) and .png (visual), or into shards.
+
+    Returns:
+        int: Number of saved images
+    """
     os.makedirs(output_dir, exist_ok=True)
+    # Sharded masks give sharded generated images, without the preview PNGs
+    shard_writer = MaskWriter('shards') if sharded else None
+    saved = 0
+    try:
+        for name, raw_generated_np in generated_images:
+            saved += 1
+            if shard_writer is not None:
+                shard_writer.submit(output_dir, f"{name}_generated", raw_generated_np)
+                continue
+
+            npy_path = os.path.join(output_dir, f"{name}_generated.npy")
+            np.save(npy_path, raw_generated_np)
+
+            vis_np = (raw_generated_np + 1.0) / 2.0
+            if vis_np.shape[-1] == 1:
+                vis_np = np.squeeze(vis_np, axis=-1)
+
+            png_path = os.path.join(output_dir, f"{name}_generated.png")
+            plt.imsave(png_path, vis_np, cmap='gray')
 
-    for mask_tensor, filename in zip(test_dataset, filenames):
-        generated = generator(mask_tensor, training=False)[0]
-        raw_generated_np = generated.numpy()
+            print(f"✅ Saved: {npy_path} (raw) and {png_path} (visual)")
+    finally:
+        if shard_writer is not None:
+            shard_writer.close()
+    if shard_writer is not None:
+        print(f"✅ Saved: {saved} generated images to the shards in {output_dir}")
+    return saved
 
-        npy_path = os.path.join(output_dir, filename.replace('.npy', '_generated.npy'))
-        np.save(npy_path, raw_generated_np)
+def run_generator_stream(named_masks: Iterable[Tuple[str, np.ndarray]], generator, output_dir,
+                         batch_size: int = 16, sharded=False) -> int:
+    """
+    Generate and save the images of masks as they are produced, without reading them from disk.
 
-        vis_img = (generated + 1.0) / 2.0
-        if vis_img.shape[-1] == 1:
-            vis_img = tf.squeeze(vis_img, axis=-1)
-        vis_np = vis_img.numpy()
+    Args:
+        named_masks (Iterable[Tuple[str, np.ndarray]]): (name, mask) pairs
+        generator: Loaded generator model (see `load_generator`)
+        output_dir: Directory of the generated images
+        batch_size (int): Number of masks per generator call
+        sharded (bool): Write the generated images as a `ShardedMaskDataset`
 
-        png_path = os.path.join(output_dir, filename.replace('.npy', '_generated.png'))
-        plt.imsave(png_path, vis_np, cmap='gray')
+    Returns:
+        int: Number of generated images
+    """
+    return save_generated_images(generate_images(generator, named_masks, batch_size), output_dir, sharded)
 
-        print(f"✅ Saved: {npy_path} (raw) and {png_path} (visual)")
+def run_generator(masks_dir, model_path, output_dir, batch_size: int = 1):
+    # Loose .npy/.mask files or the shards of output_format "shards", read one at a time
+    dataset = open_mask_dataset(masks_dir)
+    generator = load_generator(model_path)
+    run_generator_stream(zip(dataset.names, dataset), generator, output_dir, batch_size,
+                         sharded=ShardedMaskDataset.is_sharded(masks_dir))
 
 if __name__ == "__main__":
     import sys
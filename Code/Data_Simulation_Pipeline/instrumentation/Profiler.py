@@ -0,0 +1,200 @@
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+from typing import Dict, List, Any, Optional
+
+
+class _Stage:
+    """
+    Times one `with profiler.stage(name)` block.
+    """
+
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler: "Profiler", name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self) -> "_Stage":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.profiler._record(self.name, self.start, time.perf_counter())
+
+
+# Returned by `stage` while profiling is off, so disabled stages cost one call and one check
+_DISABLED_STAGE = contextlib.nullcontext()
+
+
+class Profiler:
+    """
+    Wall time per pipeline stage, counters and peak memory of a run; off by default.
+
+    Code marks stages with `with profiler.stage('align'):` and counts events with
+    `profiler.count('rejections.final')`. While disabled both return immediately. Stages
+    may nest, each reports its inclusive time; they are thread-safe, so the mask writer
+    threads record into the same profiler.
+
+    Worker processes have their own profiler: their initializer calls `configure` with
+    the `settings()` of the main profiler, every task returns `drain()` and the main
+    process adds it with `merge`. `report` summarizes everything; with tracing on, every
+    stage is also kept as an event for a Chrome trace (chrome://tracing or Perfetto).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.trace = False
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self) -> None:
+        self._stages: Dict[str, List[float]] = {}
+        self._counters: Dict[str, float] = {}
+        self._events: List[Dict[str, Any]] = []
+        self._started = time.perf_counter()
+        # perf_counter values are converted to trace timestamps shared by all processes
+        self._epoch_offset = time.time() - self._started
+
+    def configure(self, enabled: bool = False, trace: bool = False) -> None:
+        """
+        Switch profiling on or off and clear everything recorded so far.
+
+        Args:
+            enabled (bool): Record stages and counters
+            trace (bool): Also keep every stage as a trace event
+        """
+        with self._lock:
+            self.enabled = bool(enabled)
+            self.trace = self.enabled and bool(trace)
+            self._reset()
+
+    def settings(self) -> Dict[str, bool]:
+        """
+        Get the arguments of `configure` that reproduce this profiler's settings.
+        """
+        return {'enabled': self.enabled, 'trace': self.trace}
+
+    def stage(self, name: str):
+        """
+        Get a context manager timing a block as stage `name`.
+        """
+        if not self.enabled:
+            return _DISABLED_STAGE
+        return _Stage(self, name)
+
+    def count(self, name: str, value: float = 1) -> None:
+        """
+        Add `value` to counter `name`.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def _record(self, name: str, start: float, end: float) -> None:
+        duration = end - start
+        with self._lock:
+            totals = self._stages.get(name)
+            if totals is None:
+                self._stages[name] = [1, duration, duration]
+            else:
+                totals[0] += 1
+                totals[1] += duration
+                totals[2] = max(totals[2], duration)
+            if self.trace:
+                self._events.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                                     'ts': (start + self._epoch_offset) * 1e6, 'dur': duration * 1e6})
+
+    def drain(self) -> Optional[Dict[str, Any]]:
+        """
+        Take the stages, counters and events recorded since the last call, in a worker.
+
+        Returns:
+            Optional[Dict[str, Any]]: Picklable snapshot for `merge`, None while disabled
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            snapshot = {'stages': self._stages, 'counters': self._counters, 'events': self._events,
+                        'peak_rss_mb': _peak_rss_mb(resource.RUSAGE_SELF)}
+            self._stages, self._counters, self._events = {}, {}, []
+        return snapshot
+
+    def merge(self, snapshot: Optional[Dict[str, Any]]) -> None:
+        """
+        Add a snapshot from `drain` of a worker process.
+        """
+        if not self.enabled or snapshot is None:
+            return
+        with self._lock:
+            for name, (count, total, longest) in snapshot['stages'].items():
+                totals = self._stages.setdefault(name, [0, 0.0, 0.0])
+                totals[0] += count
+                totals[1] += total
+                totals[2] = max(totals[2], longest)
+            for name, value in snapshot['counters'].items():
+                self._counters[name] = self._counters.get(name, 0) + value
+            if self.trace:
+                self._events.extend(snapshot['events'])
+            self._counters['worker_peak_rss_mb'] = max(self._counters.get('worker_peak_rss_mb', 0),
+                                                       snapshot['peak_rss_mb'])
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Summarize the run.
+
+        Returns:
+            Dict[str, Any]: Wall time; count, total, mean and max seconds per stage (summed over
+                processes and threads); counters; peak RSS of this process and of its
+                largest finished child process in MB
+        """
+        with self._lock:
+            stages = {name: {'count': count, 'total_s': total, 'mean_ms': 1000 * total / count,
+                             'max_ms': 1000 * longest}
+                      for name, (count, total, longest) in sorted(self._stages.items())}
+            counters = dict(sorted(self._counters.items()))
+        return {
+            'wall_s': time.perf_counter() - self._started,
+            'stages': stages,
+            'counters': counters,
+            'peak_rss_mb': _peak_rss_mb(resource.RUSAGE_SELF),
+            'children_peak_rss_mb': _peak_rss_mb(resource.RUSAGE_CHILDREN)
+        }
+
+    def write_report(self, report_path: str) -> Dict[str, Any]:
+        """
+        Write `report` as JSON and print the stage times.
+        """
+        report = self.report()
+        os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+        with open(report_path, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Run report ({report['wall_s']:.1f}s wall, peak RSS {report['peak_rss_mb']:.0f} MB) "
+              f"saved to {report_path}")
+        for name, stage in report['stages'].items():
+            print(f"- {name}: {stage['count']} x {stage['mean_ms']:.2f} ms = {stage['total_s']:.2f}s")
+        return report
+
+    def write_trace(self, trace_path: str) -> None:
+        """
+        Write the stage events in the Chrome trace event format.
+        """
+        with self._lock:
+            events = list(self._events)
+        os.makedirs(os.path.dirname(os.path.abspath(trace_path)), exist_ok=True)
+        with open(trace_path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+        print(f"Trace of {len(events)} stages saved to {trace_path}")
+
+
+def _peak_rss_mb(who: int) -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+# Profiler of this process
+profiler = Profiler()
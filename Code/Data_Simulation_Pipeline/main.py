@@ -1,23 +1,34 @@
+import os
 import json
 import argparse
+import logging
 from pathlib import Path
 import numpy as np
 import cv2
 import matplotlib.pyplot as plt
 from typing import Dict, Any
 from mask_extractor.MaskExtractor import MaskExtractor
-from mask_extractor.extract_masks import extract_all_masks, save_masks_to_npy
+from mask_extractor.extract_masks import (extract_all_masks, update_all_masks, save_masks_to_npy, derive_seed,
+                                          shard_indices)
+from mask_extractor.MaskCorpus import MaskCorpus
+from mask_extractor.SliceIndex import SliceIndex
+from mask_extractor.SharedMaskCorpus import SharedMaskCorpus
+from mask_writer.MaskCodec import load_masks_npy
 from mask_merger.MaskAlignment import MaskAlignment
 from mask_simulator.ImageProcessor import ImageProcessor
-from mask_merger.merge_masks import generate_multible_merged_masks
-from mask_simulator.generate_simulated_mask import generate_multible_cardiac_images
+from mask_merger.merge_masks import generate_multible_merged_masks, iter_merged_masks
+from mask_merger.DonorIndex import DonorIndex
+from mask_simulator.generate_simulated_mask import generate_multible_cardiac_images, iter_cardiac_images
+from instrumentation.Profiler import profiler
+from distributed.WorkQueue import WorkQueue, QUEUE_DIR, NODES_DIR, default_node_id
 
 def load_config(json_path: str) -> Dict[str, Any]:
     with open(json_path, 'r') as file:
         config = json.load(file)
     return config
 
-def main(config_path: str):
+def main(config_path: str, generator_model_path: str = None, shard_index: int = None, shard_count: int = None,
+         distributed: bool = None, node_id: str = None):
     # Load configuration from JSON file
     config = load_config(config_path)
 
@@ -25,67 +36,255 @@ def main(config_path: str):
     base_path = Path(config['paths']['base_path'])
     np_data_path = Path(config['paths']['np_data_path'])
     output_dir = config['paths']['output_dir']
+
+    # Debug logging runs np.unique on every mask, so it is only on when asked for
+    logging.basicConfig(level=getattr(logging, config['paths'].get('log_level', 'INFO').upper()),
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        filename='app.log',  # Save logs to a file
+                        filemode='w')  # Overwrite file on each run (use 'a' to append)
+    # Per-stage timings, counters and peak memory of the run, off by default
+    profiler.configure(config['paths'].get('instrumentation', False),
+                       trace=bool(config['paths'].get('instrumentation_trace')))
+    
+    corpus_format = config['paths'].get('corpus_format', 'npy')
+    compact_corpus = corpus_format == 'compact'
+    corpus_path = MaskCorpus.corpus_path_for(np_data_path, compact_corpus)
+    extraction_workers = config['paths'].get('extraction_workers', 1)
+    incremental_extraction = config['paths'].get('incremental_extraction', False)
+    # Encoding of masks.npy and of the generated .npy masks, "none" keeps plain arrays
+    mask_codec = config['paths'].get('mask_codec', 'none')
+    mask_codec = None if mask_codec == 'none' else mask_codec
+    masks_changed = False
     
-    # Check if npy file exists
-    if np_data_path.exists():
-        # read the data from the npy file
-        all_masks = np.load(np_data_path, allow_pickle=True).item()
-        print("Loaded existing masks from file!")
-    else:
-        # Extract masks and save them
-        all_masks = extract_all_masks(base_path)
-        print("All masks extracted successfully!")
-        # Create parent directory if it doesn't exist
-        np_data_path.parent.mkdir(parents=True, exist_ok=True)
-        save_masks_to_npy(all_masks, np_data_path)
-        print("All masks saved successfully!")
-
-    # Generate merged masks
-    merge_params = config['merge_masks_params']
-    merged_masks = generate_multible_merged_masks(
-        all_masks=all_masks,
-        number_of_masks=merge_params['number_of_masks'],
-        search_range=merge_params['search_range'],
-        rotation_angles=np.arange(0, 360, merge_params['rotation_step']),
-        visualize_flag=merge_params['visualize_flag'] ,
-        mayocardium_vlue = merge_params['mayocardium_vlue'],
-        infarction_value = merge_params['infarction_value'], 
-        blood_pool_value = merge_params['blood_pool_value'], 
-        no_flow_value = merge_params['no_flow_value'],
-        output_dir=output_dir
-
-    )
-
-    # Generate multiple cardiac images
-    image_params = config['generate_images_params']
-    generate_multible_cardiac_images(
-        number_of_images=image_params['number_of_images'],
-        output_dir=output_dir,
-        all_masks=all_masks,
-        mayocardium_type=image_params['mayocardium_type'],
-        image_size=tuple(image_params['image_size']),
-        number_of_seeds=image_params['number_of_seeds'],
-        energy=image_params['energy'],
-        max_radius_step=image_params['max_radius_step'],
-        max_theta_step=image_params['max_theta_step'],
-        min_cluster_size=image_params['min_cluster_size'],
-        min_no_flow_size=image_params['min_no_flow_size'],
-        ring_thick_max=image_params['ring_thick_max'],
-        ring_thick_min=image_params['ring_thick_min'],
-        show_plots=image_params['show_plots'],
-        background_color=image_params['background_color'],
-        blood_pool_color=image_params['blood_pool_color'],
-        mayocardium_color=image_params['mayocardium_color'],
-        infarction_color=image_params['infarction_color'],
-        no_flow_color=image_params['no_flow_color'],
-        infarct_to_myo_upper_limit = image_params['infarct_to_myo_upper_limit'],
-        infarct_to_myo_lower_limit = image_params['infarct_to_myo_lower_limit'],
-        noflow_to_infarct_upper_limit = image_params['noflow_to_infarct_upper_limit'],
-        noflow_to_infarct_lower_limit = image_params['noflow_to_infarct_lower_limit']
-    )
+    with profiler.stage('load_corpus'):
+        if corpus_format in ('memmap', 'compact'):
+            # Memory-mapped corpus, converted from masks.npy or extracted on first use
+            if incremental_extraction:
+                all_masks, masks_changed = update_all_masks(
+                    base_path, MaskExtractor.manifest_path_for(corpus_path), corpus_path=corpus_path,
+                    compact=compact_corpus, workers=extraction_workers)
+            elif MaskCorpus.exists(corpus_path):
+                all_masks = MaskCorpus(corpus_path)
+                print("Opened memory-mapped mask corpus!")
+            elif np_data_path.exists():
+                all_masks = MaskCorpus.convert_npy(np_data_path, corpus_path, compact_corpus)
+            else:
+                all_masks = extract_all_masks(base_path, corpus_path, compact_corpus, extraction_workers)
+                print("All masks extracted successfully!")
+        elif incremental_extraction:
+            # Re-extract only the cases that changed since masks.npy was written
+            existing_masks = load_masks_npy(np_data_path) if np_data_path.exists() else None
+            all_masks, masks_changed = update_all_masks(
+                base_path, MaskExtractor.manifest_path_for(np_data_path), existing_masks, workers=extraction_workers)
+            if masks_changed:
+                np_data_path.parent.mkdir(parents=True, exist_ok=True)
+                save_masks_to_npy(all_masks, np_data_path, mask_codec)
+        # Check if npy file exists
+        elif np_data_path.exists():
+            # read the data from the npy file
+            all_masks = load_masks_npy(np_data_path)
+            print("Loaded existing masks from file!")
+        else:
+            # Extract masks and save them
+            all_masks = extract_all_masks(base_path, workers=extraction_workers)
+            print("All masks extracted successfully!")
+            # Create parent directory if it doesn't exist
+            np_data_path.parent.mkdir(parents=True, exist_ok=True)
+            save_masks_to_npy(all_masks, np_data_path, mask_codec)
+            print("All masks saved successfully!")
+
+    # Per-slice metadata to only sample slices with myocardium
+    slice_index = None
+    if config['paths'].get('slice_index', False):
+        slice_index_path = SliceIndex.index_path_for(np_data_path)
+        if masks_changed:
+            slice_index_path.unlink(missing_ok=True)
+        slice_index = SliceIndex.load_or_build(slice_index_path, all_masks,
+                                               config['paths'].get('min_myocardium_pixels', 1))
+
+    # Publish the masks once for all worker processes instead of pickling them to each
+    shared_corpus = None
+    if config['paths'].get('shared_memory_corpus', False):
+        shared_corpus = SharedMaskCorpus.publish(all_masks, compact_corpus)
+        all_masks = shared_corpus
+
+    try:
+        # Seed of the whole run, each step derives its own from it unless it sets a seed itself
+        run_seed = config['paths'].get('seed')
+        # This machine generates shard `shard_index` of `shard_count`, every shard_count-th mask index
+        shard_index = config['paths'].get('shard_index', 0) if shard_index is None else shard_index
+        shard_count = config['paths'].get('shard_count', 1) if shard_count is None else shard_count
+        # Nodes sharing output_dir claim batches of mask indices from a work queue instead
+        distributed = config['paths'].get('distributed', False) if distributed is None else distributed
+        if distributed and shard_count > 1:
+            raise ValueError("Distributed runs split the work themselves, leave shard_count at 1")
+        image_params = config['generate_images_params']
+        if (image_params.get('adaptive_sampling', False) and image_params.get('engine', 'single') != 'batched'
+                and (image_params.get('workers', 1) > 1 or shard_count > 1 or distributed)):
+            # The tuned settings depend on which images this process finished before
+            logging.warning("adaptive_sampling with several workers, shards or nodes is not reproducible, "
+                            "image i will differ from a serial run")
+
+        def step_seed(params: Dict[str, Any], stream: int):
+            if params.get('seed') is not None:
+                return params['seed']
+            if run_seed is not None:
+                return derive_seed(run_seed, stream)
+            if shard_count > 1 or distributed:
+                # Every shard or node would draw its own random seed
+                raise ValueError("Sharded and distributed runs need a fixed seed, set paths.seed")
+            return None
+
+        # Merged masks step
+        merge_params = config['merge_masks_params']
+        donor_index = None
+        if merge_params.get('donor_selection', 'random') == 'knn':
+            donor_index_path = DonorIndex.index_path_for(np_data_path)
+            if masks_changed:
+                # The donor index describes the cases before the incremental extraction
+                donor_index_path.unlink(missing_ok=True)
+            donor_index = DonorIndex.load_or_build(donor_index_path, all_masks)
+        alignment_cache_path = config['paths'].get('alignment_cache_path')
+        if alignment_cache_path and masks_changed:
+            # Cached alignments of the old slices would only miss, drop them instead of letting them fill the cache
+            Path(alignment_cache_path).unlink(missing_ok=True)
+        merge_arguments = dict(
+            all_masks=all_masks,
+            number_of_masks=merge_params['number_of_masks'],
+            search_range=merge_params['search_range'],
+            rotation_angles=np.arange(0, 360, merge_params['rotation_step']),
+            visualize_flag=merge_params['visualize_flag'] ,
+            mayocardium_vlue = merge_params['mayocardium_vlue'],
+            infarction_value = merge_params['infarction_value'], 
+            blood_pool_value = merge_params['blood_pool_value'], 
+            no_flow_value = merge_params['no_flow_value'],
+            output_dir=output_dir,
+            alignment_method=merge_params.get('alignment_method', 'exhaustive'),
+            alignment_cache_path=alignment_cache_path,
+            alignment_cache_size=merge_params.get('alignment_cache_size', 10000),
+            donor_index=donor_index,
+            donor_neighbours=merge_params.get('donor_neighbours', 5),
+            workers=merge_params.get('workers', 1),
+            seed=step_seed(merge_params, 0),
+            indices=shard_indices(merge_params['number_of_masks'], shard_index, shard_count),
+            slice_index=slice_index,
+            output_format=config['paths'].get('output_format', 'both'),
+            output_writers=config['paths'].get('output_writers', 1),
+            output_queue_size=config['paths'].get('output_queue_size', 64),
+            output_shard_size=config['paths'].get('output_shard_size', 1024),
+            mask_codec=mask_codec,
+            resume=config['paths'].get('resume', False),
+            checkpoint_every=config['paths'].get('checkpoint_every', 100)
+        )
+
+        # Simulated images step
+        image_arguments = dict(
+            number_of_images=image_params['number_of_images'],
+            output_dir=output_dir,
+            all_masks=all_masks,
+            mayocardium_type=image_params['mayocardium_type'],
+            image_size=tuple(image_params['image_size']),
+            number_of_seeds=image_params['number_of_seeds'],
+            energy=image_params['energy'],
+            max_radius_step=image_params['max_radius_step'],
+            max_theta_step=image_params['max_theta_step'],
+            min_cluster_size=image_params['min_cluster_size'],
+            min_no_flow_size=image_params['min_no_flow_size'],
+            ring_thick_max=image_params['ring_thick_max'],
+            ring_thick_min=image_params['ring_thick_min'],
+            show_plots=image_params['show_plots'],
+            background_color=image_params['background_color'],
+            blood_pool_color=image_params['blood_pool_color'],
+            mayocardium_color=image_params['mayocardium_color'],
+            infarction_color=image_params['infarction_color'],
+            no_flow_color=image_params['no_flow_color'],
+            infarct_to_myo_upper_limit = image_params['infarct_to_myo_upper_limit'],
+            infarct_to_myo_lower_limit = image_params['infarct_to_myo_lower_limit'],
+            noflow_to_infarct_upper_limit = image_params['noflow_to_infarct_upper_limit'],
+            noflow_to_infarct_lower_limit = image_params['noflow_to_infarct_lower_limit'],
+            workers=image_params.get('workers', 1),
+            seed=step_seed(image_params, 1),
+            indices=shard_indices(image_params['number_of_images'], shard_index, shard_count),
+            no_flow_energy_ratio=tuple(image_params.get('no_flow_energy_ratio', (0.05, 0.2))),
+            adaptive_sampling=image_params.get('adaptive_sampling', False),
+            ratio_bins=image_params.get('ratio_bins', 1),
+            early_rejection_margin=image_params.get('early_rejection_margin'),
+            engine=image_params.get('engine', 'single'),
+            engine_batch_size=image_params.get('engine_batch_size', 32),
+            slice_index=slice_index,
+            output_format=config['paths'].get('output_format', 'both'),
+            output_writers=config['paths'].get('output_writers', 1),
+            output_queue_size=config['paths'].get('output_queue_size', 64),
+            output_shard_size=config['paths'].get('output_shard_size', 1024),
+            mask_codec=mask_codec,
+            resume=config['paths'].get('resume', False),
+            checkpoint_every=config['paths'].get('checkpoint_every', 100)
+        )
+
+        streaming = config['paths'].get('streaming', False)
+        if streaming:
+            # Imported here so TensorFlow is only needed in the streaming mode
+            from generator_runner import load_generator, run_generator_stream
+            generator = load_generator(generator_model_path or config['paths']['generator_model_path'])
+            batch_size = config['paths'].get('generator_batch_size', 16)
+            sharded = config['paths'].get('output_format', 'both') == 'shards'
+
+        def run_merge(arguments: Dict[str, Any]):
+            if streaming:
+                # The masks go straight from the simulation stages into batched generator inference
+                run_generator_stream(iter_merged_masks(**arguments), generator,
+                                     os.path.join(arguments['output_dir'], 'final_generated_merged'), batch_size, sharded)
+            else:
+                generate_multible_merged_masks(**arguments, return_masks=False)
+
+        def run_images(arguments: Dict[str, Any]):
+            if streaming:
+                run_generator_stream(iter_cardiac_images(**arguments), generator,
+                                     os.path.join(arguments['output_dir'], 'final_generated_simulated'), batch_size, sharded)
+            else:
+                generate_multible_cardiac_images(**arguments)
+
+        if distributed:
+            # Every node writes to its own folder, `python -m distributed.coordinator` merges them
+            node_id = node_id or config['paths'].get('node_id') or default_node_id()
+            node_dir = os.path.join(output_dir, NODES_DIR, node_id)
+            steps = (('merged_masks', run_merge, merge_arguments, merge_params['number_of_masks']),
+                     ('simulated_masks', run_images, image_arguments, image_params['number_of_images']))
+            for step, run_step, arguments, number in steps:
+                queue = WorkQueue(os.path.join(output_dir, QUEUE_DIR, step), number,
+                                  config['paths'].get('work_queue_batch_size', 64),
+                                  config['paths'].get('lease_seconds', 600), node_id)
+                for batch, indices in queue.batches():
+                    print(f"Node {node_id}: {step} batch {batch + 1}/{queue.batch_count} "
+                          f"(masks {indices.start} to {indices.stop - 1})")
+                    # Resuming skips the masks this node already wrote before it was restarted
+                    run_step(dict(arguments, output_dir=node_dir, indices=indices, resume=True))
+        else:
+            run_merge(merge_arguments)
+            run_images(image_arguments)
+    finally:
+        # Also when a step fails, so the segments do not stay in /dev/shm
+        if shared_corpus is not None:
+            shared_corpus.unlink()
+
+    if profiler.enabled:
+        profiler.write_report(config['paths'].get('instrumentation_report')
+                              or os.path.join(output_dir, 'run_report.json'))
+        if config['paths'].get('instrumentation_trace'):
+            profiler.write_trace(config['paths']['instrumentation_trace'])
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process configuration for mask generation and simulation.")
     parser.add_argument('config_path', type=str, help='Path to the JSON configuration file.')
+    parser.add_argument('--generator-model', type=str, default=None,
+                        help='Generator model for the streaming mode, overrides paths.generator_model_path.')
+    parser.add_argument('--shard-index', type=int, default=None,
+                        help='Shard of the run generated here, overrides paths.shard_index.')
+    parser.add_argument('--shard-count', type=int, default=None,
+                        help='Number of shards the run is split into, overrides paths.shard_count.')
+    parser.add_argument('--distributed', action='store_true', default=None,
+                        help='Claim work from the queue in output_dir, overrides paths.distributed.')
+    parser.add_argument('--node-id', type=str, default=None,
+                        help='Name of this node in a distributed run, overrides paths.node_id.')
     args = parser.parse_args()
-    main(args.config_path)
\ No newline at end of file
+    main(args.config_path, args.generator_model, args.shard_index, args.shard_count, args.distributed, args.node_id)
\ No newline at end of file
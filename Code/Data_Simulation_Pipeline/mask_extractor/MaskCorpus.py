@@ -0,0 +1,394 @@
+import argparse
+from collections.abc import Mapping, Sequence
+from functools import lru_cache
+from pathlib import Path
+import numpy as np
+from typing import Dict, List, Any, Iterator, Tuple
+from mask_writer.MaskCodec import load_masks_npy
+from mask_writer.ShardedMaskDataset import write_atomic
+
+# Mask types stored for every slice, in the order of their planes in the data file
+MASK_TYPES = ('standard_mask', 'blood_pool_masks', 'mayocardium_masks', 'infarction_masks')
+# Compact corpora only store the label map and derive the other mask types from it
+COMPACT_MASK_TYPES = ('standard_mask',)
+
+
+@lru_cache(maxsize=None)
+def derived_mask_lookup_tables() -> Dict[str, np.ndarray]:
+    """
+    Build the 256-entry tables mapping label values to the values of each derived mask type.
+
+    The tables are the `MaskExtractor` mask functions applied to every uint8 value,
+    so a lookup gives exactly the mask the extractor would have stored.
+
+    Returns:
+        Dict[str, np.ndarray]: Lookup table per derived mask type
+    """
+    # Imported here since MaskExtractor itself writes corpora
+    from mask_extractor.MaskExtractor import MaskExtractor
+    values = np.arange(256, dtype=np.uint8)
+    return {
+        'blood_pool_masks': MaskExtractor._create_blood_pool_mask(values.copy()),
+        'mayocardium_masks': MaskExtractor._create_mayocardium_mask(values.copy()),
+        'infarction_masks': MaskExtractor._create_infarction_mask(values.copy())
+    }
+
+
+def index_arrays(rows: List[Tuple[str, int, int, Tuple[int, int]]], mask_types: Tuple[str, ...]) -> Dict[str, np.ndarray]:
+    """
+    Build the index arrays of a corpus.
+
+    Args:
+        rows (List[Tuple[str, int, int, Tuple[int, int]]]): (case id, slice index, byte offset, shape)
+            of every slice, in corpus order
+        mask_types (Tuple[str, ...]): Mask types stored for every slice
+
+    Returns:
+        Dict[str, np.ndarray]: Index arrays as read by `MaskCorpus`
+    """
+    return {
+        'case_ids': np.array([row[0] for row in rows], dtype=str),
+        'slice_indices': np.array([row[1] for row in rows], dtype=np.int64),
+        'is_pathological': np.array(['P' in row[0] for row in rows], dtype=bool),
+        'offsets': np.array([row[2] for row in rows], dtype=np.int64),
+        'shapes': np.array([row[3] for row in rows], dtype=np.int64).reshape(-1, 2),
+        'mask_types': np.array(mask_types, dtype=str)
+    }
+
+
+class MaskCorpus(Mapping):
+    """
+    Memory-mapped mask corpus with the same case -> mask type -> slice layout as the masks.npy dict.
+
+    All slices live in one contiguous uint8 file, every slice as one block holding a
+    plane per mask type. A small .npz index stores the case id, slice index,
+    pathology flag, byte offset and shape of every slice. Opening the corpus only
+    reads the index; the data file is mapped with `np.memmap`, so a slice is paged in
+    when it is first read. Stored slices are returned as read-only views.
+
+    A compact corpus only stores `standard_mask`; the other mask types are derived
+    from it with a lookup table when a slice is read, which makes the corpus four
+    times smaller.
+    """
+
+    def __init__(self, corpus_path: str):
+        """
+        Open a corpus written by `MaskCorpusWriter`.
+
+        Args:
+            corpus_path (str): Path of the corpus data file
+        """
+        self.corpus_path = Path(corpus_path)
+        with np.load(self.index_path_for(self.corpus_path)) as index:
+            index = {key: index[key] for key in index.files}
+        # np.memmap cannot map an empty file
+        if self.corpus_path.stat().st_size > 0:
+            data = np.memmap(self.corpus_path, dtype=np.uint8, mode='r')
+        else:
+            data = np.zeros(0, dtype=np.uint8)
+        self._set_index(index, data)
+
+    def _set_index(self, index: Dict[str, np.ndarray], data: np.ndarray) -> None:
+        """
+        Set the index arrays and the flat uint8 buffer the slices are read from.
+
+        Args:
+            index (Dict[str, np.ndarray]): Index arrays as written by `MaskCorpusWriter.close`
+            data (np.ndarray): Flat uint8 buffer holding the slices
+        """
+        self.index = index
+        self.case_ids = index['case_ids']
+        self.slice_indices = index['slice_indices']
+        self.is_pathological = index['is_pathological']
+        self.offsets = index['offsets']
+        self.shapes = index['shapes']
+        self.stored_mask_types = tuple(str(mask_type) for mask_type in index['mask_types'])
+        self.compact = 'standard_mask' in self.stored_mask_types and len(self.stored_mask_types) < len(MASK_TYPES)
+        self.mask_types = MASK_TYPES if self.compact else self.stored_mask_types
+        self._data = data
+
+        # Rows of every case in slice order, keeping the order the cases were written in
+        self._case_rows: Dict[str, List[int]] = {}
+        for row, case_id in enumerate(self.case_ids):
+            self._case_rows.setdefault(str(case_id), []).append(row)
+
+    @staticmethod
+    def corpus_path_for(np_data_path: str, compact: bool = False) -> Path:
+        """
+        Get the path the corpus is stored at, next to the masks.npy file.
+
+        Args:
+            np_data_path (str): Path of the masks.npy corpus
+            compact (bool): Path of the compact corpus instead of the full one
+
+        Returns:
+            Path: Path of the corpus data file
+        """
+        np_data_path = Path(np_data_path)
+        suffix = "_compact_corpus" if compact else "_corpus"
+        return np_data_path.with_name(f"{np_data_path.stem}{suffix}.u8")
+
+    @staticmethod
+    def index_path_for(corpus_path: str) -> Path:
+        """
+        Get the path of the index that belongs to a corpus data file.
+        """
+        corpus_path = Path(corpus_path)
+        return corpus_path.with_name(f"{corpus_path.stem}_index.npz")
+
+    @classmethod
+    def exists(cls, corpus_path: str) -> bool:
+        """
+        Check whether both the data file and the index of a corpus exist.
+        """
+        return Path(corpus_path).exists() and cls.index_path_for(corpus_path).exists()
+
+    @classmethod
+    def write(cls, all_masks: Dict[str, Any], corpus_path: str, compact: bool = False) -> "MaskCorpus":
+        """
+        Write a corpus from a dictionary of masks organized by case.
+
+        Args:
+            all_masks (Dict[str, Any]): Dictionary containing all masks organized by case
+            corpus_path (str): Path of the corpus data file
+            compact (bool): Only store `standard_mask`
+
+        Returns:
+            MaskCorpus: The written corpus, opened
+        """
+        with MaskCorpusWriter(corpus_path, COMPACT_MASK_TYPES if compact else MASK_TYPES) as writer:
+            for case_id, case_masks in all_masks.items():
+                writer.add_case(case_id, case_masks)
+        return cls(corpus_path)
+
+    @classmethod
+    def convert_npy(cls, np_data_path: str, corpus_path: str = None, compact: bool = False) -> "MaskCorpus":
+        """
+        Convert a pickled masks.npy dict into a memory-mapped corpus.
+
+        Args:
+            np_data_path (str): Path of the masks.npy corpus
+            corpus_path (str): Path of the corpus data file, next to masks.npy by default
+            compact (bool): Only store `standard_mask`
+
+        Returns:
+            MaskCorpus: The converted corpus, opened
+        """
+        if corpus_path is None:
+            corpus_path = cls.corpus_path_for(np_data_path, compact)
+        all_masks = load_masks_npy(np_data_path)
+        corpus = cls.write(all_masks, corpus_path, compact)
+        print(f"Converted {np_data_path} to {corpus_path} ({len(corpus.case_ids)} slices)")
+        return corpus
+
+    def get_slice(self, row: int, mask_type: str) -> np.ndarray:
+        """
+        Get one mask of a slice.
+
+        Stored mask types are returned as read-only views into the data file, derived
+        ones as new arrays looked up from the slice's `standard_mask`.
+
+        Args:
+            row (int): Row of the slice in the index
+            mask_type (str): One of `mask_types`
+
+        Returns:
+            np.ndarray: (height, width) uint8 mask
+        """
+        if mask_type not in self.stored_mask_types:
+            return derived_mask_lookup_tables()[mask_type][self.get_slice(row, 'standard_mask')]
+        height, width = (int(size) for size in self.shapes[row])
+        plane = self.stored_mask_types.index(mask_type)
+        start = int(self.offsets[row]) + plane * height * width
+        return self._data[start:start + height * width].reshape(height, width)
+
+    def location(self, row: int) -> Tuple[str, int]:
+        """
+        Get the (case id, slice index) of a row of the index.
+        """
+        return str(self.case_ids[row]), int(self.slice_indices[row])
+
+    def __getitem__(self, case_id: str) -> "CaseMasks":
+        return CaseMasks(self, self._case_rows[str(case_id)])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._case_rows)
+
+    def __len__(self) -> int:
+        return len(self._case_rows)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Worker processes reopen the mapping instead of receiving the data
+        return {'corpus_path': self.corpus_path}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(state['corpus_path'])
+
+
+class CaseMasks(Mapping):
+    """
+    Masks of one case of a `MaskCorpus`, keyed by mask type like a case of the masks.npy dict.
+    """
+
+    def __init__(self, corpus: MaskCorpus, rows: List[int]):
+        self.corpus = corpus
+        self.rows = rows
+
+    def __getitem__(self, mask_type: str) -> "CaseSlices":
+        if mask_type not in self.corpus.mask_types:
+            raise KeyError(mask_type)
+        return CaseSlices(self.corpus, self.rows, mask_type)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.corpus.mask_types)
+
+    def __len__(self) -> int:
+        return len(self.corpus.mask_types)
+
+
+class CaseSlices(Sequence):
+    """
+    Slices of one mask type of one case, indexable like the lists of the masks.npy dict.
+    """
+
+    def __init__(self, corpus: MaskCorpus, rows: List[int], mask_type: str):
+        self.corpus = corpus
+        self.rows = rows
+        self.mask_type = mask_type
+
+    def __getitem__(self, slice_idx: int) -> np.ndarray:
+        return self.corpus.get_slice(self.rows[slice_idx], self.mask_type)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+
+class MaskCorpusWriter:
+    """
+    Streams cases into a memory-mapped corpus, writing the index when closed.
+
+    The index is only written when the writer is closed without an exception, and
+    atomically, so an interrupted extraction never leaves a corpus that `MaskCorpus.exists`
+    accepts with cases missing. In append mode the slices of an existing corpus are kept and new slices are
+    appended to its data file. Replacing or dropping a case only removes its rows
+    from the index; the bytes it used stay in the data file until the corpus is
+    rewritten.
+    """
+
+    def __init__(self, corpus_path: str, mask_types: Tuple[str, ...] = MASK_TYPES, append: bool = False):
+        """
+        Create (or overwrite) a corpus, or open an existing one for appending.
+
+        Args:
+            corpus_path (str): Path of the corpus data file
+            mask_types (Tuple[str, ...]): Mask types stored for every slice
+            append (bool): Keep the cases of an existing corpus at `corpus_path`
+        """
+        self.corpus_path = Path(corpus_path)
+        self.corpus_path.parent.mkdir(parents=True, exist_ok=True)
+        self.mask_types = tuple(mask_types)
+        # (slice index, byte offset, shape) of every slice by case, in case order
+        self._cases: Dict[str, List[Tuple[int, int, Tuple[int, int]]]] = {}
+        append = append and MaskCorpus.exists(self.corpus_path)
+        if append:
+            existing = MaskCorpus(self.corpus_path)
+            if existing.stored_mask_types != self.mask_types:
+                raise ValueError(f"Cannot append {self.mask_types} slices to a corpus storing "
+                                 f"{existing.stored_mask_types}")
+            for row in range(len(existing.case_ids)):
+                case_id, slice_idx = existing.location(row)
+                self._cases.setdefault(case_id, []).append(
+                    (slice_idx, int(existing.offsets[row]), tuple(int(size) for size in existing.shapes[row])))
+            del existing
+        else:
+            # The index of a corpus being overwritten would describe the old data file
+            MaskCorpus.index_path_for(self.corpus_path).unlink(missing_ok=True)
+        self._append = append
+        self._data = open(self.corpus_path, 'ab' if append else 'wb')
+        self._offset = self._data.tell()
+
+    def add_case(self, case_id: str, case_masks: Dict[str, List[np.ndarray]]) -> None:
+        """
+        Append all slices of a case, replacing the case if it is already stored.
+
+        Args:
+            case_id (str): Case id, pathological cases contain 'P'
+            case_masks (Dict[str, List[np.ndarray]]): Masks of the case by mask type
+        """
+        rows = []
+        for slice_idx in range(len(case_masks[self.mask_types[0]])):
+            planes = np.stack([np.asarray(case_masks[mask_type][slice_idx], dtype=np.uint8)
+                               for mask_type in self.mask_types])
+            self._data.write(np.ascontiguousarray(planes).tobytes())
+            rows.append((slice_idx, self._offset, planes.shape[1:]))
+            self._offset += planes.nbytes
+        self._cases.pop(str(case_id), None)
+        self._cases[str(case_id)] = rows
+
+    def drop_case(self, case_id: str) -> None:
+        """
+        Remove a case from the index.
+        """
+        self._cases.pop(str(case_id), None)
+
+    def order_cases(self, case_ids: List[str]) -> None:
+        """
+        Put the stored cases in the given order, cases that are not listed go last.
+        """
+        ordered = {str(case_id): self._cases[str(case_id)] for case_id in case_ids if str(case_id) in self._cases}
+        ordered.update(self._cases)
+        self._cases = ordered
+
+    @property
+    def stale_bytes(self) -> int:
+        """
+        Bytes of the data file no longer referenced by the index.
+        """
+        plane_bytes = len(self.mask_types)
+        live = sum(plane_bytes * shape[0] * shape[1] for rows in self._cases.values() for _, _, shape in rows)
+        return self._offset - live
+
+    def close(self) -> None:
+        """
+        Close the data file and write the index next to it.
+        """
+        self._data.close()
+        rows = [(case_id, slice_idx, offset, shape)
+                for case_id, case_rows in self._cases.items() for slice_idx, offset, shape in case_rows]
+        arrays = index_arrays(rows, self.mask_types)
+        write_atomic(MaskCorpus.index_path_for(self.corpus_path), lambda file: np.savez(file, **arrays))
+
+    def abort(self) -> None:
+        """
+        Close the data file without writing the index.
+
+        A new corpus is removed. An appended corpus keeps its previous index, which
+        does not reference the bytes appended since.
+        """
+        self._data.close()
+        if not self._append:
+            self.corpus_path.unlink(missing_ok=True)
+
+    def __enter__(self) -> "MaskCorpusWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if exc_info[0] is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a masks.npy dict into a memory-mapped corpus.")
+    parser.add_argument('np_data_path', type=str, help='Path of the masks.npy file.')
+    parser.add_argument('--corpus-path', type=str, default=None,
+                        help='Path of the corpus data file, next to masks.npy by default.')
+    parser.add_argument('--compact', action='store_true',
+                        help='Only store the label maps and derive the other mask types on read.')
+    args = parser.parse_args()
+    MaskCorpus.convert_npy(args.np_data_path, args.corpus_path, args.compact)
+
+
+if __name__ == "__main__":
+    main()
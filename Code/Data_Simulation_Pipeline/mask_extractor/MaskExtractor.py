@@ -1,35 +1,138 @@
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import json
 import os
 import numpy as np
 import cv2
 import matplotlib.pyplot as plt
-from typing import Dict, List, Tuple, Any
+from typing import Dict, List, Tuple, Any, Optional
+from mask_extractor.MaskCorpus import MaskCorpus, MaskCorpusWriter, MASK_TYPES, COMPACT_MASK_TYPES
 
 class MaskExtractor:
     """
     Class for extracting and processing different types of masks from medical image data.
     Handles mask extraction, processing, and visualization.
+
+    Cases can be extracted by a thread pool, and with a manifest path the size and
+    modification time of every slice file are recorded per case, so that `update`
+    only re-extracts the cases that were added or changed since the last run.
     """
 
-    def __init__(self, base_path: str):
+    def __init__(self, base_path: str, corpus_path: str = None, compact_corpus: bool = False,
+                 workers: int = 1, manifest_path: str = None):
         """
         Initialize the MaskExtractor with a base path.
         
         Args:
             base_path (str): Path to the directory containing the medical image data
+            corpus_path (str): Optional path of a memory-mapped `MaskCorpus` the cases are
+                streamed into instead of being kept in memory
+            compact_corpus (bool): Only store `standard_mask` in the corpus
+            workers (int): Number of threads reading and processing cases
+            manifest_path (str): Optional path of the JSON manifest of the extracted slice files
         """
         self.base_path = Path(base_path)
+        self.corpus_path = corpus_path
+        self.compact_corpus = compact_corpus
+        self.workers = max(1, int(workers))
+        self.manifest_path = manifest_path
         self.all_masks = {}
+        self.changed = False
+        self._corpus_writer = None
         # self.mask_alignment = MaskAlignment()
 
+    @staticmethod
+    def manifest_path_for(data_path: str) -> Path:
+        """
+        Get the path of the extraction manifest that belongs to a masks.npy or corpus file.
+        """
+        data_path = Path(data_path)
+        return data_path.with_name(f"{data_path.stem}_manifest.json")
+
     def process(self) -> Dict[str, Any]:
         """
         Main entry point for processing all masks in the dataset.
         
         Returns:
-            Dict[str, Any]: Dictionary containing all processed masks organized by case
+            Dict[str, Any]: Dictionary containing all processed masks organized by case,
+                or the opened `MaskCorpus` when a corpus path is set
+        """
+        case_dirs = self._get_case_directories()
+        signatures = {case_dir.name: self.case_signature(case_dir) for case_dir in case_dirs}
+        self.changed = True
+        if self.corpus_path is None:
+            self._process_case_directories(case_dirs)
+            result = self.all_masks
+        else:
+            with MaskCorpusWriter(self.corpus_path, self._corpus_mask_types()) as self._corpus_writer:
+                self._process_case_directories(case_dirs)
+            self._corpus_writer = None
+            result = MaskCorpus(self.corpus_path)
+        self._save_manifest(signatures)
+        return result
+
+    def update(self, all_masks: Dict[str, Any] = None) -> Dict[str, Any]:
         """
-        return self.extract_masks_all_folders()
+        Incrementally bring previously extracted masks up to date with the dataset.
+
+        Cases whose slice files differ from the manifest, or that are missing from the
+        extracted masks, are re-extracted; cases that no longer exist are removed.
+        In corpus mode the new slices are appended to the existing corpus. Without a
+        manifest or previously extracted masks everything is extracted. `changed` tells
+        whether anything was re-extracted or removed.
+
+        Args:
+            all_masks (Dict[str, Any]): Previously extracted masks organized by case,
+                only used without a corpus path
+
+        Returns:
+            Dict[str, Any]: Dictionary containing all processed masks organized by case,
+                or the opened `MaskCorpus` when a corpus path is set
+        """
+        if self.manifest_path is None:
+            raise ValueError("Incremental extraction needs a manifest path")
+        manifest = self._load_manifest()
+        if self.corpus_path is not None:
+            existing = MaskCorpus(self.corpus_path) if MaskCorpus.exists(self.corpus_path) else None
+            if existing is not None and existing.stored_mask_types != self._corpus_mask_types():
+                existing = None
+        else:
+            existing = all_masks
+        if manifest is None or existing is None:
+            print("No previous extraction found, extracting all cases")
+            return self.process()
+
+        case_dirs = self._get_case_directories()
+        signatures = {case_dir.name: self.case_signature(case_dir) for case_dir in case_dirs}
+        changed_dirs = [case_dir for case_dir in case_dirs
+                        if case_dir.name not in existing or manifest.get(case_dir.name) != signatures[case_dir.name]]
+        removed = [case_id for case_id in existing if case_id not in signatures]
+        self.changed = bool(changed_dirs or removed)
+        print(f"Incremental extraction: {len(changed_dirs)} new or changed, {len(removed)} removed, "
+              f"{len(case_dirs) - len(changed_dirs)} unchanged cases")
+
+        if self.corpus_path is not None:
+            if not self.changed:
+                return existing
+            del existing
+            with MaskCorpusWriter(self.corpus_path, self._corpus_mask_types(), append=True) as self._corpus_writer:
+                for case_id in removed:
+                    self._corpus_writer.drop_case(case_id)
+                self._process_case_directories(changed_dirs)
+                self._corpus_writer.order_cases(list(signatures))
+                stale_bytes = self._corpus_writer.stale_bytes
+            self._corpus_writer = None
+            if stale_bytes:
+                print(f"{stale_bytes / 2 ** 20:.1f} MB of replaced slices remain in {self.corpus_path}")
+            result = MaskCorpus(self.corpus_path)
+        else:
+            self.all_masks = {case_id: masks for case_id, masks in existing.items() if case_id not in removed}
+            self._process_case_directories(changed_dirs)
+            self.all_masks = {case_id: self.all_masks[case_id] for case_id in signatures}
+            result = self.all_masks
+        self._save_manifest(signatures)
+        return result
 
     def extract_masks_all_folders(self) -> Dict[str, Any]:
         """
@@ -38,8 +141,7 @@ class MaskExtractor:
         Returns:
             Dict[str, Any]: Dictionary containing all processed masks organized by case
         """
-        for train_dir in self._get_train_directories():
-            self._process_train_directory(train_dir)
+        self._process_case_directories(self._get_case_directories())
         return self.all_masks
 
     def _get_train_directories(self) -> List[Path]:
@@ -51,6 +153,77 @@ class MaskExtractor:
         """
         return [d for d in self.base_path.glob("*train_data") if d.is_dir()]
 
+    def _get_case_directories(self) -> List[Path]:
+        """
+        Get the case directories of all training directories.
+
+        Returns:
+            List[Path]: List of paths to case directories
+        """
+        return [case_dir for train_dir in self._get_train_directories()
+                for case_dir in train_dir.iterdir() if case_dir.is_dir()]
+
+    def _corpus_mask_types(self) -> Tuple[str, ...]:
+        return COMPACT_MASK_TYPES if self.compact_corpus else MASK_TYPES
+
+    @staticmethod
+    def case_signature(case_dir: Path) -> List[List[Any]]:
+        """
+        Get the name, size and modification time of every slice file of a case.
+
+        Args:
+            case_dir (Path): Path to the case directory
+
+        Returns:
+            List[List[Any]]: Sorted [name, size, mtime in ns] of the .npy files in Slices
+        """
+        return sorted([entry.name, entry.stat().st_size, entry.stat().st_mtime_ns]
+                      for entry in os.scandir(case_dir / "Slices") if entry.name.endswith(".npy"))
+
+    def _load_manifest(self) -> Optional[Dict[str, Any]]:
+        """
+        Load the case signatures of the last extraction, None without a manifest.
+        """
+        if not Path(self.manifest_path).exists():
+            return None
+        with open(self.manifest_path, 'r') as file:
+            return json.load(file)['cases']
+
+    def _save_manifest(self, signatures: Dict[str, Any]) -> None:
+        """
+        Save the case signatures of this extraction.
+        """
+        if self.manifest_path is None:
+            return
+        Path(self.manifest_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(self.manifest_path, 'w') as file:
+            json.dump({'base_path': str(self.base_path), 'cases': signatures}, file)
+
+    def _process_case_directories(self, case_dirs: List[Path]) -> None:
+        """
+        Extract the masks of the cases and store them in the given order.
+
+        With more than one worker the cases are read and processed by a thread pool;
+        `np.load` and the mask computations release the GIL for most of their time.
+        At most two cases per worker are in flight, so a corpus can still be written
+        without holding all cases in memory.
+
+        Args:
+            case_dirs (List[Path]): Paths to the case directories
+        """
+        if self.workers == 1:
+            for case_dir in case_dirs:
+                self._store_case(*self._extract_case(case_dir))
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            for case_dir in case_dirs:
+                pending.append(executor.submit(self._extract_case, case_dir))
+                if len(pending) >= 2 * self.workers:
+                    self._store_case(*pending.popleft().result())
+            while pending:
+                self._store_case(*pending.popleft().result())
+
     def _process_train_directory(self, train_dir: Path) -> None:
         """
         Process a single training directory containing multiple cases.
@@ -58,24 +231,41 @@ class MaskExtractor:
         Args:
             train_dir (Path): Path to the training directory
         """
-        for case_dir in train_dir.iterdir():
-            if case_dir.is_dir():
-                self._process_case_directory(case_dir)
+        self._process_case_directories([case_dir for case_dir in train_dir.iterdir() if case_dir.is_dir()])
 
-    def _process_case_directory(self, case_dir: Path) -> None:
+    def _extract_case(self, case_dir: Path) -> Tuple[str, Dict[str, List[np.ndarray]], Path]:
         """
-        Process a single case directory to extract masks.
-        
+        Extract the masks of a single case directory.
+
         Args:
             case_dir (Path): Path to the case directory
+
+        Returns:
+            Tuple[str, Dict[str, List[np.ndarray]], Path]: Case id, masks by mask type and slices path
         """
         slices_path = case_dir / "Slices"
-        name = case_dir.name
         nd_arrays = self.read_nd_array_from_directory(str(slices_path))
-        masks = self.extract_masks_from_nd_arrays(nd_arrays)
-        self.all_masks[name] = masks
+        return case_dir.name, self.extract_masks_from_nd_arrays(nd_arrays), slices_path
+
+    def _store_case(self, name: str, masks: Dict[str, List[np.ndarray]], slices_path: Path) -> None:
+        """
+        Store the masks of an extracted case in the corpus or the masks dictionary.
+        """
+        if self._corpus_writer is not None:
+            self._corpus_writer.add_case(name, masks)
+        else:
+            self.all_masks[name] = masks
         print(f"Processed {slices_path}")
 
+    def _process_case_directory(self, case_dir: Path) -> None:
+        """
+        Process a single case directory to extract masks.
+        
+        Args:
+            case_dir (Path): Path to the case directory
+        """
+        self._store_case(*self._extract_case(case_dir))
+
     def read_nd_array_from_directory(self, directory: str) -> List[np.ndarray]:
         """
         Read all .npy files from a directory into numpy arrays.
@@ -0,0 +1,131 @@
+import os
+import weakref
+from multiprocessing import shared_memory
+import numpy as np
+from typing import Dict, Any
+from mask_extractor.MaskCorpus import MaskCorpus, MASK_TYPES, COMPACT_MASK_TYPES, index_arrays
+
+
+def _release_segment(segment: shared_memory.SharedMemory, owner_pid: int) -> None:
+    """
+    Detach from a shared memory segment and remove it if this process published it.
+
+    Forked workers inherit the owning handle, the pid check keeps them from removing
+    the segment.
+    """
+    if owner_pid == os.getpid():
+        try:
+            segment.unlink()
+        except FileNotFoundError:
+            pass
+    try:
+        segment.close()
+    except BufferError:
+        # Slices handed out are still alive; the mapping goes away with the last of them
+        pass
+
+
+class SharedMaskCorpus(MaskCorpus):
+    """
+    Mask corpus published once in a `multiprocessing.shared_memory` segment.
+
+    The slices are laid out like the data file of a `MaskCorpus`, so reading and
+    sampling work the same, including `get_random_mask_slice`. Pickling only sends the
+    segment name and the small index, so worker processes attach to the same memory
+    instead of receiving a copy of the masks.
+
+    The publishing process owns the segment and removes it with `unlink`, when used as
+    a context manager, or at interpreter exit. If the owner is killed, the
+    multiprocessing resource tracker removes the segment.
+    """
+
+    def __init__(self, name: str, index: Dict[str, np.ndarray], owner: bool = False):
+        """
+        Attach to a published corpus.
+
+        Args:
+            name (str): Name of the shared memory segment
+            index (Dict[str, np.ndarray]): Index arrays of the corpus
+            owner (bool): Whether this handle removes the segment when released
+        """
+        self.name = name
+        self.owner = owner
+        self._segment = shared_memory.SharedMemory(name=name)
+        self._finalizer = weakref.finalize(self, _release_segment, self._segment, os.getpid() if owner else None)
+        slice_bytes = len(index['mask_types']) * np.prod(index['shapes'], axis=1)
+        size = int((index['offsets'] + slice_bytes).max()) if len(slice_bytes) else 0
+        data = np.ndarray((size,), dtype=np.uint8, buffer=self._segment.buf)
+        data.flags.writeable = False
+        self._set_index(index, data)
+
+    @classmethod
+    def publish(cls, all_masks: Dict[str, Any], compact: bool = False) -> "SharedMaskCorpus":
+        """
+        Copy a corpus into a new shared memory segment.
+
+        Args:
+            all_masks (Dict[str, Any]): Dictionary containing all masks organized by case,
+                or a `MaskCorpus`
+            compact (bool): Only store `standard_mask` and derive the other mask types on read
+
+        Returns:
+            SharedMaskCorpus: Owning handle of the published corpus
+        """
+        mask_types = COMPACT_MASK_TYPES if compact else MASK_TYPES
+        rows, offset = [], 0
+        for case_id, case_masks in all_masks.items():
+            for slice_idx, standard_mask in enumerate(case_masks['standard_mask']):
+                shape = tuple(int(size) for size in np.shape(standard_mask))
+                rows.append((str(case_id), slice_idx, offset, shape))
+                offset += len(mask_types) * shape[0] * shape[1]
+        index = index_arrays(rows, mask_types)
+
+        # A segment cannot be empty
+        segment = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        try:
+            cls._fill(segment, rows, mask_types, all_masks)
+            corpus = cls(segment.name, index, owner=True)
+        except BaseException:
+            _release_segment(segment, os.getpid())
+            raise
+        segment.close()
+        print(f"Published {len(rows)} slices ({offset / 2 ** 20:.1f} MB) to shared memory {segment.name}")
+        return corpus
+
+    @staticmethod
+    def _fill(segment: shared_memory.SharedMemory, rows, mask_types, all_masks: Dict[str, Any]) -> None:
+        """
+        Copy the planes of every slice to its offset in the segment.
+        """
+        data = np.ndarray((segment.size,), dtype=np.uint8, buffer=segment.buf)
+        for case_id, slice_idx, start, (height, width) in rows:
+            planes = data[start:start + len(mask_types) * height * width].reshape(len(mask_types), height, width)
+            for plane, mask_type in enumerate(mask_types):
+                planes[plane] = np.asarray(all_masks[case_id][mask_type][slice_idx], dtype=np.uint8)
+
+    def close(self) -> None:
+        """
+        Detach this handle; the owning handle also removes the segment.
+        """
+        self._finalizer()
+
+    def unlink(self) -> None:
+        """
+        Remove the segment, from the owning handle.
+        """
+        if not self.owner:
+            raise ValueError("Only the publishing handle can remove the shared corpus")
+        self._finalizer()
+
+    def __enter__(self) -> "SharedMaskCorpus":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Workers attach to the segment instead of receiving the data
+        return {'name': self.name, 'index': self.index}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(state['name'], state['index'])
@@ -0,0 +1,228 @@
+from pathlib import Path
+import numpy as np
+import cv2
+from typing import Dict, Tuple, Any, Optional
+
+
+class SliceIndex:
+    """
+    Per-slice metadata of the mask corpus for sampling slices without touching the masks.
+
+    For every slice the index stores the blood pool, myocardium, infarct and no-flow
+    pixel counts of its label map and the center and radius of its myocardium.
+    Slices without myocardium (apex and base slices) are invalid and never sampled.
+    The rows matching a filter are computed once, so drawing a slice is a single
+    random index into them.
+    """
+
+    # Pixel counts per slice; the myocardium includes its infarct and no-flow pixels
+    COUNT_FIELDS = ('blood_pool_pixels', 'myocardium_pixels', 'infarct_pixels', 'no_flow_pixels')
+
+    def __init__(self, case_ids: np.ndarray, slice_indices: np.ndarray, counts: Dict[str, np.ndarray],
+                 centers: np.ndarray, radii: np.ndarray, min_myocardium_pixels: int = 1):
+        """
+        Initialize the SliceIndex from precomputed metadata.
+
+        Args:
+            case_ids (np.ndarray): (N,) case id of every slice
+            slice_indices (np.ndarray): (N,) slice index of every slice within its case
+            counts (Dict[str, np.ndarray]): (N,) pixel counts by `COUNT_FIELDS` name
+            centers (np.ndarray): (N, 2) myocardium center (x, y), NaN for invalid slices
+            radii (np.ndarray): (N,) myocardium radius, NaN for invalid slices
+            min_myocardium_pixels (int): Smallest myocardium area sampled by default
+        """
+        self.case_ids = np.asarray(case_ids).astype(str)
+        self.slice_indices = np.asarray(slice_indices, dtype=np.int64)
+        self.counts = {field: np.asarray(counts[field], dtype=np.int64) for field in self.COUNT_FIELDS}
+        self.centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+        self.radii = np.asarray(radii, dtype=np.float64)
+        self.is_pathological = np.char.find(self.case_ids, 'P') >= 0
+        self.valid = self.counts['myocardium_pixels'] > 0
+        self.min_myocardium_pixels = max(1, int(min_myocardium_pixels))
+        self._filtered_rows: Dict[Tuple[bool, int], np.ndarray] = {}
+
+    @staticmethod
+    def index_path_for(np_data_path: str) -> Path:
+        """
+        Get the path the index is stored at, next to the mask corpus file.
+
+        Args:
+            np_data_path (str): Path of the masks.npy corpus
+
+        Returns:
+            Path: Path of the slice index file
+        """
+        np_data_path = Path(np_data_path)
+        return np_data_path.with_name(f"{np_data_path.stem}_slice_index.npz")
+
+    @classmethod
+    def build(cls, all_masks: Dict[str, Any], min_myocardium_pixels: int = 1) -> "SliceIndex":
+        """
+        Compute the metadata of every slice in the corpus.
+
+        Args:
+            all_masks (Dict[str, Any]): Dictionary containing all masks organized by case
+            min_myocardium_pixels (int): Smallest myocardium area sampled by default
+
+        Returns:
+            SliceIndex: Index over all slices
+        """
+        case_ids, slice_indices, rows = [], [], []
+        for case_id, case_masks in all_masks.items():
+            for slice_idx, standard_mask in enumerate(case_masks['standard_mask']):
+                case_ids.append(case_id)
+                slice_indices.append(slice_idx)
+                rows.append(cls.describe_slice(standard_mask))
+
+        counts = {field: np.array([row[0][field] for row in rows], dtype=np.int64) for field in cls.COUNT_FIELDS}
+        centers = np.array([row[1] for row in rows], dtype=np.float64).reshape(-1, 2)
+        radii = np.array([row[2] for row in rows], dtype=np.float64)
+        slice_index = cls(np.array(case_ids, dtype=str), np.array(slice_indices), counts, centers, radii,
+                          min_myocardium_pixels)
+        print(f"Built slice index over {len(case_ids)} slices, {int(slice_index.valid.sum())} with myocardium")
+        return slice_index
+
+    @staticmethod
+    def describe_slice(standard_mask: np.ndarray) -> Tuple[Dict[str, int], Tuple[float, float], float]:
+        """
+        Compute the pixel counts and myocardium circle of a single slice.
+
+        Args:
+            standard_mask (np.ndarray): Label map of the slice (1 blood pool, 2 myocardium,
+                3 infarct, 4 no-flow)
+
+        Returns:
+            Tuple[Dict[str, int], Tuple[float, float], float]: Pixel counts, myocardium
+                center (x, y) and radius; the center and radius are NaN without myocardium
+        """
+        labels = np.bincount(np.asarray(standard_mask, dtype=np.uint8).ravel(), minlength=5)
+        counts = {
+            'blood_pool_pixels': int(labels[1]),
+            'myocardium_pixels': int(labels[2:].sum()),
+            'infarct_pixels': int(labels[3]),
+            'no_flow_pixels': int(labels[4:].sum())
+        }
+        if counts['myocardium_pixels'] == 0:
+            return counts, (np.nan, np.nan), np.nan
+        mayocardium = (np.asarray(standard_mask) >= 2).astype(np.uint8)
+        contours, _ = cv2.findContours(mayocardium, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        (center_x, center_y), radius = cv2.minEnclosingCircle(max(contours, key=cv2.contourArea))
+        return counts, (center_x, center_y), radius
+
+    def save(self, index_path: str) -> None:
+        """
+        Save the metadata to an .npz file.
+
+        Args:
+            index_path (str): Path to save the index to
+        """
+        np.savez(index_path, case_ids=self.case_ids, slice_indices=self.slice_indices,
+                 centers=self.centers, radii=self.radii, **self.counts)
+        print(f"Saved slice index to {index_path}")
+
+    @classmethod
+    def load(cls, index_path: str, min_myocardium_pixels: int = 1) -> "SliceIndex":
+        """
+        Load an index saved with `save`.
+
+        Args:
+            index_path (str): Path of the index file
+            min_myocardium_pixels (int): Smallest myocardium area sampled by default
+
+        Returns:
+            SliceIndex: Loaded index
+        """
+        with np.load(index_path) as data:
+            return cls(data['case_ids'], data['slice_indices'], {field: data[field] for field in cls.COUNT_FIELDS},
+                       data['centers'], data['radii'], min_myocardium_pixels)
+
+    @classmethod
+    def load_or_build(cls, index_path: str, all_masks: Dict[str, Any],
+                      min_myocardium_pixels: int = 1) -> "SliceIndex":
+        """
+        Load the index if it was precomputed for this corpus, otherwise build and save it.
+
+        Args:
+            index_path (str): Path of the index file
+            all_masks (Dict[str, Any]): Dictionary containing all masks organized by case
+            min_myocardium_pixels (int): Smallest myocardium area sampled by default
+
+        Returns:
+            SliceIndex: Slice index over the corpus
+        """
+        if Path(index_path).exists():
+            slice_index = cls.load(index_path, min_myocardium_pixels)
+            if slice_index.matches(all_masks):
+                print(f"Loaded slice index from {index_path}")
+                return slice_index
+            print(f"Slice index {index_path} does not match the corpus, rebuilding")
+        slice_index = cls.build(all_masks, min_myocardium_pixels)
+        slice_index.save(index_path)
+        return slice_index
+
+    def matches(self, all_masks: Dict[str, Any]) -> bool:
+        """
+        Check that the index covers exactly the cases and slices of a corpus, in order.
+        """
+        expected = [(str(case_id), slice_idx) for case_id, case_masks in all_masks.items()
+                    for slice_idx in range(len(case_masks['standard_mask']))]
+        return expected == list(zip(self.case_ids.tolist(), self.slice_indices.tolist()))
+
+    def filtered_rows(self, has_infarction: bool = False, min_myocardium_pixels: int = None) -> np.ndarray:
+        """
+        Get the rows of the valid slices matching a filter, computed once per filter.
+
+        Args:
+            has_infarction (bool): Only pathological slices with infarct or no-flow pixels
+            min_myocardium_pixels (int): Smallest myocardium area, the index default when None
+
+        Returns:
+            np.ndarray: Matching rows of the index
+        """
+        if min_myocardium_pixels is None:
+            min_myocardium_pixels = self.min_myocardium_pixels
+        key = (bool(has_infarction), max(1, int(min_myocardium_pixels)))
+        if key not in self._filtered_rows:
+            selected = self.counts['myocardium_pixels'] >= key[1]
+            if has_infarction:
+                selected &= self.is_pathological & (self.counts['infarct_pixels'] + self.counts['no_flow_pixels'] > 0)
+            self._filtered_rows[key] = np.flatnonzero(selected)
+        return self._filtered_rows[key]
+
+    def sample(self, mask_type: str, has_infarction: bool = None,
+               min_myocardium_pixels: int = None) -> Tuple[str, int]:
+        """
+        Draw a random valid slice with `np.random`.
+
+        Args:
+            mask_type (str): Mask type the slice is sampled for; 'infarction_masks' only
+                samples slices with infarction unless `has_infarction` says otherwise
+            has_infarction (bool): Only sample pathological slices with infarct or no-flow pixels
+            min_myocardium_pixels (int): Smallest myocardium area, the index default when None
+
+        Returns:
+            Tuple[str, int]: (case id, slice index) of the sampled slice
+        """
+        if has_infarction is None:
+            has_infarction = mask_type == 'infarction_masks'
+        rows = self.filtered_rows(has_infarction, min_myocardium_pixels)
+        if len(rows) == 0:
+            raise ValueError(f"No slices with at least {min_myocardium_pixels or self.min_myocardium_pixels} "
+                             f"myocardium pixels{' and infarction' if has_infarction else ''} to sample")
+        row = rows[np.random.randint(len(rows))]
+        return str(self.case_ids[row]), int(self.slice_indices[row])
+
+    def metadata(self, location: Tuple[str, int]) -> Optional[Dict[str, Any]]:
+        """
+        Get the counts, center and radius of a slice, None if it is not indexed.
+        """
+        rows = np.flatnonzero((self.case_ids == str(location[0])) & (self.slice_indices == int(location[1])))
+        if len(rows) == 0:
+            return None
+        row = rows[0]
+        return dict({field: int(values[row]) for field, values in self.counts.items()},
+                    center=tuple(float(value) for value in self.centers[row]),
+                    radius=float(self.radii[row]), valid=bool(self.valid[row]))
+
+    def __len__(self) -> int:
+        return len(self.case_ids)
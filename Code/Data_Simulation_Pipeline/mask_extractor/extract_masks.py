@@ -1,25 +1,63 @@
 from typing import Dict, List, Tuple, Any
 from mask_extractor.MaskExtractor import MaskExtractor
+from mask_extractor.SliceIndex import SliceIndex
+from mask_writer.MaskCodec import encode_corpus
 import numpy as np
+import random
 import logging
-def extract_all_masks(base_path: str) -> Dict[str, Any]:
+def extract_all_masks(base_path: str, corpus_path: str = None, compact: bool = False,
+                      workers: int = 1, manifest_path: str = None) -> Dict[str, Any]:
     """
     Extract all masks from the dataset using MaskExtractor.
     
     Args:
         base_path (str): Path to the base directory containing the data
+        corpus_path (str): Optional path of a memory-mapped `MaskCorpus` to extract into
+        compact (bool): Only store `standard_mask` in the corpus
+        workers (int): Number of threads extracting cases
+        manifest_path (str): Optional path to record the extracted slice files at, for `update_all_masks`
         
     Returns:
         Dict[str, Any]: Dictionary containing all processed masks organized by case
+            (a `MaskCorpus` with the same layout when `corpus_path` is set)
     """
     # Initialize the mask extractor
-    extractor = MaskExtractor(base_path)
+    extractor = MaskExtractor(base_path, corpus_path, compact, workers, manifest_path)
     
     # Process and extract all masks
     print("Starting mask extraction...")
     all_masks = extractor.process()
+    _print_extraction_summary(all_masks)
+    return all_masks
+
+def update_all_masks(base_path: str, manifest_path: str, all_masks: Dict[str, Any] = None,
+                     corpus_path: str = None, compact: bool = False,
+                     workers: int = 1) -> Tuple[Dict[str, Any], bool]:
+    """
+    Re-extract only the cases that were added or changed since the last extraction.
     
-    # Print summary of extracted masks
+    Args:
+        base_path (str): Path to the base directory containing the data
+        manifest_path (str): Path of the extraction manifest
+        all_masks (Dict[str, Any]): Previously extracted masks, without a corpus path
+        corpus_path (str): Optional path of the memory-mapped `MaskCorpus` to update
+        compact (bool): Only store `standard_mask` in the corpus
+        workers (int): Number of threads extracting cases
+        
+    Returns:
+        Tuple[Dict[str, Any], bool]: Up-to-date masks (a `MaskCorpus` when `corpus_path`
+            is set) and whether any case was re-extracted or removed
+    """
+    extractor = MaskExtractor(base_path, corpus_path, compact, workers, manifest_path)
+    all_masks = extractor.update(all_masks)
+    if extractor.changed:
+        _print_extraction_summary(all_masks)
+    return all_masks, extractor.changed
+
+def _print_extraction_summary(all_masks: Dict[str, Any]) -> None:
+    """
+    Print the number of cases, slices per case and mask types of extracted masks.
+    """
     num_cases = len(all_masks)
     if num_cases > 0:
         sample_case = next(iter(all_masks))
@@ -30,49 +68,120 @@ def extract_all_masks(base_path: str) -> Dict[str, Any]:
         print(f"- Available mask types: {list(all_masks[sample_case].keys())}")
     else:
         print("No masks were extracted!")
-        
-    return all_masks
 
-def get_random_mask_slice(all_masks: Dict[str, Any], mask_type) -> np.ndarray:
-    # Select a random case
-    if mask_type == "infarction_masks":
-        keys_with_infarction = [key for key in all_masks.keys() if 'P' in key]
-        case_id = np.random.choice(list(keys_with_infarction))
+def get_random_mask_slice(all_masks: Dict[str, Any], mask_type, return_location: bool = False,
+                          slice_index: SliceIndex = None) -> np.ndarray:
+    """
+    Select a random slice of the given mask type and its blood pool mask.
+    
+    Args:
+        all_masks (Dict[str, Any]): Dictionary containing all masks organized by case
+        mask_type (str): Mask type to sample ('infarction_masks' only samples pathological cases)
+        return_location (bool): Also return the (case id, slice index) of the selected slice
+        slice_index (SliceIndex): Optional slice metadata; when given the slice is drawn
+            uniformly from the valid slices (with infarction for 'infarction_masks')
+            instead of a random slice of a random case
+        
+    Returns:
+        Tuple of the mask slice and blood pool mask slice, followed by the
+        (case id, slice index) location when `return_location` is set
+    """
+    if slice_index is not None:
+        case_id, slice_idx = slice_index.sample(mask_type)
+        mask = all_masks[case_id][mask_type]
+        blood_pool_mask = all_masks[case_id]["blood_pool_masks"]
+    else:
+        # Select a random case
+        if mask_type == "infarction_masks":
+            keys_with_infarction = [key for key in all_masks.keys() if 'P' in key]
+            case_id = np.random.choice(list(keys_with_infarction))
 
-    else: 
-        case_id = np.random.choice(list(all_masks.keys()))
+        else: 
+            case_id = np.random.choice(list(all_masks.keys()))
 
+        case_masks = all_masks[case_id]
+        
+        # Select a random mask type
+        mask = case_masks[mask_type]
+        blood_pool_mask = case_masks["blood_pool_masks"]
+        # Select a random slice
+        slice_idx = np.random.randint(len(mask))
 
     # log the selected case ID
     logging.debug(f"Selected case ID: {case_id}")
-    
-    case_masks = all_masks[case_id]
-    
-    # Select a random mask type
-    mask = case_masks[mask_type]
-    blood_pool_mask = case_masks["blood_pool_masks"]
-    # Select a random slice
-    slice_idx = np.random.randint(len(mask))
     mask_slice = mask[slice_idx]
     blood_pool_mask_slice = blood_pool_mask[slice_idx]
     logging.debug(f"Selected slice index: {slice_idx}")
-    # log the unique values of the mask slice   
-    if mask_type == "infarction_masks":
-        logging.debug(f"Unique values in infarction mask slice: {np.unique(mask_slice)}")
-    
-    logging.debug(f"Unique values in mask slice: {np.unique(blood_pool_mask_slice)}")
+    # log the unique values of the mask slice, np.unique only runs when debug logging is on
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        if mask_type == "infarction_masks":
+            logging.debug(f"Unique values in infarction mask slice: {np.unique(mask_slice)}")
+
+        logging.debug(f"Unique values in mask slice: {np.unique(blood_pool_mask_slice)}")
     logging.debug(f"blood_pool_mask_slice shape: {blood_pool_mask_slice.shape}")
+    if return_location:
+        return mask_slice, blood_pool_mask_slice, (str(case_id), int(slice_idx))
     return mask_slice, blood_pool_mask_slice
 
-def save_masks_to_npy(all_masks: Dict[str, Any], np_data_path: str) -> None:
+def seed_random_generators(seed: int, index: int) -> None:
+    """
+    Seed the global `random` and `np.random` generators with the stream of one item.
+    
+    Every item index derives its own independent stream from the run seed, so item
+    `index` draws the same random numbers whichever process generates it.
+    
+    Args:
+        seed (int): Seed of the whole run
+        index (int): Index of the item being generated
+    """
+    state = np.random.SeedSequence(entropy=seed, spawn_key=(index,)).generate_state(2)
+    np.random.seed(int(state[0]))
+    random.seed(int(state[1]))
+
+def derive_seed(seed: int, stream: int) -> int:
+    """
+    Derive the seed of one step of a run from the run seed.
+
+    Args:
+        seed (int): Seed of the whole run
+        stream (int): Number of the step, every step gets an independent seed
+
+    Returns:
+        int: Seed of the step
+    """
+    return int(np.random.SeedSequence(entropy=seed, spawn_key=(stream,)).generate_state(1, np.uint64)[0])
+
+def shard_indices(number_of_items: int, shard_index: int = 0, shard_count: int = 1) -> range:
+    """
+    Get the item indices one shard of a run generates.
+
+    Shard k of n takes every n-th index starting at k, so the shards together cover
+    every index exactly once and, as item i is seeded from i alone, produce the same
+    items as a single run.
+
+    Args:
+        number_of_items (int): Number of items of the whole run
+        shard_index (int): Index of this shard, from 0 to `shard_count` - 1
+        shard_count (int): Number of shards the run is split into
+
+    Returns:
+        range: Indices of this shard
+    """
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise ValueError(f"shard_index must be in [0, shard_count), got {shard_index} of {shard_count}")
+    return range(shard_index, number_of_items, shard_count)
+
+def save_masks_to_npy(all_masks: Dict[str, Any], np_data_path: str, mask_codec: str = None) -> None:
     """
     Save the extracted masks to an npy file.
     
     Args:
         all_masks (Dict[str, Any]): Dictionary containing all processed masks organized by case
         np_data_path (str): Path to save the npy file
+        mask_codec (str): 'rle' or 'bitplanes' to store every slice encoded (see `MaskCodec`);
+            read such files back with `load_masks_npy`
     """
-    np.save(np_data_path, all_masks)
+    np.save(np_data_path, encode_corpus(all_masks, mask_codec) if mask_codec else all_masks)
     print(f"Saved masks to {np_data_path}")
 
 def overlay_masks_on_mask(mask1: np.ndarray, mask2: np.ndarray) -> np.ndarray:
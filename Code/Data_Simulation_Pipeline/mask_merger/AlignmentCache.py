@@ -0,0 +1,137 @@
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+import numpy as np
+from typing import Dict, Any, Optional, Sequence, Tuple
+import logging
+
+class AlignmentCache:
+    """
+    Persistent, size-bounded LRU cache of alignment results keyed by donor slice pair.
+
+    Entries live in a SQLite file so the cache survives between runs and can be
+    shared by several processes writing to the same file. Keys include a hash of the
+    two slices, so a slice whose mask changed after a re-extraction misses the cache
+    instead of getting the alignment of its old mask.
+    """
+
+    def __init__(self, cache_path: str, max_entries: int = 10000):
+        """
+        Initialize the AlignmentCache, creating the cache file if needed.
+
+        Args:
+            cache_path (str): Path of the SQLite cache file
+            max_entries (int): Maximum number of alignments kept before the least recently used are evicted
+        """
+        self.cache_path = Path(cache_path)
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._connection = sqlite3.connect(str(self.cache_path), timeout=30)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS alignments ("
+                " key TEXT PRIMARY KEY,"
+                " shift_x INTEGER NOT NULL,"
+                " shift_y INTEGER NOT NULL,"
+                " angle REAL NOT NULL,"
+                " metrics TEXT,"
+                " last_used REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS alignments_last_used ON alignments (last_used)"
+            )
+
+    @staticmethod
+    def make_key(mayocardium_location: Tuple[str, int], infarction_location: Tuple[str, int],
+                 search_range: int, rotation_angles: Sequence[float],
+                 alignment_method: str = 'exhaustive', slices: Sequence[np.ndarray] = ()) -> str:
+        """
+        Build the cache key of an alignment.
+
+        Args:
+            mayocardium_location (Tuple[str, int]): (case id, slice index) of the myocardium slice
+            infarction_location (Tuple[str, int]): (case id, slice index) of the infarction donor slice
+            search_range (int): Range of pixels searched for alignment
+            rotation_angles (Sequence[float]): Rotation angles searched
+            alignment_method (str): Alignment search engine that produced the result
+            slices (Sequence[np.ndarray]): Myocardium and infarction slices, hashed into the key
+
+        Returns:
+            str: Key identifying the alignment
+        """
+        content = hashlib.blake2b(digest_size=16)
+        for mask in slices:
+            mask = np.ascontiguousarray(mask)
+            content.update(f"{mask.dtype.str}{mask.shape}".encode())
+            content.update(mask.tobytes())
+        return json.dumps([
+            str(mayocardium_location[0]), int(mayocardium_location[1]),
+            str(infarction_location[0]), int(infarction_location[1]),
+            int(search_range), [float(angle) for angle in np.asarray(rotation_angles).ravel()],
+            alignment_method, content.hexdigest()
+        ])
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up a cached alignment and mark it as recently used.
+
+        Args:
+            key (str): Key from `make_key`
+
+        Returns:
+            Optional[Dict[str, Any]]: Alignment parameters in the `find_optimal_alignment` format,
+                or None on a miss
+        """
+        row = self._connection.execute(
+            "SELECT shift_x, shift_y, angle, metrics FROM alignments WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        with self._connection:
+            self._connection.execute(
+                "UPDATE alignments SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+        shift_x, shift_y, angle, metrics = row
+        return {
+            'shift_x': shift_x,
+            'shift_y': shift_y,
+            'angle': int(angle) if float(angle).is_integer() else angle,
+            'metrics': json.loads(metrics) if metrics is not None else None
+        }
+
+    def put(self, key: str, best_params: Dict[str, Any]) -> None:
+        """
+        Store an alignment result and evict the least recently used entries over the limit.
+
+        Args:
+            key (str): Key from `make_key`
+            best_params (Dict[str, Any]): Alignment parameters returned by the search
+        """
+        metrics = best_params['metrics']
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO alignments (key, shift_x, shift_y, angle, metrics, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, int(best_params['shift_x']), int(best_params['shift_y']), float(best_params['angle']),
+                 json.dumps(metrics) if metrics is not None else None, time.time())
+            )
+            self._connection.execute(
+                "DELETE FROM alignments WHERE key IN ("
+                " SELECT key FROM alignments ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def __len__(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM alignments").fetchone()[0]
+
+    def close(self) -> None:
+        """Close the underlying database connection."""
+        logging.info(f"Alignment cache {self.cache_path}: {self.hits} hits, {self.misses} misses")
+        self._connection.close()
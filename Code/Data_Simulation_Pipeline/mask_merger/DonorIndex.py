@@ -0,0 +1,220 @@
+from pathlib import Path
+import numpy as np
+from typing import Dict, List, Tuple, Any, Optional
+import logging
+from mask_merger.MaskAlignment import MaskAlignment
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:  # Without scipy every query scans all donors, see `DonorIndex.__init__`
+    cKDTree = None
+
+
+class DonorIndex:
+    """
+    Shape-descriptor index over all corpus slices for k-nearest-neighbour donor matching.
+
+    Every slice with a myocardium is described by its myocardium center and radius,
+    myocardium area and a radial profile of the myocardium around its center.
+    Infarction donors are the pathological slices that contain infarction pixels.
+    Queries go through a k-d tree over the donors when scipy is installed, otherwise
+    through a linear scan of all donors, with a warning.
+    """
+
+    def __init__(self, descriptors: np.ndarray, case_ids: np.ndarray, slice_indices: np.ndarray,
+                 is_donor: np.ndarray):
+        """
+        Initialize the DonorIndex from precomputed descriptors.
+
+        Args:
+            descriptors (np.ndarray): (N, D) shape descriptors, one row per slice
+            case_ids (np.ndarray): (N,) case id of every slice
+            slice_indices (np.ndarray): (N,) slice index of every slice within its case
+            is_donor (np.ndarray): (N,) whether the slice can serve as an infarction donor
+        """
+        self.descriptors = np.asarray(descriptors, dtype=np.float64)
+        self.case_ids = np.asarray(case_ids).astype(str)
+        self.slice_indices = np.asarray(slice_indices, dtype=np.int64)
+        self.is_donor = np.asarray(is_donor, dtype=bool)
+        self._rows = {(case_id, int(slice_idx)): row
+                      for row, (case_id, slice_idx) in enumerate(zip(self.case_ids, self.slice_indices))}
+
+        # Standardize the features so no descriptor dominates the distance
+        mean = self.descriptors.mean(axis=0) if len(self.descriptors) else 0.0
+        std = self.descriptors.std(axis=0) if len(self.descriptors) else 1.0
+        self._scaled = (self.descriptors - mean) / np.where(std > 0, std, 1.0)
+        self._donor_rows = np.flatnonzero(self.is_donor)
+        # Donors per case, to know how many same-case neighbours a query may have to skip
+        donor_cases, donor_counts = np.unique(self.case_ids[self._donor_rows], return_counts=True)
+        self._case_donors = dict(zip(donor_cases.tolist(), donor_counts.tolist()))
+        donor_points = self._scaled[self._donor_rows]
+        self._tree = cKDTree(donor_points) if cKDTree is not None and len(donor_points) else None
+        if cKDTree is None and len(donor_points):
+            logging.warning(f"scipy is not installed, donor queries scan all {len(donor_points)} donors "
+                            f"instead of a k-d tree; install scipy for the k-d tree")
+
+    @staticmethod
+    def index_path_for(np_data_path: str) -> Path:
+        """
+        Get the path the index is stored at, next to the mask corpus file.
+
+        Args:
+            np_data_path (str): Path of the masks.npy corpus
+
+        Returns:
+            Path: Path of the donor index file
+        """
+        np_data_path = Path(np_data_path)
+        return np_data_path.with_name(f"{np_data_path.stem}_donor_index.npz")
+
+    @classmethod
+    def build(cls, all_masks: Dict[str, Any], radial_bins: int = 8) -> "DonorIndex":
+        """
+        Compute the shape descriptors of every slice in the corpus.
+
+        Args:
+            all_masks (Dict[str, Any]): Dictionary containing all masks organized by case
+            radial_bins (int): Number of bins of the radial myocardium profile
+
+        Returns:
+            DonorIndex: Index over all slices with a myocardium
+        """
+        mask_alignment = MaskAlignment()
+        descriptors, case_ids, slice_indices, is_donor = [], [], [], []
+        for case_id, case_masks in all_masks.items():
+            for slice_idx, standard_mask in enumerate(case_masks['standard_mask']):
+                descriptor = cls.describe_slice(standard_mask, mask_alignment, radial_bins)
+                if descriptor is None:
+                    continue
+                descriptors.append(descriptor)
+                case_ids.append(case_id)
+                slice_indices.append(slice_idx)
+                is_donor.append('P' in case_id and bool(np.any(standard_mask >= 3)))
+
+        logging.info(f"Built donor index over {len(descriptors)} slices, {sum(is_donor)} donors")
+        return cls(np.reshape(descriptors, (len(descriptors), -1)), np.array(case_ids, dtype=str),
+                   np.array(slice_indices), np.array(is_donor, dtype=bool))
+
+    @staticmethod
+    def describe_slice(standard_mask: np.ndarray, mask_alignment: MaskAlignment,
+                       radial_bins: int = 8) -> Optional[np.ndarray]:
+        """
+        Compute the shape descriptor of a single slice.
+
+        Args:
+            standard_mask (np.ndarray): Label map of the slice
+            mask_alignment (MaskAlignment): Provides `calculate_mask_rad_and_position`
+            radial_bins (int): Number of bins of the radial myocardium profile
+
+        Returns:
+            Optional[np.ndarray]: [center_x, center_y, radius, area, radial profile...],
+                or None if the slice has no myocardium
+        """
+        mayocardium = (standard_mask >= 2).astype(np.uint8)
+        area = int(np.sum(mayocardium))
+        if area == 0:
+            return None
+
+        (center_x, center_y), radius = mask_alignment.calculate_mask_rad_and_position(mayocardium)
+        ys, xs = np.nonzero(mayocardium)
+        distances = np.hypot(xs - center_x, ys - center_y) / max(radius, 1.0)
+        profile, _ = np.histogram(distances, bins=radial_bins, range=(0.0, 1.0))
+        return np.concatenate([[center_x, center_y, radius, area], profile / area])
+
+    def save(self, index_path: str) -> None:
+        """
+        Save the descriptors to an .npz file.
+
+        Args:
+            index_path (str): Path to save the index to
+        """
+        np.savez(index_path, descriptors=self.descriptors, case_ids=self.case_ids,
+                 slice_indices=self.slice_indices, is_donor=self.is_donor)
+        print(f"Saved donor index to {index_path}")
+
+    @classmethod
+    def load(cls, index_path: str) -> "DonorIndex":
+        """
+        Load an index saved with `save`.
+
+        Args:
+            index_path (str): Path of the index file
+
+        Returns:
+            DonorIndex: Loaded index
+        """
+        with np.load(index_path) as data:
+            return cls(data['descriptors'], data['case_ids'], data['slice_indices'], data['is_donor'])
+
+    @classmethod
+    def load_or_build(cls, index_path: str, all_masks: Dict[str, Any]) -> "DonorIndex":
+        """
+        Load the index if it was already precomputed, otherwise build and save it.
+
+        Args:
+            index_path (str): Path of the index file
+            all_masks (Dict[str, Any]): Dictionary containing all masks organized by case
+
+        Returns:
+            DonorIndex: Donor index over the corpus
+        """
+        if Path(index_path).exists():
+            print(f"Loaded donor index from {index_path}")
+            return cls.load(index_path)
+        donor_index = cls.build(all_masks)
+        donor_index.save(index_path)
+        return donor_index
+
+    def nearest_donors(self, location: Tuple[str, int], k: int = 5) -> List[Tuple[str, int]]:
+        """
+        Find the k donor slices whose shape is closest to the given slice.
+
+        Donors from the same case as the query are skipped.
+
+        Args:
+            location (Tuple[str, int]): (case id, slice index) of the myocardium slice
+            k (int): Number of neighbours to return
+
+        Returns:
+            List[Tuple[str, int]]: (case id, slice index) of the nearest donors, closest first;
+                empty if the slice is not indexed
+        """
+        row = self._rows.get((str(location[0]), int(location[1])))
+        if row is None or len(self._donor_rows) == 0:
+            return []
+
+        # Over-fetch so that enough neighbours remain once same-case donors are dropped
+        same_case = self._case_donors.get(str(self.case_ids[row]), 0)
+        fetch = min(k + same_case, len(self._donor_rows))
+        query = self._scaled[row]
+        if self._tree is not None:
+            _, neighbours = self._tree.query(query, k=fetch)
+            neighbours = np.atleast_1d(neighbours)
+        else:
+            distances = np.sum((self._scaled[self._donor_rows] - query) ** 2, axis=1)
+            neighbours = np.argpartition(distances, fetch - 1)[:fetch]
+            neighbours = neighbours[np.argsort(distances[neighbours])]
+
+        donors = []
+        for neighbour in neighbours:
+            donor_row = self._donor_rows[neighbour]
+            if self.case_ids[donor_row] == self.case_ids[row]:
+                continue
+            donors.append((str(self.case_ids[donor_row]), int(self.slice_indices[donor_row])))
+        return donors[:k]
+
+    def sample_donor(self, location: Tuple[str, int], k: int = 5) -> Optional[Tuple[str, int]]:
+        """
+        Pick a random donor among the k nearest neighbours of a slice.
+
+        Args:
+            location (Tuple[str, int]): (case id, slice index) of the myocardium slice
+            k (int): Number of neighbours to choose from
+
+        Returns:
+            Optional[Tuple[str, int]]: (case id, slice index) of the donor, None if no donor matches
+        """
+        donors = self.nearest_donors(location, k)
+        if not donors:
+            return None
+        return donors[np.random.randint(len(donors))]
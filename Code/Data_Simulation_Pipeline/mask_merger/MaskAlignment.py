@@ -5,11 +5,27 @@ import cv2
 import matplotlib.pyplot as plt
 from typing import Dict, List, Tuple, Any
 import logging
+from instrumentation.Profiler import profiler
 
 class MaskAlignment:
     """
     Class for handling mask alignment operations including shifting, rotation, and correlation calculations.
     """
+
+    # Maps the `alignment_method` config value to the search implementation
+    ALIGNMENT_METHODS = {
+        'exhaustive': 'find_optimal_alignment',
+        'fft': 'find_optimal_alignment_fft',
+        'pyramid': 'find_optimal_alignment_pyramid',
+    }
+    # Rotation angles scored per FFT batch, bounds its memory whatever the rotation step
+    FFT_ANGLE_CHUNK = 8
+
+    def __init__(self):
+        """Initialize the MaskAlignment."""
+        # Evaluation counts and result of the most recent alignment
+        self.last_search_stats = None
+        self.last_best_params = None
     
     @staticmethod
     def shift_mask(mask: np.ndarray, shift_x: int = 0, shift_y: int = 0) -> np.ndarray:
@@ -161,14 +177,17 @@ class MaskAlignment:
         
         rotation_center = (int(mayocardium_center[0]), int(mayocardium_center[1]))
         
-        print("Starting alignment optimization...")
+        # Formatting a message per candidate is only worth it when it is logged
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        logging.debug("Starting alignment optimization...")
         
         for shift_x in range(-search_range, search_range + 1):
             for shift_y in range(-search_range, search_range + 1):
                 shifted_mask = self.shift_mask(infarction_mask, shift_x, shift_y)
                 
                 for angle in rotation_angles:
-                    print(f"Testing shift ({shift_x}, {shift_y}), rotation {angle}°")
+                    if debug:
+                        logging.debug(f"Testing shift ({shift_x}, {shift_y}), rotation {angle}°")
                     
                     rotated_mask = self.rotate_mask_around_point(
                         shifted_mask, angle, rotation_center
@@ -188,12 +207,341 @@ class MaskAlignment:
                             'metrics': correlation_metrics
                         }
         
+        grid_size = (2 * search_range + 1) ** 2 * len(rotation_angles)
+        self._record_search_stats(grid_size, grid_size, grid_size)
         return best_params
 
+    def find_optimal_alignment_fft(self, mayocardial_mask: np.ndarray, infarction_mask: np.ndarray,
+                                   mayocardium_center: Tuple[float, float],
+                                   search_range: int = 20,
+                                   rotation_angles: np.ndarray = np.arange(0, 360, 30)) -> Dict[str, Any]:
+        """
+        Find optimal alignment parameters using FFT cross-correlation.
+
+        Rather than shifting and rotating the infarction mask for every candidate, each
+        rotation is applied once to a map of pixel indices. This tells which source
+        pixel every output pixel reads from, so the myocardium can be pulled back onto
+        the unrotated grid (a pre-rotated stack). The overlap and the rotated area for
+        every translation then come out of a single cross-correlation with the binary
+        infarction mask, giving the same Dice scores as `find_optimal_alignment`.
+        
+        Args:
+            mayocardial_mask (np.ndarray): Target mask
+            infarction_mask (np.ndarray): Mask to be aligned
+            mayocardium_center (Tuple[float, float]): Center point for rotation
+            search_range (int): Range of pixels to search for alignment
+            rotation_angles (np.ndarray): Array of rotation angles to try
+            
+        Returns:
+            Dict[str, Any]: Dictionary containing best alignment parameters
+        """
+        best_params = {'shift_x': 0, 'shift_y': 0, 'angle': 0, 'metrics': None}
+        rotation_center = (int(mayocardium_center[0]), int(mayocardium_center[1]))
+        rotation_angles = np.asarray(rotation_angles)
+
+        dice_scores = self._score_alignments_fft(
+            mayocardial_mask, infarction_mask, rotation_center, search_range, rotation_angles
+        )
+        # All candidates are scored by the correlation; only the winner is re-evaluated
+        self._record_search_stats(1, 1, dice_scores.size)
+        best_correlation = dice_scores.max()
+        if best_correlation <= 0:
+            return best_params
+
+        # Match the exhaustive loop order (shift_x, then shift_y, then angle) on ties
+        angle_idx, y_idx, x_idx = np.nonzero(dice_scores == best_correlation)
+        first = np.lexsort((angle_idx, y_idx, x_idx))[0]
+        shift_x = int(x_idx[first]) - search_range
+        shift_y = int(y_idx[first]) - search_range
+        angle = rotation_angles[angle_idx[first]]
+
+        rotated_mask = self.rotate_mask_around_point(
+            self.shift_mask(infarction_mask, shift_x, shift_y), angle, rotation_center
+        )
+        return {
+            'shift_x': shift_x,
+            'shift_y': shift_y,
+            'angle': angle,
+            'metrics': self.calculate_mask_correlation(rotated_mask, mayocardial_mask)
+        }
+
+    def _score_alignments_fft(self, mayocardial_mask: np.ndarray, infarction_mask: np.ndarray,
+                              rotation_center: Tuple[int, int], search_range: int,
+                              rotation_angles: np.ndarray) -> np.ndarray:
+        """
+        Compute the Dice coefficient of every (angle, shift_y, shift_x) candidate.
+
+        The angles are scored `FFT_ANGLE_CHUNK` at a time and only the search window of
+        each correlation is kept, so memory does not grow with the number of angles.
+        
+        Args:
+            mayocardial_mask (np.ndarray): Target mask
+            infarction_mask (np.ndarray): Mask to be aligned
+            rotation_center (Tuple[int, int]): Center point for rotation
+            search_range (int): Range of pixels to search for alignment
+            rotation_angles (np.ndarray): Array of rotation angles to try
+            
+        Returns:
+            np.ndarray: Array of shape (len(rotation_angles), 2 * search_range + 1, 2 * search_range + 1)
+                indexed by [angle, shift_y + search_range, shift_x + search_range]
+        """
+        h, w = infarction_mask.shape
+        mayocardial_binary = (mayocardial_mask > 0).ravel()
+        mayocardial_area = int(np.sum(mayocardial_binary))
+
+        # Padding by search_range keeps the circular correlation free of wrap-around
+        # for every lag inside the search window.
+        fft_shape = (h + search_range, w + search_range)
+        infarction_fft_conj = np.conj(np.fft.rfft2((infarction_mask > 0).astype(np.float64), s=fft_shape))
+        lags = np.arange(-search_range, search_range + 1)
+        counts = np.empty((len(rotation_angles), 2, len(lags), len(lags)), dtype=np.float64)
+
+        for start in range(0, len(rotation_angles), self.FFT_ANGLE_CHUNK):
+            chunk = rotation_angles[start:start + self.FFT_ANGLE_CHUNK]
+            # For every angle, count how many output pixels (and how many myocardial output
+            # pixels) read from each source pixel of the shifted mask.
+            weights = np.empty((len(chunk), 2, h, w), dtype=np.float64)
+            for i, angle in enumerate(chunk):
+                source_index = self._rotation_source_index(h, w, angle, rotation_center).ravel()
+                inside = source_index >= 0
+                weights[i, 0] = np.bincount(source_index[inside], weights=mayocardial_binary[inside],
+                                            minlength=h * w).reshape(h, w)
+                weights[i, 1] = np.bincount(source_index[inside], minlength=h * w).reshape(h, w)
+
+            weights_fft = np.fft.rfft2(weights, s=fft_shape, axes=(-2, -1))
+            weights_fft *= infarction_fft_conj
+            correlation = np.fft.irfft2(weights_fft, s=fft_shape, axes=(-2, -1))
+            counts[start:start + len(chunk)] = np.rint(correlation[:, :, lags[:, None], lags[None, :]])
+        intersection, rotated_area = counts[:, 0], counts[:, 1]
+
+        denominator = rotated_area + mayocardial_area
+        return np.divide(2.0 * intersection, denominator,
+                         out=np.zeros_like(intersection), where=denominator > 0)
+
+    @staticmethod
+    def _rotation_source_index(h: int, w: int, angle: float, center: Tuple[int, int]) -> np.ndarray:
+        """
+        Find the source pixel each output pixel is sampled from by `rotate_mask_around_point`.
+        
+        The index map goes through the same `cv2.warpAffine` call, so the mapping matches
+        its nearest-neighbour rounding exactly.
+        
+        Args:
+            h (int): Height of the mask
+            w (int): Width of the mask
+            angle (float): Rotation angle in degrees
+            center (Tuple[int, int]): Center point for rotation
+            
+        Returns:
+            np.ndarray: Flat source index per output pixel, -1 where the source is outside the mask
+        """
+        index_map = np.arange(1, h * w + 1, dtype=np.float32).reshape(h, w)
+        rotation_matrix = cv2.getRotationMatrix2D(center, -angle, 1.0)
+        warped = cv2.warpAffine(index_map, rotation_matrix, (w, h), flags=cv2.INTER_NEAREST)
+        return warped.astype(np.int64) - 1
+
+    def find_optimal_alignment_pyramid(self, mayocardial_mask: np.ndarray, infarction_mask: np.ndarray,
+                                       mayocardium_center: Tuple[float, float],
+                                       search_range: int = 20,
+                                       rotation_angles: np.ndarray = np.arange(0, 360, 30),
+                                       pyramid_levels: int = 2,
+                                       candidates_per_level: int = 3) -> Dict[str, Any]:
+        """
+        Find alignment parameters with a coarse-to-fine search on a mask pyramid.
+
+        The infarction is first pre-aligned by moving its centroid onto the closest
+        myocardial pixel, and the shift window is centered on that offset. Every angle
+        and shift of the window is scored on the coarsest (downsampled) level. Only
+        the best candidates are carried to the next finer level, where their
+        neighbouring shifts and angles are re-scored, down to full resolution.
+        
+        Args:
+            mayocardial_mask (np.ndarray): Target mask
+            infarction_mask (np.ndarray): Mask to be aligned
+            mayocardium_center (Tuple[float, float]): Center point for rotation
+            search_range (int): Range of pixels to search around the pre-aligned offset
+            rotation_angles (np.ndarray): Array of rotation angles to try
+            pyramid_levels (int): Number of times the masks are downsampled by 2
+            candidates_per_level (int): Number of best candidates refined on the next level
+            
+        Returns:
+            Dict[str, Any]: Dictionary containing best alignment parameters
+        """
+        best_params = {'shift_x': 0, 'shift_y': 0, 'angle': 0, 'metrics': None}
+        rotation_angles = np.asarray(rotation_angles)
+        num_angles = len(rotation_angles)
+        base_x, base_y = self._centroid_pre_alignment(mayocardial_mask, infarction_mask)
+
+        # Do not downsample below roughly 16 pixels per side
+        h, w = infarction_mask.shape
+        max_levels = max(int(np.log2(max(min(h, w), 1) / 16)), 0)
+        pyramid = self._build_mask_pyramid(mayocardial_mask, infarction_mask,
+                                           min(pyramid_levels, max_levels))
+
+        evaluations = 0
+        full_resolution_evaluations = 0
+        candidates = None
+        for level in reversed(range(len(pyramid))):
+            factor = 2 ** level
+            mayocardial_level, infarction_level = pyramid[level]
+            center_level = (int(mayocardium_center[0] / factor), int(mayocardium_center[1] / factor))
+            x_bounds = (int(np.floor((base_x - search_range) / factor)), int(np.ceil((base_x + search_range) / factor)))
+            y_bounds = (int(np.floor((base_y - search_range) / factor)), int(np.ceil((base_y + search_range) / factor)))
+
+            if candidates is None:
+                # Coarsest level: the whole (downsampled) window and every angle
+                proposals = {
+                    (angle_idx, shift_x, shift_y)
+                    for shift_x in range(x_bounds[0], x_bounds[1] + 1)
+                    for shift_y in range(y_bounds[0], y_bounds[1] + 1)
+                    for angle_idx in range(num_angles)
+                }
+            else:
+                # Finer level: neighbours of the upsampled survivors
+                proposals = {
+                    ((angle_idx + d_angle) % num_angles,
+                     min(max(2 * shift_x + dx, x_bounds[0]), x_bounds[1]),
+                     min(max(2 * shift_y + dy, y_bounds[0]), y_bounds[1]))
+                    for _, angle_idx, shift_x, shift_y in candidates
+                    for d_angle in (-1, 0, 1)
+                    for dx in (-1, 0, 1)
+                    for dy in (-1, 0, 1)
+                }
+
+            scored = []
+            for angle_idx, shift_x, shift_y in proposals:
+                rotated_mask = self.rotate_mask_around_point(
+                    self.shift_mask(infarction_level, shift_x, shift_y),
+                    rotation_angles[angle_idx], center_level
+                )
+                dice = self.calculate_mask_correlation(rotated_mask, mayocardial_level)['dice_coefficient']
+                # Ties follow the exhaustive loop order: shift_x, shift_y, then angle
+                scored.append((-dice, shift_x, shift_y, angle_idx))
+            evaluations += len(scored)
+            if level == 0:
+                full_resolution_evaluations = len(scored)
+
+            scored.sort()
+            candidates = [(score, angle_idx, shift_x, shift_y)
+                          for score, shift_x, shift_y, angle_idx in scored[:candidates_per_level]]
+
+        exhaustive_evaluations = (2 * search_range + 1) ** 2 * num_angles
+        self._record_search_stats(evaluations, full_resolution_evaluations, exhaustive_evaluations)
+        logging.debug(f"Pyramid alignment: {evaluations} evaluations "
+                      f"({full_resolution_evaluations} at full resolution) "
+                      f"vs {exhaustive_evaluations} exhaustive")
+
+        score, angle_idx, shift_x, shift_y = candidates[0]
+        if -score <= 0:
+            return best_params
+
+        rotated_mask = self.rotate_mask_around_point(
+            self.shift_mask(infarction_mask, shift_x, shift_y),
+            rotation_angles[angle_idx],
+            (int(mayocardium_center[0]), int(mayocardium_center[1]))
+        )
+        return {
+            'shift_x': shift_x,
+            'shift_y': shift_y,
+            'angle': rotation_angles[angle_idx],
+            'metrics': self.calculate_mask_correlation(rotated_mask, mayocardial_mask)
+        }
+
+    @staticmethod
+    def _centroid_pre_alignment(mayocardial_mask: np.ndarray, infarction_mask: np.ndarray) -> Tuple[int, int]:
+        """
+        Calculate the shift that moves the infarction centroid onto the myocardium.
+        
+        Args:
+            mayocardial_mask (np.ndarray): Target mask
+            infarction_mask (np.ndarray): Mask to be aligned
+            
+        Returns:
+            Tuple[int, int]: (shift_x, shift_y) to the closest myocardial pixel, (0, 0) if
+                the centroid already lies on the myocardium or either mask is empty
+        """
+        infarction_points = np.argwhere(infarction_mask > 0)
+        mayocardial_points = np.argwhere(mayocardial_mask > 0)
+        if len(infarction_points) == 0 or len(mayocardial_points) == 0:
+            return 0, 0
+
+        centroid = infarction_points.mean(axis=0)
+        distances = np.sum((mayocardial_points - centroid) ** 2, axis=1)
+        target_y, target_x = mayocardial_points[np.argmin(distances)]
+        return int(round(target_x - centroid[1])), int(round(target_y - centroid[0]))
+
+    @staticmethod
+    def _build_mask_pyramid(mayocardial_mask: np.ndarray, infarction_mask: np.ndarray,
+                            levels: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Build binary mask pyramids, halving the resolution at each level.
+        
+        Args:
+            mayocardial_mask (np.ndarray): Target mask
+            infarction_mask (np.ndarray): Mask to be aligned
+            levels (int): Number of downsampled levels
+            
+        Returns:
+            List[Tuple[np.ndarray, np.ndarray]]: (mayocardial, infarction) masks, level 0 at full resolution
+        """
+        pyramid = [(mayocardial_mask, infarction_mask)]
+        h, w = infarction_mask.shape
+        for level in range(1, levels + 1):
+            factor = 2 ** level
+            size = (max(w // factor, 1), max(h // factor, 1))
+            pyramid.append(tuple(
+                (cv2.resize((mask > 0).astype(np.uint8) * 255, size, interpolation=cv2.INTER_AREA) >= 128).astype(np.uint8)
+                for mask in (mayocardial_mask, infarction_mask)
+            ))
+        return pyramid
+
+    def _record_search_stats(self, evaluations: int, full_resolution_evaluations: int,
+                             exhaustive_evaluations: int) -> None:
+        """
+        Store the evaluation counts of the latest search in `last_search_stats`.
+        
+        Args:
+            evaluations (int): Candidates scored by the search
+            full_resolution_evaluations (int): Candidates scored on full-resolution masks
+            exhaustive_evaluations (int): Size of the exhaustive (2 * search_range + 1)^2 x angles grid
+        """
+        self.last_search_stats = {
+            'evaluations': evaluations,
+            'full_resolution_evaluations': full_resolution_evaluations,
+            'exhaustive_evaluations': exhaustive_evaluations
+        }
+
+    def align(self, mayocardial_mask: np.ndarray, infarction_mask: np.ndarray,
+              mayocardium_center: Tuple[float, float],
+              search_range: int = 20,
+              rotation_angles: np.ndarray = np.arange(0, 360, 30),
+              alignment_method: str = 'exhaustive') -> Dict[str, Any]:
+        """
+        Find optimal alignment parameters with the selected search engine.
+        
+        Args:
+            mayocardial_mask (np.ndarray): Target mask
+            infarction_mask (np.ndarray): Mask to be aligned
+            mayocardium_center (Tuple[float, float]): Center point for rotation
+            search_range (int): Range of pixels to search for alignment
+            rotation_angles (np.ndarray): Array of rotation angles to try
+            alignment_method (str): One of `ALIGNMENT_METHODS`
+            
+        Returns:
+            Dict[str, Any]: Dictionary containing best alignment parameters
+        """
+        if alignment_method not in self.ALIGNMENT_METHODS:
+            raise ValueError(f"Unknown alignment method '{alignment_method}', "
+                             f"expected one of {list(self.ALIGNMENT_METHODS)}")
+        search = getattr(self, self.ALIGNMENT_METHODS[alignment_method])
+        return search(mayocardial_mask, infarction_mask, mayocardium_center, search_range, rotation_angles)
+
     def _get_merged_mask(self, mayocardial_mask: np.ndarray, infarction_mask: np.ndarray,
                         mayocardium_center: Tuple[float, float],
                         search_range: int = 20,
-                        rotation_angles: np.ndarray = np.arange(0, 360, 30), visualize_flag: bool = 1) -> np.ndarray:
+                        rotation_angles: np.ndarray = np.arange(0, 360, 30), visualize_flag: bool = 1,
+                        alignment_method: str = 'exhaustive',
+                        best_params: Dict[str, Any] = None) -> np.ndarray:
         """
         Align and merge two masks together.
         
@@ -203,21 +551,32 @@ class MaskAlignment:
             mayocardium_center (Tuple[float, float]): Center point for rotation
             search_range (int): Range of pixels to search for alignment
             rotation_angles (np.ndarray): Array of rotation angles to try
+            alignment_method (str): Alignment search engine ('exhaustive', 'fft' or 'pyramid')
+            best_params (Dict[str, Any]): Previously found alignment parameters; when given the
+                search is skipped and only the stored transform is applied
             
         Returns:
             np.ndarray: Final merged mask
         """
         # Find optimal alignment parameters
-        best_params = self.find_optimal_alignment(
-            mayocardial_mask, infarction_mask, mayocardium_center, search_range, rotation_angles
-        )
+        if best_params is None:
+            with profiler.stage('align'):
+                best_params = self.align(
+                    mayocardial_mask, infarction_mask, mayocardium_center, search_range, rotation_angles,
+                    alignment_method
+                )
+        else:
+            self._record_search_stats(0, 0, (2 * search_range + 1) ** 2 * len(rotation_angles))
+        self.last_best_params = best_params
         
         # Align the infarction mask
         shifted_mask = self.shift_mask(
             infarction_mask, best_params['shift_x'], best_params['shift_y']
         )
         # log the unique values of the shifted mask
-        logging.debug(f"Unique values in shifted mask: {np.unique(shifted_mask)}")
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        if debug:
+            logging.debug(f"Unique values in shifted mask: {np.unique(shifted_mask)}")
         
         aligned_infarction_mask = self.rotate_mask_around_point(
             shifted_mask, 
@@ -225,10 +584,12 @@ class MaskAlignment:
             (int(mayocardium_center[0]), int(mayocardium_center[1]))
         )
         # log the unique values of the aligned infarction mask
-        logging.debug(f"Unique values in aligned infarction mask: {np.unique(aligned_infarction_mask)}")
+        if debug:
+            logging.debug(f"Unique values in aligned infarction mask: {np.unique(aligned_infarction_mask)}")
         # Merge the maskse
         merged_mask = self._merge_masks(mayocardial_mask, aligned_infarction_mask)
-        logging.debug(f"Unique values in merged mask: {np.unique(merged_mask)}")
+        if debug:
+            logging.debug(f"Unique values in merged mask: {np.unique(merged_mask)}")
         
         # Visualize results
         if visualize_flag:
@@ -252,7 +613,8 @@ class MaskAlignment:
         # Create a binary mask of the mayocardial region
         mayocardial_region = (mayocardial_mask > 0).astype(np.uint8)
         # log the unique values of the aligned infarction mask
-        logging.debug(f"Unique values in aligned infarction mask: {np.unique(aligned_infarction_mask)}")
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f"Unique values in aligned infarction mask: {np.unique(aligned_infarction_mask)}")
         # Create the merged mask starting with the mayocardial mask
         merged_mask = mayocardial_mask.copy()
         
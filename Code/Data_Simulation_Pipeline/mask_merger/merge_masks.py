@@ -1,24 +1,27 @@
 from mask_merger.MaskAlignment import MaskAlignment
+from mask_merger.AlignmentCache import AlignmentCache
+from mask_merger.DonorIndex import DonorIndex
+from mask_extractor.SliceIndex import SliceIndex
+from mask_writer.MaskWriter import MaskWriter
+from mask_writer.RunManifest import RunManifest
+from instrumentation.Profiler import profiler
 from pathlib import Path
 import os
 import numpy as np
 import cv2
-from typing import Dict, List, Tuple, Any
-from mask_extractor.extract_masks import get_random_mask_slice, add_blood_pool_to_image
+from typing import Dict, List, Tuple, Any, Iterator, Sequence
+from mask_extractor.extract_masks import get_random_mask_slice, add_blood_pool_to_image, seed_random_generators
 import logging
 import time
-from datetime import datetime
-
-
-logging.basicConfig(level=logging.DEBUG, 
-                    format='%(asctime)s - %(levelname)s - %(message)s',
-                    filename='app.log',  # Save logs to a file
-                    filemode='w')  # Overwrite file on each run (use 'a' to append)
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
 
 
 def merge_masks(mayocardial_mask: np.ndarray, infarction_mask: np.ndarray, search_range: int = 10,
                  rotation_angles: np.ndarray = np.arange(0, 360, 30), visualize_flag: bool = 0,
-                   mayocardium_vlue: int =2, infarction_value: int = 3, no_flow_value: int = 4 ) -> np.ndarray:
+                   mayocardium_vlue: int =2, infarction_value: int = 3, no_flow_value: int = 4,
+                   alignment_method: str = 'exhaustive', search_stats: Dict[str, int] = None,
+                   alignment_cache: AlignmentCache = None, cache_key: str = None) -> np.ndarray:
     """
     Generate a merged mask by aligning the input masks.
 
@@ -28,6 +31,10 @@ def merge_masks(mayocardial_mask: np.ndarray, infarction_mask: np.ndarray, searc
         search_range (int): Search range for alignment
         rotation_angles (np.ndarray): Range of rotation angles to search
         visualize_flag (bool): Flag to visualize the alignment process
+        alignment_method (str): Alignment search engine ('exhaustive', 'fft' or 'pyramid')
+        search_stats (Dict[str, int]): Optional accumulator for the alignment evaluation counts
+        alignment_cache (AlignmentCache): Optional cache of alignment results
+        cache_key (str): Key of this slice pair in `alignment_cache`
     
     Returns:
         np.ndarray: Result of merging the input masks
@@ -38,69 +45,336 @@ def merge_masks(mayocardial_mask: np.ndarray, infarction_mask: np.ndarray, searc
     mask_alignment = MaskAlignment()
     mayocardium_center = mask_alignment.calculate_mask_rad_and_position(mayocardial_mask)[0]
     print("mayocardium_center", mayocardium_center)
-    # log the unique values of both of the masks
-    logging.debug(f"Unique values in mayocardial_mask: {np.unique(mayocardial_mask)}")
-    logging.debug(f"Unique values in infarction_mask: {np.unique(infarction_mask)}")
-    merged_mask = mask_alignment._get_merged_mask(mayocardial_mask, infarction_mask, mayocardium_center, search_range, rotation_angles, visualize_flag)
+    # log the unique values of both of the masks (np.unique is only worth running when it is logged)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"Unique values in mayocardial_mask: {np.unique(mayocardial_mask)}")
+        logging.debug(f"Unique values in infarction_mask: {np.unique(infarction_mask)}")
+    use_cache = alignment_cache is not None and cache_key is not None
+    cached_params = alignment_cache.get(cache_key) if use_cache else None
+    merged_mask = mask_alignment._get_merged_mask(mayocardial_mask, infarction_mask, mayocardium_center, search_range, rotation_angles, visualize_flag,
+                                                  alignment_method, best_params=cached_params)
+    if use_cache and cached_params is None:
+        alignment_cache.put(cache_key, mask_alignment.last_best_params)
+    if search_stats is not None:
+        for key, value in mask_alignment.last_search_stats.items():
+            search_stats[key] = search_stats.get(key, 0) + value
     processed_mask = mask_alignment.change_mask_pixel_values(mask= merged_mask, mayocardium_vlue= mayocardium_vlue, infarction_value= infarction_value, no_flow_value= no_flow_value)
     # log the values of the infarction and mayocardium value
     logging.debug(f"infarction_value: {infarction_value}, mayocardium_vlue: {mayocardium_vlue}, no_flow_value: {no_flow_value}")
-    logging.debug(f"Unique values in merged_mask: {np.unique(merged_mask)}")
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"Unique values in merged_mask: {np.unique(merged_mask)}")
     return processed_mask
 
 
-def generate_multible_merged_masks(all_masks: Dict[str, Any], number_of_masks: int, search_range, 
-                                   rotation_angles, visualize_flag, mayocardium_vlue: int = 2, infarction_value: int = 3, 
-                                   blood_pool_value: int =1, no_flow_value: int = 4 , output_dir : str = None) -> List[np.ndarray]:
+def _merge_single_mask(index: int, seed: int, all_masks: Dict[str, Any], search_range: int,
+                       rotation_angles: np.ndarray, visualize_flag: bool, mayocardium_vlue: int,
+                       infarction_value: int, blood_pool_value: int, no_flow_value: int,
+                       alignment_method: str, alignment_cache: AlignmentCache = None,
+                       donor_index: DonorIndex = None, donor_neighbours: int = 5,
+                       slice_index: SliceIndex = None) -> Tuple[np.ndarray, Dict[str, int]]:
     """
-    Generate a number of merged masks using the input masks.
+    Generate merged mask number `index` of a run from its own random stream.
     
     Args:
+        index (int): Index of the mask in the run
+        seed (int): Seed of the run
         all_masks (Dict[str, Any]): Dictionary containing all masks organized by case
-        number_of_masks (int): Number of merged masks to generate
-        search_range (int): Search range for alignment
-        rotation_angles (np.ndarray): Range of rotation angles to search
-        visualize_flag (bool): Flag to visualize the alignment process
-
+        alignment_cache (AlignmentCache): Optional cache of alignment results
+        donor_index (DonorIndex): Optional shape index for k-NN donor selection
+        slice_index (SliceIndex): Optional slice metadata to sample valid slices only
+        (remaining arguments as in `generate_multible_merged_masks`)
         
     Returns:
-        List[np.ndarray]: List of merged masks
+        Tuple[np.ndarray, Dict[str, int]]: Merged mask and its alignment and cache counters
     """
-    merged_masks = []
-    merged_directory_path ='merged_masks'
-    output_dir = os.path.join(output_dir, merged_directory_path)
-    # Ensure the directory exists
-    os.makedirs(output_dir, exist_ok=True)
+    seed_random_generators(seed, index)
+    search_stats = {}
 
-    
-    for _ in range(number_of_masks):
-        # Select two random masks
-        mayocardial_mask, blood_pool_mask = get_random_mask_slice(all_masks, 'mayocardium_masks')
-        infarction_mask, _ = get_random_mask_slice(all_masks, 'infarction_masks')
-        # Merge the masks
+    # Select two random masks
+    with profiler.stage('sample'):
+        mayocardial_mask, blood_pool_mask, mayocardium_location = get_random_mask_slice(
+            all_masks, 'mayocardium_masks', return_location=True, slice_index=slice_index)
+        donor_location = None
+        if donor_index is not None:
+            donor_location = donor_index.sample_donor(mayocardium_location, donor_neighbours)
+        if donor_location is not None:
+            infarction_location = donor_location
+            infarction_mask = all_masks[donor_location[0]]['infarction_masks'][donor_location[1]]
+        else:
+            infarction_mask, _, infarction_location = get_random_mask_slice(
+                all_masks, 'infarction_masks', return_location=True, slice_index=slice_index)
+    cache_key = AlignmentCache.make_key(mayocardium_location, infarction_location, search_range,
+                                        rotation_angles, alignment_method,
+                                        slices=(mayocardial_mask, infarction_mask))
+    cache_hits = alignment_cache.hits if alignment_cache is not None else 0
+
+    # Merge the masks
+    with profiler.stage('merge'):
         merged_mask = merge_masks(mayocardial_mask= mayocardial_mask, infarction_mask= infarction_mask,
                                    search_range= search_range, rotation_angles= rotation_angles,
                                      visualize_flag= visualize_flag, mayocardium_vlue= mayocardium_vlue, infarction_value= infarction_value,
-                                     no_flow_value= no_flow_value)
+                                     no_flow_value= no_flow_value, alignment_method= alignment_method,
+                                     search_stats= search_stats, alignment_cache= alignment_cache,
+                                     cache_key= cache_key)
         merged_mask = add_blood_pool_to_image(merged_mask, blood_pool_mask, blood_pool_value)
+
+    if alignment_cache is not None:
+        cache_hit = alignment_cache.hits > cache_hits
+        search_stats['cache_hits'] = int(cache_hit)
+        search_stats['cache_misses'] = int(not cache_hit)
+    search_stats['masks_with_infarction'] = int(
+        np.any((merged_mask == infarction_value) | (merged_mask == no_flow_value)))
+    return merged_mask, search_stats
+
+
+# Per-process state of the merge workers, set once by `_init_merge_worker`
+_worker_state = {}
+
+def _init_merge_worker(all_masks: Dict[str, Any], donor_index: DonorIndex,
+                       alignment_cache_path: str, alignment_cache_size: int,
+                       slice_index: SliceIndex = None, profiler_settings: Dict[str, bool] = None) -> None:
+    """
+    Initialize a merge worker process with the corpus and its own cache connection.
+    
+    Args:
+        all_masks (Dict[str, Any]): Dictionary containing all masks organized by case
+        donor_index (DonorIndex): Optional shape index for k-NN donor selection
+        alignment_cache_path (str): Optional path of the persistent alignment cache
+        alignment_cache_size (int): Maximum number of cached alignments
+        slice_index (SliceIndex): Optional slice metadata to sample valid slices only
+        profiler_settings (Dict[str, bool]): `Profiler.settings` of the main process
+    """
+    profiler.configure(**(profiler_settings or {}))
+    _worker_state['all_masks'] = all_masks
+    _worker_state['donor_index'] = donor_index
+    _worker_state['slice_index'] = slice_index
+    _worker_state['alignment_cache'] = (AlignmentCache(alignment_cache_path, alignment_cache_size)
+                                        if alignment_cache_path else None)
+
+def _merge_worker_task(index: int, seed: int, merge_settings: Dict[str, Any]) -> Tuple[np.ndarray, Dict[str, int]]:
+    """
+    Generate one merged mask inside a worker process.
+    
+    Args:
+        index (int): Index of the mask in the run
+        seed (int): Seed of the run
+        merge_settings (Dict[str, Any]): Keyword arguments of `_merge_single_mask`
         
-        merged_masks.append(merged_mask)
-        
-        # timestamp = time.strftime("%Y-%m-%d-%H-%M")
-        timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S-%f")
-        # calculate the precetage of infarction to mayocardium
-        # infarction_percentage = int(np.sum(merged_mask == infarction_value) / np.sum( merged_mask != 0) * 100)
+    Returns:
+        Tuple[np.ndarray, Dict[str, int]]: Merged mask and its counters, with the worker's
+            profiler snapshot under 'profile' while profiling
+    """
+    merged_mask, search_stats = _merge_single_mask(index, seed, _worker_state['all_masks'],
+                                                   alignment_cache=_worker_state['alignment_cache'],
+                                                   donor_index=_worker_state['donor_index'],
+                                                   slice_index=_worker_state['slice_index'], **merge_settings)
+    profile = profiler.drain()
+    if profile is not None:
+        search_stats['profile'] = profile
+    return merged_mask, search_stats
 
-        np.save(os.path.join(output_dir, f"real_real_{timestamp}.npy"), merged_mask)
-        cv2.imwrite(os.path.join(output_dir, f"real_real_{timestamp}.png"), merged_mask)
-        print(f"Merged mask {timestamp} saved successfully!")
 
+def _bounded_map(executor: ProcessPoolExecutor, function, items, max_in_flight: int, *arguments) -> Iterator[Any]:
+    """
+    Like `executor.map(function, items, repeat(argument), ...)`, but submitting lazily with at
+    most `max_in_flight` unfinished tasks, so results wait in memory only until they are consumed.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(function, item, *arguments))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def iter_merged_masks(all_masks: Dict[str, Any], number_of_masks: int, search_range,
+                      rotation_angles, visualize_flag, mayocardium_vlue: int = 2, infarction_value: int = 3,
+                      blood_pool_value: int = 1, no_flow_value: int = 4, output_dir: str = None,
+                      alignment_method: str = 'exhaustive', alignment_cache_path: str = None,
+                      alignment_cache_size: int = 10000, donor_index: DonorIndex = None,
+                      donor_neighbours: int = 5, workers: int = 1, seed: int = None,
+                      slice_index: SliceIndex = None, output_format: str = 'both',
+                      output_writers: int = 1, output_queue_size: int = 64,
+                      output_shard_size: int = 1024, mask_codec: str = None,
+                      indices: Sequence[int] = None, resume: bool = False,
+                      checkpoint_every: int = 100) -> Iterator[Tuple[str, np.ndarray]]:
+    """
+    Generate merged masks one at a time, in index order.
+
+    Nothing is kept after a mask is yielded and at most 2 x `workers` masks are generated
+    ahead, so memory does not grow with `number_of_masks`. The masks are also written to
+    `output_dir` unless `output_format` is 'none'; stopping early shuts the workers down and
+    waits for the masks already submitted to be written. The summaries are printed once
+    every mask was generated. A resumed run skips, and does not yield, the masks already
+    on disk.
 
-    # # Save the merged masks to the specified directory
-    # for i, merged_mask in enumerate(merged_masks):
-    #     cv2.imwrite(os.path.join(output_dir, f"merged_mask_{i}.png"), merged_mask)
-    #     # save as npy
-    #     np.save(os.path.join(output_dir, f"merged_mask_{i}.npy"), merged_mask)
-    #     print(f"Merged mask {i} saved successfully!")
+    Args:
+        (as in `generate_multible_merged_masks`)
+        output_format (str): Files written per mask, 'npy', 'png', 'both' or 'shards';
+            'none' only yields the masks
+        indices (Sequence[int]): Mask indices to generate, e.g. the `shard_indices` of one
+            shard of the run or single masks to regenerate; all of `range(number_of_masks)`
+            when None
+        resume (bool): Record the progress in a `RunManifest` and only generate the masks
+            not yet written by an earlier, interrupted run into the same `output_dir`
+        checkpoint_every (int): Written masks between two manifest updates
 
+    Yields:
+        Tuple[str, np.ndarray]: File name (without extension) and merged mask
+    """
+    search_stats = {}
+    donor_selection = 'knn' if donor_index is not None else 'random'
+    merge_settings = dict(search_range=search_range, rotation_angles=rotation_angles,
+                          visualize_flag=visualize_flag, mayocardium_vlue=mayocardium_vlue,
+                          infarction_value=infarction_value, blood_pool_value=blood_pool_value,
+                          no_flow_value=no_flow_value, alignment_method=alignment_method,
+                          donor_neighbours=donor_neighbours)
+    indices = range(number_of_masks) if indices is None else list(indices)
+    manifest = None
+    if output_format != 'none':
+        output_dir = os.path.join(output_dir, 'merged_masks')
+        # Ensure the directory exists
+        os.makedirs(output_dir, exist_ok=True)
+        if resume:
+            # Everything that changes the masks, a resumed run must match it
+            run_settings = dict(merge_settings, donor_selection=donor_selection, slice_index=slice_index is not None)
+            del run_settings['visualize_flag']
+            manifest = RunManifest.resume(output_dir, seed, number_of_masks, run_settings, output_format,
+                                          mask_codec, checkpoint_every)
+            seed = manifest.seed
+            remaining = [index for index in indices if index not in manifest.completed]
+            print(f"Resuming merged masks in {output_dir}: {len(indices) - len(remaining)} already written, "
+                  f"{len(remaining)} to generate")
+            indices = remaining
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    print(f"Merged masks seed: {seed}")
+    if visualize_flag and workers > 1:
+        logging.warning("visualize_flag needs the main process, generating merged masks with a single worker")
+        workers = 1
+    start_time = time.perf_counter()
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_merge_worker,
+                                       initargs=(all_masks, donor_index, alignment_cache_path, alignment_cache_size,
+                                                 slice_index, profiler.settings()))
+        results = _bounded_map(executor, _merge_worker_task, indices, 2 * workers,
+                               seed, merge_settings)
+    else:
+        executor = None
+        alignment_cache = AlignmentCache(alignment_cache_path, alignment_cache_size) if alignment_cache_path else None
+        results = (_merge_single_mask(index, seed, all_masks, alignment_cache=alignment_cache,
+                                      donor_index=donor_index, slice_index=slice_index, **merge_settings)
+                   for index in indices)
+
+    writer = None
+    if output_format != 'none':
+        writer = MaskWriter(output_format, output_writers, output_queue_size, output_shard_size,
+                            label_values=(0, blood_pool_value, mayocardium_vlue, infarction_value, no_flow_value),
+                            mask_codec=mask_codec, on_written=manifest.commit if manifest is not None else None)
+    try:
+        for index, (merged_mask, mask_stats) in zip(indices, results):
+            profiler.merge(mask_stats.pop('profile', None))
+            for key, value in mask_stats.items():
+                search_stats[key] = search_stats.get(key, 0) + value
+
+            # Named by index only, so mask i has the same name in every run, worker and shard
+            file_name = f"real_real_{index:06d}"
+            if writer is not None:
+                writer.submit(output_dir, file_name, merged_mask)
+                print(f"Merged mask {file_name} queued for writing")
+            yield file_name, merged_mask
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        elif alignment_cache is not None:
+            alignment_cache.close()
+        try:
+            if writer is not None:
+                # Waits for the queued masks to be written
+                writer.close()
+        finally:
+            if manifest is not None:
+                manifest.save()
+
+    elapsed = time.perf_counter() - start_time
+    for key, value in search_stats.items():
+        profiler.count(f"merge.{key}", value)
+    generated = len(indices)
+    profiler.count("merge.masks", generated)
+    print(f"Donor selection ({donor_selection}): {generated} masks in {elapsed:.1f}s "
+          f"({generated / max(elapsed, 1e-9):.2f} masks/s, {workers} workers), "
+          f"{search_stats.get('masks_with_infarction', 0)}/{generated} with infarction overlap")
+    if search_stats.get('evaluations'):
+        print(f"Alignment search ({alignment_method}): {search_stats['evaluations']} evaluations, "
+              f"{search_stats['full_resolution_evaluations']} at full resolution, "
+              f"vs {search_stats['exhaustive_evaluations']} for the exhaustive grid "
+              f"({search_stats['exhaustive_evaluations'] / max(search_stats['evaluations'], 1):.1f}x fewer)")
+    if alignment_cache_path:
+        print(f"Alignment cache: {search_stats.get('cache_hits', 0)} hits, "
+              f"{search_stats.get('cache_misses', 0)} misses")
+    if writer is not None:
+        writer.print_summary("Merged masks")
+
+
+def generate_multible_merged_masks(all_masks: Dict[str, Any], number_of_masks: int, search_range, 
+                                   rotation_angles, visualize_flag, mayocardium_vlue: int = 2, infarction_value: int = 3, 
+                                   blood_pool_value: int =1, no_flow_value: int = 4 , output_dir : str = None,
+                                   alignment_method: str = 'exhaustive', alignment_cache_path: str = None,
+                                   alignment_cache_size: int = 10000, donor_index: DonorIndex = None,
+                                   donor_neighbours: int = 5, workers: int = 1, seed: int = None,
+                                   slice_index: SliceIndex = None, output_format: str = 'both',
+                                   output_writers: int = 1, output_queue_size: int = 64,
+                                   output_shard_size: int = 1024, mask_codec: str = None,
+                                   indices: Sequence[int] = None, resume: bool = False, checkpoint_every: int = 100,
+                                   return_masks: bool = True) -> List[np.ndarray]:
+    """
+    Generate a number of merged masks using the input masks.
+    
+    Args:
+        all_masks (Dict[str, Any]): Dictionary containing all masks organized by case
+        number_of_masks (int): Number of merged masks to generate
+        search_range (int): Search range for alignment
+        rotation_angles (np.ndarray): Range of rotation angles to search
+        visualize_flag (bool): Flag to visualize the alignment process
+        alignment_method (str): Alignment search engine ('exhaustive', 'fft' or 'pyramid')
+        alignment_cache_path (str): Optional path of a persistent alignment cache shared between runs
+        alignment_cache_size (int): Maximum number of cached alignments
+        donor_index (DonorIndex): Optional shape index; when given the infarction donor is drawn from
+            the nearest neighbours of the myocardium slice instead of uniformly at random
+        donor_neighbours (int): Number of nearest donors to choose from
+        workers (int): Number of worker processes; 1 generates in the current process
+        seed (int): Seed of the run; mask i always gets the same random stream whatever
+            the number of workers. A random seed is drawn (and printed) when None
+        slice_index (SliceIndex): Optional slice metadata; when given only slices with
+            myocardium (and infarction for the donors) are sampled
+        output_format (str): Files written per mask, 'npy', 'png' or 'both', or 'shards' to write
+            compressed shards of `output_shard_size` masks (see `ShardedMaskDataset`)
+        output_writers (int): Background threads writing the masks (see `MaskWriter`); 0 writes inline
+        output_queue_size (int): Maximum number of masks waiting to be written
+        output_shard_size (int): Number of masks per shard for 'shards'
+        mask_codec (str): 'rle' or 'bitplanes' to write encoded .mask files instead of .npy files
+        indices (Sequence[int]): Mask indices to generate, all of `range(number_of_masks)` when None
+        resume (bool): Only generate the masks an earlier, interrupted run has not written yet
+            (see `RunManifest`)
+        checkpoint_every (int): Written masks between two manifest updates
+        return_masks (bool): Collect and return the masks; False keeps memory independent of
+            `number_of_masks` and returns an empty list
+        
+    Returns:
+        List[np.ndarray]: List of merged masks
+    """
+    merged_masks = []
+    for _, merged_mask in iter_merged_masks(
+            all_masks, number_of_masks, search_range, rotation_angles, visualize_flag,
+            mayocardium_vlue=mayocardium_vlue, infarction_value=infarction_value, blood_pool_value=blood_pool_value,
+            no_flow_value=no_flow_value, output_dir=output_dir, alignment_method=alignment_method,
+            alignment_cache_path=alignment_cache_path, alignment_cache_size=alignment_cache_size,
+            donor_index=donor_index, donor_neighbours=donor_neighbours, workers=workers, seed=seed,
+            slice_index=slice_index, output_format=output_format, output_writers=output_writers,
+            output_queue_size=output_queue_size, output_shard_size=output_shard_size, mask_codec=mask_codec,
+            indices=indices, resume=resume, checkpoint_every=checkpoint_every):
+        if return_masks:
+            merged_masks.append(merged_mask)
     return merged_masks
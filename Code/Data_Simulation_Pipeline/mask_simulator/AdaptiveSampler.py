@@ -0,0 +1,265 @@
+import time
+import numpy as np
+from typing import Dict, List, Tuple, Any, Optional
+
+
+class AdaptiveSampler:
+    """
+    Online tuning of the image generation parameters toward the accepted ratio bands.
+
+    The infarct-to-myocardium band is split into `ratio_bins` equal bins and image i
+    of a run is assigned to bin i % ratio_bins, so the accepted images cover the band
+    evenly. Every bin keeps its own `energy`, `number_of_seeds` and no-flow energy
+    ratio range, together with running means of the infarct and no-flow ratios its
+    attempts produced. When adaptation is on and a running mean leaves its band, every
+    attempt scales the parameters by (band middle / running mean) ** gain, limited to
+    one `step`: `energy` and `number_of_seeds` follow the infarct ratio, and the no-flow
+    energy ratio follows the no-flow ratio of the attempts whose infarct ratio fits.
+    The state an image was accepted with becomes the starting point of the next image
+    of that bin.
+    """
+
+    # Histogram bins of the observed infarct and no-flow ratios
+    HISTOGRAM_BINS = 20
+
+    def __init__(self, generation_settings: Dict[str, Any], ratio_limits: Dict[str, float],
+                 ratio_bins: int = 1, adaptive: bool = True, step: float = 0.15, gain: float = 0.5,
+                 smoothing: float = 0.1, max_scale: float = 4.0, log_every: int = 50):
+        """
+        Initialize the AdaptiveSampler.
+
+        Args:
+            generation_settings (Dict[str, Any]): Keyword arguments of `generate_cardiac_image`,
+                the tuned parameters start from their values here
+            ratio_limits (Dict[str, float]): Keyword arguments of `StatsCalculator.process_mask`
+            ratio_bins (int): Number of equal infarct-to-myocardium bins that get the same quota
+            adaptive (bool): Whether rejected attempts tune the parameters; with False only
+                the bin quotas and the acceptance logging are applied
+            step (float): Largest relative change of a parameter per attempt
+            gain (float): Exponent of the target to running mean ratio a parameter is scaled by
+            smoothing (float): Weight of the newest attempt in the running ratio means
+            max_scale (float): Largest factor a parameter may move away from its initial value
+            log_every (int): Print the acceptance rate every this many accepted images
+        """
+        if ratio_bins < 1:
+            raise ValueError(f"ratio_bins must be at least 1, got {ratio_bins}")
+        self.ratio_limits = ratio_limits
+        self.adaptive = adaptive
+        self.step = step
+        self.gain = gain
+        self.smoothing = smoothing
+        self.log_every = log_every
+        self.bin_edges = np.linspace(ratio_limits['infarct_to_myo_lower_limit'],
+                                     ratio_limits['infarct_to_myo_upper_limit'], ratio_bins + 1)
+
+        self.initial_settings = {
+            'energy': int(generation_settings['energy']),
+            'number_of_seeds': int(generation_settings['number_of_seeds']),
+            'no_flow_energy_ratio': tuple(float(ratio) for ratio in generation_settings['no_flow_energy_ratio'])
+        }
+        self.bounds = {
+            'energy': (max(1, int(self.initial_settings['energy'] / max_scale)),
+                       int(self.initial_settings['energy'] * max_scale)),
+            'number_of_seeds': (max(1, int(self.initial_settings['number_of_seeds'] / max_scale)),
+                                int(self.initial_settings['number_of_seeds'] * max_scale)),
+            'no_flow_energy_scale': (1 / max_scale, max_scale)
+        }
+        self.bin_states = [{'settings': dict(self.initial_settings), 'infarct_mean': None, 'noflow_mean': None}
+                           for _ in range(ratio_bins)]
+
+        self.infarct_histogram = np.zeros(self.HISTOGRAM_BINS, dtype=np.int64)
+        self.noflow_histogram = np.zeros(self.HISTOGRAM_BINS, dtype=np.int64)
+        self.bin_attempts = np.zeros(ratio_bins, dtype=np.int64)
+        self.bin_accepted = np.zeros(ratio_bins, dtype=np.int64)
+        self.errors = 0
+        self.history: List[Dict[str, float]] = []
+        self._window_start = (0, 0)
+        self._start_time = time.perf_counter()
+
+    @property
+    def ratio_bins(self) -> int:
+        return len(self.bin_states)
+
+    def target_bin(self, index: int) -> int:
+        """
+        Get the infarct ratio bin image number `index` of the run has to land in.
+        """
+        return index % self.ratio_bins
+
+    def bin_limits(self, bin_index: int) -> Dict[str, float]:
+        """
+        Get the `StatsCalculator.process_mask` limits of a bin.
+
+        Args:
+            bin_index (int): Index of the bin
+
+        Returns:
+            Dict[str, float]: Ratio limits with the infarct band narrowed to the bin
+        """
+        return dict(self.ratio_limits,
+                    infarct_to_myo_lower_limit=float(self.bin_edges[bin_index]),
+                    infarct_to_myo_upper_limit=float(self.bin_edges[bin_index + 1]))
+
+    def settings_for(self, bin_index: int) -> Dict[str, Any]:
+        """
+        Get the current tuned parameters of a bin.
+        """
+        return dict(self.bin_states[bin_index]['settings'])
+
+    def tuning(self, bin_index: int) -> Dict[str, Any]:
+        """
+        Get everything an accept/reject loop needs to tune a bin on its own.
+
+        The result only holds plain values so it can be sent to worker processes.
+
+        Args:
+            bin_index (int): Index of the bin
+
+        Returns:
+            Dict[str, Any]: Bin, ratio limits, starting state and tuning constants
+        """
+        return {
+            'bin': bin_index,
+            'ratio_limits': self.bin_limits(bin_index),
+            'state': dict(self.bin_states[bin_index], settings=self.settings_for(bin_index)),
+            'initial_settings': dict(self.initial_settings),
+            'bounds': self.bounds,
+            'adaptive': self.adaptive,
+            'step': self.step,
+            'gain': self.gain,
+            'smoothing': self.smoothing
+        }
+
+    @staticmethod
+    def _running_mean(mean: Optional[float], value: float, smoothing: float) -> float:
+        return value if mean is None else (1 - smoothing) * mean + smoothing * value
+
+    @staticmethod
+    def _scale_factor(mean: float, lower: float, upper: float, gain: float, step: float) -> float:
+        # No change while the running mean is inside the band, otherwise steer it to the middle
+        if lower < mean < upper:
+            return 1.0
+        return float(np.clip(((lower + upper) / 2 / max(mean, 1e-3)) ** gain, 1 - step, 1 + step))
+
+    @staticmethod
+    def update(tuning: Dict[str, Any], state: Dict[str, Any], stats: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Fold the ratios of an attempt into the running means and retune the settings.
+
+        Args:
+            tuning (Dict[str, Any]): Result of `tuning`
+            state (Dict[str, Any]): Settings and running ratio means the attempt was generated with
+            stats (Dict[str, Any]): Statistics of the attempt from `StatsCalculator.process_mask`
+
+        Returns:
+            Dict[str, Any]: State for the next attempt
+        """
+        if not tuning['adaptive']:
+            return state
+        limits, bounds, smoothing = tuning['ratio_limits'], tuning['bounds'], tuning['smoothing']
+        state = dict(state, settings=dict(state['settings']))
+        settings = state['settings']
+
+        state['infarct_mean'] = AdaptiveSampler._running_mean(
+            state['infarct_mean'], stats['infarct_to_myo'], smoothing)
+        factor = AdaptiveSampler._scale_factor(state['infarct_mean'], limits['infarct_to_myo_lower_limit'],
+                                               limits['infarct_to_myo_upper_limit'], tuning['gain'], tuning['step'])
+        for key in ('energy', 'number_of_seeds'):
+            low, high = bounds[key]
+            settings[key] = int(np.clip(round(settings[key] * factor), low, high))
+
+        # The no-flow ratio is only tuned on attempts whose infarction already fits
+        if not stats['has_significant_infarct']:
+            state['noflow_mean'] = AdaptiveSampler._running_mean(
+                state['noflow_mean'], stats['noflow_to_infarct'], smoothing)
+            factor = AdaptiveSampler._scale_factor(state['noflow_mean'], limits['noflow_to_infarct_lower_limit'],
+                                                   limits['noflow_to_infarct_upper_limit'], tuning['gain'],
+                                                   tuning['step'])
+            initial_low, initial_high = tuning['initial_settings']['no_flow_energy_ratio']
+            min_scale, max_scale = bounds['no_flow_energy_scale']
+            scale = float(np.clip(settings['no_flow_energy_ratio'][0] / initial_low * factor, min_scale, max_scale))
+            settings['no_flow_energy_ratio'] = (initial_low * scale, min(initial_high * scale, 1.0))
+        return state
+
+    def record(self, bin_index: int, observations: List[Tuple[float, Optional[float]]], errors: int,
+               accepted_state: Dict[str, Any]) -> None:
+        """
+        Record the attempts of one accepted image and keep the state it was accepted with.
+
+        Args:
+            bin_index (int): Bin of the image
+            observations (List[Tuple[float, Optional[float]]]): (infarct_to_myo, noflow_to_infarct)
+                of every attempt that got as far as a ratio check, the accepted one last;
+                noflow_to_infarct is None for attempts rejected before the no-flow regions exist
+            errors (int): Attempts that failed with an exception
+            accepted_state (Dict[str, Any]): Tuning state after the accepted attempt
+        """
+        self.record_attempts(bin_index, observations, errors)
+        self.bin_accepted[bin_index] += 1
+        if self.adaptive:
+            self.bin_states[bin_index] = dict(accepted_state)
+
+        accepted = int(self.bin_accepted.sum())
+        if self.log_every and accepted % self.log_every == 0:
+            self._log_progress()
+
+    def record_attempts(self, bin_index: int, observations: List[Tuple[float, Optional[float]]],
+                        errors: int = 0) -> None:
+        """
+        Record attempts for a bin without an accepted image, e.g. the attempts of a batch
+        that only landed in bins whose images are generated elsewhere.
+
+        Args:
+            bin_index (int): Bin the attempts count for
+            observations (List[Tuple[float, Optional[float]]]): Ratios of the attempts, as in `record`
+            errors (int): Attempts that failed with an exception
+        """
+        infarct_ratios = [infarct_to_myo for infarct_to_myo, _ in observations]
+        noflow_ratios = [noflow_to_infarct for _, noflow_to_infarct in observations if noflow_to_infarct is not None]
+        self.infarct_histogram += np.histogram(infarct_ratios, bins=self.HISTOGRAM_BINS, range=(0.0, 1.0))[0]
+        self.noflow_histogram += np.histogram(noflow_ratios, bins=self.HISTOGRAM_BINS, range=(0.0, 1.0))[0]
+        self.bin_attempts[bin_index] += len(observations) + errors
+        self.errors += errors
+
+    def acceptance_rate(self) -> float:
+        """
+        Get the fraction of all attempts so far that were accepted.
+        """
+        return float(self.bin_accepted.sum() / max(self.bin_attempts.sum(), 1))
+
+    def _log_progress(self) -> None:
+        """
+        Append the acceptance rate overall and since the last log to the history and print it.
+        """
+        attempts, accepted = int(self.bin_attempts.sum()), int(self.bin_accepted.sum())
+        window_attempts = attempts - self._window_start[0]
+        window_accepted = accepted - self._window_start[1]
+        entry = {
+            'elapsed': time.perf_counter() - self._start_time,
+            'attempts': attempts,
+            'accepted': accepted,
+            'acceptance_rate': self.acceptance_rate(),
+            'window_acceptance_rate': window_accepted / max(window_attempts, 1)
+        }
+        self.history.append(entry)
+        self._window_start = (attempts, accepted)
+        print(f"Acceptance after {entry['elapsed']:.1f}s: {entry['acceptance_rate']:.1%} overall, "
+              f"{entry['window_acceptance_rate']:.1%} over the last {window_attempts} attempts")
+
+    def print_summary(self) -> None:
+        """
+        Print the acceptance rate per bin, with the tuned settings when adaptive sampling is on.
+        """
+        title = "Adaptive sampler" if self.adaptive else "Sampler (adaptive sampling off)"
+        print(f"{title}: {int(self.bin_accepted.sum())} accepted of {int(self.bin_attempts.sum())} "
+              f"attempts ({self.acceptance_rate():.1%}), {self.errors} failed")
+        for bin_index in range(self.ratio_bins):
+            rate = self.bin_accepted[bin_index] / max(self.bin_attempts[bin_index], 1)
+            line = (f"- infarct ratio [{self.bin_edges[bin_index]:.2f}, {self.bin_edges[bin_index + 1]:.2f}]: "
+                    f"{self.bin_accepted[bin_index]} accepted ({rate:.1%})")
+            if self.adaptive:
+                settings = self.bin_states[bin_index]['settings']
+                low, high = settings['no_flow_energy_ratio']
+                line += (f", energy {settings['energy']}, seeds {settings['number_of_seeds']}, "
+                         f"no-flow energy ratio [{low:.3f}, {high:.3f}]")
+            print(line)
@@ -0,0 +1,341 @@
+from typing import Dict, Tuple, Any, Callable
+import numpy as np
+import cv2
+from mask_simulator.RegionGrower import RegionGrower
+from stats_calculator.stats_calculator import StatsCalculator
+
+# Intermediate pixel values of `ImageProcessor`
+MYOCARDIUM, BLOOD_POOL, INFARCTION, NO_FLOW = 150, 80, 255, 40
+# Seed points of every no-flow cluster, as in `ImageProcessor.add_no_flow`
+NO_FLOW_SEEDS = 10
+# Most channels of one OpenCV image (CV_CN_MAX, 128 since OpenCV 5), the filters run on up to this many masks per call
+MAX_CHANNELS = 128
+
+
+class BatchSimulator:
+    """
+    Simulated cardiac masks with infarctions and no-flow regions, generated N at a time.
+
+    Runs the stages of `generate_cardiac_image` for simulated myocardia on a whole
+    (N, H, W) stack instead of mask by mask:
+    - rings and cavities are drawn from squared distance maps and deformed with one batch
+      of random offsets
+    - the polar seed random walks of all masks are cumulative sums of one draw
+    - region growing of the infarctions and of the no-flow regions is one `RegionGrower`
+      call on a canvas of the masks stacked with a blank row between them, so no region
+      crosses into the next mask; connected components and cluster filtering use the
+      same canvas
+    - blurs and morphological operations treat the masks as the channels of one image
+    - recolouring is one lookup table and the ratios come from `StatsCalculator.process_masks`
+
+    The random draws differ from `generate_cardiac_image`, so a seed gives other masks
+    with the same distribution. With `ratio_limits` the infarct ratio is checked once the
+    infarct clusters are filtered, and the masks out of bounds are dropped before the
+    no-flow stage. Intermediate stacks are only kept when asked for.
+    """
+
+    def __init__(self, mayocardium_type: str = 'simulated', image_size: Tuple[int, int] = (250, 250),
+                 number_of_seeds: int = 80, energy: int = 30, max_radius_step: float = 2,
+                 max_theta_step: float = np.pi / 4, min_cluster_size: int = 70, min_no_flow_size: int = 30,
+                 ring_thick_max: int = 20, ring_thick_min: int = 15, show_plots: bool = False,
+                 background_color: int = 0, blood_pool_color: int = 1, mayocardium_color: int = 2,
+                 infarction_color: int = 3, no_flow_color: int = 4,
+                 no_flow_energy_ratio: Tuple[float, float] = (0.05, 0.2), early_rejection_margin: float = None):
+        """
+        Initialize the BatchSimulator with the settings of `generate_cardiac_image`.
+
+        Args:
+            mayocardium_type: Only 'simulated'; real myocardia differ in size and are
+                generated one at a time
+            show_plots: Ignored, callers plot the intermediates of `generate`
+            (remaining arguments as in `generate_cardiac_image`)
+        """
+        if mayocardium_type != 'simulated':
+            raise ValueError(f"The batched engine only simulates myocardia, not '{mayocardium_type}'")
+        self.image_size = tuple(image_size)
+        self.number_of_seeds = number_of_seeds
+        self.energy = energy
+        self.max_radius_step = max_radius_step
+        self.max_theta_step = max_theta_step
+        self.min_cluster_size = min_cluster_size
+        self.min_no_flow_size = min_no_flow_size
+        self.ring_thick_max = ring_thick_max
+        self.ring_thick_min = ring_thick_min
+        self.no_flow_energy_ratio = tuple(no_flow_energy_ratio)
+        self.early_rejection_margin = early_rejection_margin
+        self.stats_calculator = StatsCalculator(infarction_val=infarction_color, myocardium_val=mayocardium_color,
+                                                no_flow_val=no_flow_color)
+        # Same result as the chain of replacements at the end of `generate_cardiac_image`
+        color_table = np.arange(256)
+        for value, color in ((0, background_color), (INFARCTION, infarction_color), (NO_FLOW, no_flow_color),
+                             (MYOCARDIUM, mayocardium_color), (BLOOD_POOL, blood_pool_color)):
+            color_table[color_table == value] = color
+        self.color_table = color_table.astype(np.uint8)
+        self.region_grower = RegionGrower()
+        self.close_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (8, 8))
+        self.no_flow_close_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (8, 8))
+        self.no_flow_erode_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (7, 7))
+
+    def generate(self, count: int, ratio_limits: Dict[str, float] = None,
+                 return_intermediates: bool = False) -> Tuple[np.ndarray, Dict[str, Any]]:
+        """
+        Generate a stack of masks.
+
+        Args:
+            count: Number of masks to draw
+            ratio_limits: Keyword arguments of `StatsCalculator.process_masks`; when given,
+                masks over the upper infarct limit (or under the lower limit lowered by
+                `early_rejection_margin`, when set) are dropped before the no-flow stage and
+                the statistics are computed
+            return_intermediates: Also return the intermediate stacks of the kept masks
+
+        Returns:
+            Tuple containing:
+                - (M, H, W) uint8 masks that passed the infarct check, M <= count
+                - 'stats': `StatsCalculator.process_masks` of the masks (None without limits),
+                  'rejected_infarct_to_myo': infarct ratios of the dropped masks and, when asked,
+                  'intermediates': the stacks of `generate_cardiac_image`'s results
+        """
+        if count <= 0:
+            # Nothing to grow; the region growing and tiling need at least one mask
+            empty = np.zeros((0, *self.image_size), dtype=np.uint8)
+            info = {
+                'stats': self.stats_calculator.process_masks(empty, **ratio_limits) if ratio_limits else None,
+                'rejected_infarct_to_myo': np.empty(0)
+            }
+            if return_intermediates:
+                info['intermediates'] = {key: empty.astype(bool) if key == 'infarction_mask' else empty
+                                         for key in ('original_image', 'output_array', 'infarction_mask',
+                                                     'closed_output', 'filtered_output', 'no_flow_image',
+                                                     'filtered_no_flow', 'final_image')}
+            return empty, info
+
+        array = self.draw_myocardia(count)
+        myocardium = array == MYOCARDIUM
+        output_array = np.copy(array)
+        image_ids, rows, columns = self.generate_seeds(array)
+        output_array[self._grow(image_ids, rows, columns, self.energy, myocardium)] = INFARCTION
+        closed_output = self._per_channel(
+            lambda channels: cv2.GaussianBlur(cv2.morphologyEx(channels, cv2.MORPH_CLOSE, self.close_kernel),
+                                              (5, 5), sigmaX=2),
+            (output_array == INFARCTION).astype(np.uint8))
+        filtered_output = self.filter_clusters_by_size(closed_output, self.min_cluster_size)
+
+        kept = np.arange(count)
+        rejected_ratios = np.empty(0)
+        if ratio_limits is not None:
+            infarct_pixels = np.count_nonzero(filtered_output == 255, axis=(1, 2))
+            myocardium_pixels = np.count_nonzero(myocardium & (filtered_output != 255), axis=(1, 2))
+            total = infarct_pixels + myocardium_pixels
+            infarct_to_myo = np.divide(infarct_pixels, total, out=np.zeros(count), where=total > 0)
+            # No-flow can only raise the infarct ratio, so the upper limit is final
+            passed = infarct_to_myo < ratio_limits['infarct_to_myo_upper_limit']
+            if self.early_rejection_margin is not None:
+                passed &= infarct_to_myo > ratio_limits['infarct_to_myo_lower_limit'] - self.early_rejection_margin
+            rejected_ratios = infarct_to_myo[~passed]
+            kept = kept[passed]
+
+        no_flow_image = self.add_no_flow(filtered_output[kept])
+        filtered_no_flow = self.filter_clusters_by_size(no_flow_image, self.min_no_flow_size)
+        final_image = np.copy(array[kept])
+        final_image[filtered_output[kept] == 255] = INFARCTION
+        final_image[filtered_no_flow == 255] = NO_FLOW
+        final_image = self.color_table[final_image]
+
+        info = {
+            'stats': self.stats_calculator.process_masks(final_image, **ratio_limits) if ratio_limits else None,
+            'rejected_infarct_to_myo': rejected_ratios
+        }
+        if return_intermediates:
+            info['intermediates'] = {
+                'original_image': array[kept],
+                'output_array': output_array[kept],
+                'infarction_mask': output_array[kept] == INFARCTION,
+                'closed_output': closed_output[kept],
+                'filtered_output': filtered_output[kept],
+                'no_flow_image': no_flow_image,
+                'filtered_no_flow': filtered_no_flow,
+                'final_image': final_image
+            }
+        return final_image, info
+
+    def draw_myocardia(self, count: int) -> np.ndarray:
+        """
+        Draw deformed rings (150) with offset cavities (80) around the image centers.
+
+        Returns:
+            np.ndarray: (count, H, W) uint8 stack
+        """
+        height, width = self.image_size
+        size = min(height, width)
+        outer_radius = np.random.randint(size // 4, size // 3 + 1, size=count)[:, None, None]
+        thickness = np.random.randint(self.ring_thick_min, self.ring_thick_max + 1, size=count)[:, None, None]
+        half = self.ring_thick_min // 2
+        cavity_offset = np.random.randint(-half, half + 1, size=(2, count, 1, 1))
+        rows = np.arange(height)[None, :, None]
+        columns = np.arange(width)[None, None, :]
+
+        # Thick circle outline as drawn by cv2.circle: |distance - radius| <= thickness / 2
+        distance = (columns - width // 2) ** 2 + (rows - height // 2) ** 2
+        ring = ((distance >= np.maximum(outer_radius - thickness / 2, 0) ** 2) &
+                (distance <= (outer_radius + thickness / 2) ** 2))
+        cavity_distance = ((columns - width // 2 - cavity_offset[0]) ** 2 +
+                           (rows - height // 2 - cavity_offset[1]) ** 2)
+        cavity = cavity_distance <= (outer_radius - thickness // 2) ** 2
+
+        array = np.zeros((count, height, width), dtype=np.uint8)
+        array[self._blur_mask(self.apply_random_deformation(ring, max_offset=1))] = MYOCARDIUM
+        array[self._blur_mask(self.apply_random_deformation(cavity, max_offset=3))] = BLOOD_POOL
+        return array
+
+    @staticmethod
+    def apply_random_deformation(masks: np.ndarray, max_offset: int) -> np.ndarray:
+        """
+        Move every foreground pixel of a boolean stack by an independent offset, clipped to its mask.
+        """
+        count, height, width = masks.shape
+        deformed = np.zeros_like(masks)
+        image_ids, ys, xs = np.nonzero(masks)
+        offsets = np.random.randint(-max_offset, max_offset + 1, size=(2, len(ys)))
+        deformed[image_ids, np.clip(ys + offsets[1], 0, height - 1), np.clip(xs + offsets[0], 0, width - 1)] = True
+        return deformed
+
+    def _blur_mask(self, masks: np.ndarray) -> np.ndarray:
+        # Pixels the 9x9 Gaussian blur of a 255 mask leaves above zero
+        return self._per_channel(lambda channels: cv2.GaussianBlur(channels, (9, 9), 0),
+                                 masks.astype(np.uint8) * 255) > 0
+
+    def generate_seeds(self, array: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Run the polar seed random walk of `ImageProcessor.generate_seeds` for every mask.
+
+        Each walk starts at a random myocardium pixel and circles the myocardium center;
+        only the steps landing on myocardium become seeds.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: Mask, row and column of every seed
+        """
+        count, height, width = array.shape
+        myocardium = array == MYOCARDIUM
+        pixels = np.count_nonzero(myocardium, axis=(1, 2))
+        image_ids, rows, columns = np.nonzero(myocardium)
+        first_pixel = np.r_[0, np.cumsum(pixels)[:-1]]
+        has_myocardium = pixels > 0
+        pick = np.where(has_myocardium, first_pixel + (np.random.random(count) * pixels).astype(np.int64), 0)
+        center_x = np.bincount(image_ids, weights=rows, minlength=count) / np.maximum(pixels, 1)
+        center_y = np.bincount(image_ids, weights=columns, minlength=count) / np.maximum(pixels, 1)
+        if not len(rows):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        # Polar coordinates of the start, with rows as x as in `ImageProcessor.cartesian_to_polar`
+        dx, dy = rows[pick] - center_x, columns[pick] - center_y
+        steps = (count, self.number_of_seeds - 1)
+        radius = np.hypot(dx, dy)[:, None] + np.cumsum(
+            np.random.uniform(-self.max_radius_step, self.max_radius_step, size=steps), axis=1)
+        theta = np.arctan2(dy, dx)[:, None] + np.cumsum(
+            np.random.uniform(-self.max_theta_step, self.max_theta_step, size=steps), axis=1)
+        seed_rows = np.trunc(center_x[:, None] + radius * np.cos(theta)).astype(np.int64)
+        seed_columns = np.trunc(center_y[:, None] + radius * np.sin(theta)).astype(np.int64)
+        seed_images = np.broadcast_to(np.arange(count)[:, None], steps)
+
+        valid = ((seed_rows >= 0) & (seed_rows < height) & (seed_columns >= 0) & (seed_columns < width) &
+                 has_myocardium[:, None])
+        valid[valid] = myocardium[seed_images[valid], seed_rows[valid], seed_columns[valid]]
+        return seed_images[valid], seed_rows[valid], seed_columns[valid]
+
+    def filter_clusters_by_size(self, masks: np.ndarray, min_size: int) -> np.ndarray:
+        """
+        Keep the 8-connected clusters of at least `min_size` pixels of every mask, as 255.
+        """
+        if not len(masks):
+            return np.zeros_like(masks)
+        _, labels, stats, _ = cv2.connectedComponentsWithStats(self._tile(masks), connectivity=8)
+        keep = np.where(stats[:, cv2.CC_STAT_AREA] >= min_size, 255, 0).astype(np.uint8)
+        keep[0] = 0
+        return self._untile(keep[labels], len(masks))
+
+    def add_no_flow(self, filtered_output: np.ndarray) -> np.ndarray:
+        """
+        Spread no-flow regions inside random infarct clusters, as `ImageProcessor.add_no_flow`.
+
+        Every mask with clusters gets between one and all of them, chosen at random; each
+        chosen cluster grows from `NO_FLOW_SEEDS` distinct random pixels with an energy of
+        a random share of its area.
+
+        Returns:
+            np.ndarray: (N, H, W) uint8 stack, 1 on the closed and eroded no-flow regions
+        """
+        count, height, width = filtered_output.shape
+        if not count:
+            return np.zeros_like(filtered_output)
+        num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(self._tile(filtered_output), connectivity=8)
+        # Every cluster lies inside one mask of the canvas
+        cluster_image = stats[1:, cv2.CC_STAT_TOP] // (height + 1)
+        clusters_per_image = np.bincount(cluster_image, minlength=count)
+        chosen_per_image = np.zeros(count, dtype=np.int64)
+        has_clusters = clusters_per_image > 0
+        chosen_per_image[has_clusters] = np.random.randint(1, clusters_per_image[has_clusters] + 1)
+        chosen = np.zeros(num_labels, dtype=bool)
+        chosen[1:] = self._random_rank(cluster_image) < chosen_per_image[cluster_image]
+
+        flat_labels = labels.ravel()
+        pixels = np.flatnonzero(chosen[flat_labels])
+        seeds = pixels[self._random_rank(flat_labels[pixels]) < NO_FLOW_SEEDS]
+        cluster_energy = (np.random.uniform(*self.no_flow_energy_ratio, size=num_labels) *
+                          stats[:, cv2.CC_STAT_AREA]).astype(np.int64)
+        painted = self.region_grower.grow(np.stack([seeds // width, seeds % width], axis=1),
+                                          cluster_energy[flat_labels[seeds]], chosen[labels])
+
+        return self._per_channel(
+            lambda channels: cv2.erode(cv2.morphologyEx(channels, cv2.MORPH_CLOSE, self.no_flow_close_kernel),
+                                       self.no_flow_erode_kernel),
+            self._untile(painted.astype(np.uint8), count))
+
+    def _grow(self, image_ids: np.ndarray, rows: np.ndarray, columns: np.ndarray, energy, paintable: np.ndarray) -> np.ndarray:
+        # One region growing run for the whole stack on its canvas
+        count, height, _ = paintable.shape
+        seeds = np.stack([image_ids * (height + 1) + rows, columns], axis=1)
+        return self._untile(self.region_grower.grow(seeds, energy, self._tile(paintable)), count)
+
+    @staticmethod
+    def _random_rank(groups: np.ndarray) -> np.ndarray:
+        """
+        Rank every element among the elements of its group, in a random order.
+        """
+        if not len(groups):
+            return np.empty(0, dtype=np.int64)
+        order = np.lexsort((np.random.random(len(groups)), groups))
+        sorted_groups = groups[order]
+        group_start = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order)) - np.repeat(group_start, np.diff(np.r_[group_start, len(order)]))
+        return rank
+
+    @staticmethod
+    def _tile(masks: np.ndarray) -> np.ndarray:
+        """
+        Stack the masks into one (N * (H + 1), W) canvas with a blank row after each.
+        """
+        count, height, width = masks.shape
+        canvas = np.zeros((count, height + 1, width), dtype=masks.dtype)
+        canvas[:, :height] = masks
+        return canvas.reshape(count * (height + 1), width)
+
+    @staticmethod
+    def _untile(canvas: np.ndarray, count: int) -> np.ndarray:
+        """
+        Split a canvas of `_tile` back into its (N, H, W) masks.
+        """
+        return canvas.reshape(count, -1, canvas.shape[1])[:, :-1]
+
+    @staticmethod
+    def _per_channel(function: Callable[[np.ndarray], np.ndarray], masks: np.ndarray) -> np.ndarray:
+        """
+        Apply an OpenCV filter to every mask of a stack, passing the masks as channels.
+        """
+        count, height, width = masks.shape
+        filtered = np.empty_like(masks)
+        for start in range(0, count, MAX_CHANNELS):
+            channels = np.ascontiguousarray(np.moveaxis(masks[start:start + MAX_CHANNELS], 0, -1))
+            filtered[start:start + MAX_CHANNELS] = np.moveaxis(function(channels).reshape(height, width, -1), -1, 0)
+        return filtered
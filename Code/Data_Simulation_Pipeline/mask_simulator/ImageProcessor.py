@@ -4,6 +4,7 @@ import cv2
 import random
 import logging
 import time
+from mask_simulator.RegionGrower import RegionGrower
 
 class ImageProcessor:
     """
@@ -11,9 +12,29 @@ class ImageProcessor:
     particularly focused on cardiac-like features.
     """
 
-    def __init__(self):
-        """Initialize the ImageProcessor."""
-        pass
+    # Implementations selectable through `deformation_method` and `region_growing_method`
+    DEFORMATION_METHODS = ('vectorized', 'loop')
+    REGION_GROWING_METHODS = ('frontier', 'queue')
+
+    def __init__(self, deformation_method: str = 'vectorized', region_growing_method: str = 'frontier'):
+        """
+        Initialize the ImageProcessor.
+        
+        Args:
+            deformation_method (str): 'vectorized' (default) or the per-pixel 'loop'
+                implementation of `apply_random_deformation`
+            region_growing_method (str): 'frontier' (default, `RegionGrower`) or the list-based
+                'queue' implementation of `spread_region_with_bias` and `add_no_flow`
+        """
+        if deformation_method not in self.DEFORMATION_METHODS:
+            raise ValueError(f"Unknown deformation method '{deformation_method}', "
+                             f"expected one of {self.DEFORMATION_METHODS}")
+        if region_growing_method not in self.REGION_GROWING_METHODS:
+            raise ValueError(f"Unknown region growing method '{region_growing_method}', "
+                             f"expected one of {self.REGION_GROWING_METHODS}")
+        self.deformation_method = deformation_method
+        self.region_growing_method = region_growing_method
+        self.region_grower = RegionGrower()
 
     # ----------------------
     # Basic Image Operations
@@ -36,6 +57,34 @@ class ImageProcessor:
         """
         Apply random deformation to a binary mask.
         
+        Every foreground pixel is moved by an independent uniform offset in
+        [-max_offset, max_offset] on both axes, clipped to the image. All offsets are
+        drawn in one batch and scattered at once; as in the per-pixel loop, pixels
+        visited later in row-major order win when several land on the same spot.
+        
+        Args:
+            mask (np.ndarray): Binary mask to deform
+            max_offset (int): Maximum pixel shift in both directions
+        
+        Returns:
+            np.ndarray: Deformed mask
+        """
+        if self.deformation_method == 'loop':
+            return self._apply_random_deformation_loop(mask, max_offset)
+
+        deformation_mask = np.zeros_like(mask)
+        height, width = mask.shape
+        ys, xs = np.nonzero(mask)
+        offsets = np.random.randint(-max_offset, max_offset + 1, size=(2, len(ys)))
+        new_x = np.clip(xs + offsets[0], 0, width - 1)
+        new_y = np.clip(ys + offsets[1], 0, height - 1)
+        deformation_mask[new_y, new_x] = mask[ys, xs]
+        return deformation_mask
+
+    def _apply_random_deformation_loop(self, mask: np.ndarray, max_offset: int = 5) -> np.ndarray:
+        """
+        Per-pixel reference implementation of `apply_random_deformation`.
+        
         Args:
             mask (np.ndarray): Binary mask to deform
             max_offset (int): Maximum pixel shift in both directions
@@ -246,6 +295,27 @@ class ImageProcessor:
         """
         Spread region from seeds using biased random walk.
         
+        Args:
+            selected_seeds: List of seed points
+            energy: Initial energy for spreading
+            array: Input image array
+        
+        Returns:
+            np.ndarray: Array with spread regions
+        """
+        if self.region_growing_method == 'queue':
+            return self._spread_region_with_bias_queue(selected_seeds, energy, array)
+
+        output_array = np.copy(array)
+        painted = self.region_grower.grow(np.reshape(selected_seeds, (-1, 2)), energy, array == 150)
+        output_array[painted] = 255
+        return output_array
+
+    def _spread_region_with_bias_queue(self, selected_seeds: List[Tuple[int, int]],
+                                       energy: int, array: np.ndarray) -> np.ndarray:
+        """
+        List-queue reference implementation of `spread_region_with_bias`.
+        
         Args:
             selected_seeds: List of seed points
             energy: Initial energy for spreading
@@ -338,7 +408,8 @@ class ImageProcessor:
         return image
 
     def add_no_flow(self, image: np.ndarray, value_to_be_set: int = 20, 
-                    number_of_seeds: int = 10) -> np.ndarray:
+                    number_of_seeds: int = 10,
+                    energy_ratio_range: Tuple[float, float] = (0.05, 0.2)) -> np.ndarray:
         """
         Add no-flow regions to the image.
         
@@ -346,6 +417,8 @@ class ImageProcessor:
             image: Input image
             value_to_be_set: Pixel value for no-flow regions
             number_of_seeds: Number of seed points per cluster
+            energy_ratio_range: Range the spreading energy of a cluster is drawn from,
+                relative to the cluster area
         
         Returns:
             np.ndarray: Image with no-flow regions
@@ -366,36 +439,12 @@ class ImageProcessor:
             
             # Process each selected cluster
             for cluster in selected_clusters:
-                cluster_coordinates = np.argwhere(labels == cluster)
-                selected_points = random.sample(list(cluster_coordinates), number_of_seeds)
-                
-                # Calculate energy based on cluster size
-                energy_ratio = random.uniform(0.05, 0.2)
-                relative_energy = int(energy_ratio * len(cluster_coordinates))
-                
-                # Spread no-flow region
-                queue = [(point[0], point[1], relative_energy) for point in selected_points]
-                while queue:
-                    x, y, e = queue.pop(0)
-                    if e <= 0:
-                        continue
-                        
-                    output_array[x, y] = value_to_be_set
-                    directions = [(-1, 0), (1, 0), (0, -1), (0, 1)]
-                    chosen_directions = random.choices(
-                        directions, 
-                        weights=[0.3, 0.2, 0.2, 0.2], 
-                        k=2
-                    )
-                    
-                    for dx, dy in chosen_directions:
-                        nx, ny = x + dx, y + dy
-                        if (0 <= nx < output_array.shape[0] and 
-                            0 <= ny < output_array.shape[1] and 
-                            labels[nx, ny] == cluster and 
-                            output_array[nx, ny] == 255):
-                            new_energy = e - random.randint(1, 3)
-                            queue.append((nx, ny, new_energy))
+                if self.region_growing_method == 'queue':
+                    self._spread_no_flow_cluster_queue(output_array, labels, cluster,
+                                                       number_of_seeds, value_to_be_set, energy_ratio_range)
+                else:
+                    self._spread_no_flow_cluster(output_array, labels, stats, cluster,
+                                                 number_of_seeds, value_to_be_set, energy_ratio_range)
             
             # Post-processing
             closed_output = cv2.morphologyEx(
@@ -407,4 +456,85 @@ class ImageProcessor:
         kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (7, 7))
         eroded_output = cv2.erode(closed_output, kernel)
         
-        return eroded_output
\ No newline at end of file
+        return eroded_output
+
+    def _spread_no_flow_cluster(self, output_array: np.ndarray, labels: np.ndarray, stats: np.ndarray,
+                                cluster: int, number_of_seeds: int, value_to_be_set: int,
+                                energy_ratio_range: Tuple[float, float] = (0.05, 0.2)) -> None:
+        """
+        Spread a no-flow region inside one infarction cluster, in place.
+        
+        Only the bounding box of the cluster is scanned, and the spreading runs on the
+        shared `RegionGrower`.
+        
+        Args:
+            output_array: Image the no-flow pixels are painted into
+            labels: Connected component labels of the infarction clusters
+            stats: Connected component statistics from `cv2.connectedComponentsWithStats`
+            cluster: Label of the cluster
+            number_of_seeds: Number of seed points in the cluster
+            value_to_be_set: Pixel value for no-flow regions
+            energy_ratio_range: Range of the spreading energy relative to the cluster area
+        """
+        x, y = stats[cluster, cv2.CC_STAT_LEFT], stats[cluster, cv2.CC_STAT_TOP]
+        w, h = stats[cluster, cv2.CC_STAT_WIDTH], stats[cluster, cv2.CC_STAT_HEIGHT]
+        output_box = output_array[y:y + h, x:x + w]
+        cluster_box = labels[y:y + h, x:x + w] == cluster
+
+        cluster_coordinates = np.argwhere(cluster_box)
+        selected_points = cluster_coordinates[
+            np.random.choice(len(cluster_coordinates), number_of_seeds, replace=False)
+        ]
+        
+        # Calculate energy based on cluster size
+        energy_ratio = random.uniform(*energy_ratio_range)
+        relative_energy = int(energy_ratio * stats[cluster, cv2.CC_STAT_AREA])
+        
+        # Spread no-flow region over the still untouched infarction pixels
+        painted = self.region_grower.grow(selected_points, relative_energy, cluster_box & (output_box == 255))
+        output_box[painted] = value_to_be_set
+
+    def _spread_no_flow_cluster_queue(self, output_array: np.ndarray, labels: np.ndarray, cluster: int,
+                                      number_of_seeds: int, value_to_be_set: int,
+                                      energy_ratio_range: Tuple[float, float] = (0.05, 0.2)) -> None:
+        """
+        List-queue reference implementation of `_spread_no_flow_cluster`.
+        
+        Args:
+            output_array: Image the no-flow pixels are painted into
+            labels: Connected component labels of the infarction clusters
+            cluster: Label of the cluster
+            number_of_seeds: Number of seed points in the cluster
+            value_to_be_set: Pixel value for no-flow regions
+            energy_ratio_range: Range of the spreading energy relative to the cluster area
+        """
+        cluster_coordinates = np.argwhere(labels == cluster)
+        selected_points = random.sample(list(cluster_coordinates), number_of_seeds)
+        
+        # Calculate energy based on cluster size
+        energy_ratio = random.uniform(*energy_ratio_range)
+        relative_energy = int(energy_ratio * len(cluster_coordinates))
+        
+        # Spread no-flow region
+        queue = [(point[0], point[1], relative_energy) for point in selected_points]
+        while queue:
+            x, y, e = queue.pop(0)
+            if e <= 0:
+                continue
+                
+            output_array[x, y] = value_to_be_set
+            directions = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+            chosen_directions = random.choices(
+                directions, 
+                weights=[0.3, 0.2, 0.2, 0.2], 
+                k=2
+            )
+            
+            for dx, dy in chosen_directions:
+                nx, ny = x + dx, y + dy
+                if (0 <= nx < output_array.shape[0] and 
+                    0 <= ny < output_array.shape[1] and 
+                    labels[nx, ny] == cluster and 
+                    output_array[nx, ny] == 255):
+                    new_energy = e - random.randint(1, 3)
+                    queue.append((nx, ny, new_energy))
@@ -1,17 +1,85 @@
 from pathlib import Path
 import os
+import itertools
 import numpy as np
 import cv2
 import matplotlib.pyplot as plt
-from typing import Dict, List, Tuple, Any
+from typing import Dict, List, Tuple, Any, Iterator, Optional, Sequence
 from mask_simulator.ImageProcessor import ImageProcessor
-from  mask_extractor.extract_masks import get_random_mask_slice, add_blood_pool_to_image
+from  mask_extractor.extract_masks import get_random_mask_slice, add_blood_pool_to_image, seed_random_generators
 import logging
 import time
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from stats_calculator.stats_calculator import StatsCalculator
+from mask_extractor.SliceIndex import SliceIndex
+from mask_writer.MaskWriter import MaskWriter
+from mask_writer.RunManifest import RunManifest
+from mask_simulator.AdaptiveSampler import AdaptiveSampler
+from mask_simulator.BatchSimulator import BatchSimulator
+from instrumentation.Profiler import profiler
 
 
+# Where an attempt can be rejected: the two staged checks inside `generate_cardiac_image`,
+# the final check on the finished image and attempts that failed with an exception
+REJECTION_STAGES = ('infarct', 'no_flow', 'final', 'error')
+
+# 'single' simulates one image per attempt, 'batched' a stack of images per `BatchSimulator` call
+SIMULATION_ENGINES = ('single', 'batched')
+
+class RejectedAttempt(Exception):
+    """
+    Raised by `generate_cardiac_image` when a staged ratio check rejects the image early.
+    """
+
+    def __init__(self, stage: str, stats: Dict[str, Any]):
+        """
+        Args:
+            stage (str): Stage that rejected the image, 'infarct' or 'no_flow'
+            stats (Dict[str, Any]): Ratios known at that stage in the `StatsCalculator.process_mask`
+                format; `noflow_to_infarct` is None at the infarct stage
+        """
+        super().__init__(f"Rejected at the {stage} stage: infarct_to_myo {stats['infarct_to_myo']:.3f}")
+        self.stage = stage
+        self.stats = stats
+
+def _check_stage(stage: str, infarct_pixels: int, myocardium_pixels: int, no_flow_pixels: int,
+                 ratio_limits: Dict[str, float], margin: Optional[float] = 0.0) -> None:
+    """
+    Raise `RejectedAttempt` if the ratios known at a stage are out of bounds.
+    
+    At the infarct stage only the infarct ratio is checked. No-flow pixels added later
+    can only raise it (when they spill onto myocardium or background), so the upper
+    limit is final while the lower one is lowered by `margin`, or not checked when
+    `margin` is None.
+    
+    Args:
+        stage (str): 'infarct' or 'no_flow'
+        infarct_pixels (int): Infarction pixels, not counting no-flow
+        myocardium_pixels (int): Healthy myocardium pixels
+        no_flow_pixels (int): No-flow pixels
+        ratio_limits (Dict[str, float]): Keyword arguments of `StatsCalculator.process_mask`
+        margin (Optional[float]): Tolerance below the lower infarct ratio limit, None to
+            only check the upper limit
+    """
+    infarct_to_myo, noflow_to_infarct = StatsCalculator.ratios_from_counts(
+        infarct_pixels, myocardium_pixels, no_flow_pixels)
+    has_significant_infarct = (infarct_to_myo >= ratio_limits['infarct_to_myo_upper_limit'] or
+                               (margin is not None and
+                                infarct_to_myo <= ratio_limits['infarct_to_myo_lower_limit'] - margin))
+    if stage == 'infarct':
+        noflow_to_infarct, has_significant_noflow = None, False
+    else:
+        has_significant_noflow = (noflow_to_infarct >= ratio_limits['noflow_to_infarct_upper_limit'] or
+                                  noflow_to_infarct <= ratio_limits['noflow_to_infarct_lower_limit'])
+    if has_significant_infarct or has_significant_noflow:
+        raise RejectedAttempt(stage, {
+            'infarct_to_myo': infarct_to_myo,
+            'noflow_to_infarct': noflow_to_infarct,
+            'has_significant_infarct': has_significant_infarct,
+            'has_significant_noflow': has_significant_noflow,
+            'has_significant_infarct_or_noflow': True
+        })
+
 
 def generate_cardiac_image(
     all_masks: Dict[str, Any] = None,
@@ -31,6 +99,11 @@ def generate_cardiac_image(
     mayocardium_color: int = 2,
     infarction_color: int = 3,
     no_flow_color: int = 4,
+    no_flow_energy_ratio: Tuple[float, float] = (0.05, 0.2),
+    ratio_limits: Dict[str, float] = None,
+    early_rejection_margin: float = None,
+    slice_index: SliceIndex = None,
+    return_intermediates: bool = False,
 ) -> Tuple[np.ndarray, dict]:
     """
     Generate a complete cardiac image with infarctions and no-flow regions.
@@ -49,13 +122,26 @@ def generate_cardiac_image(
         mayocardium_color: Pixel value for the myocardium
         infarction_color: Pixel value for the infarctions
         no_flow_color: Pixel value for the no-flow regions
+        no_flow_energy_ratio: Range of the no-flow spreading energy relative to the cluster area
+        ratio_limits: Keyword arguments of `StatsCalculator.process_mask`; when given, the
+            infarct ratio is checked right after the infarction clusters are filtered and both
+            ratios right after the no-flow clusters are, raising `RejectedAttempt` if out of bounds.
+            Both checks only reject attempts the final check would reject too
+        early_rejection_margin: Tolerance below the lower limit of the infarct stage check,
+            which may then reject attempts that no-flow would have lifted into the limits;
+            None (default) leaves the lower limit to the checks on the finished ratios
+        slice_index: Optional slice metadata; the real myocardium is then only drawn from
+            slices that have one
+        return_intermediates: Return the intermediate results even without `show_plots`
 
     
     Returns:
         Tuple containing:
             - Final processed image
-            - Dictionary of intermediate results
+            - Dictionary of intermediate results, empty unless `show_plots` or
+              `return_intermediates` is set
     """
+    staged_checks = ratio_limits is not None
     # Initialize processor
     processor = ImageProcessor()
     if mayocardium_type == 'simulated':
@@ -72,7 +158,8 @@ def generate_cardiac_image(
 
     else:
         # Load a random myocardium mask
-        mayocardium_mask, blood_pool_mask = get_random_mask_slice(all_masks, 'mayocardium_masks')
+        mayocardium_mask, blood_pool_mask = get_random_mask_slice(all_masks, 'mayocardium_masks',
+                                                                  slice_index=slice_index)
         # map the value from 2 to 150
         array = np.copy(mayocardium_mask)
         array[array == 2] = 150
@@ -98,16 +185,31 @@ def generate_cardiac_image(
         array=array
     )
     
-    infarction_mask = output_array == 255
     cv_closed_output = processor.morphological_processing(output_array)
     filtered_output = processor.filter_clusters_by_size(cv_closed_output, min_cluster_size)
+
+    if staged_checks:
+        # Pixels the blood pool overlay of real myocardia paints over do not count
+        visible = blood_pool_mask == 0 if mayocardium_type != 'simulated' else np.ones(array.shape, dtype=bool)
+        infarction_pixels = (filtered_output == 255) & visible
+        _check_stage('infarct', np.count_nonzero(infarction_pixels),
+                     np.count_nonzero((array == 150) & ~infarction_pixels & visible), 0,
+                     ratio_limits, early_rejection_margin)
     
     # Add and process no-flow regions
-    image_with_no_flow = processor.add_no_flow(filtered_output)
+    image_with_no_flow = processor.add_no_flow(filtered_output, energy_ratio_range=no_flow_energy_ratio)
     filtered_no_flow_output = processor.filter_clusters_by_size(
         image_with_no_flow, 
         min_no_flow_size
     )
+
+    if staged_checks:
+        # Same pixel counts as the final image, so this check is exact
+        no_flow_pixels = (filtered_no_flow_output == 255) & visible
+        lesion = (filtered_output == 255) | (filtered_no_flow_output == 255)
+        _check_stage('no_flow', np.count_nonzero(infarction_pixels & ~no_flow_pixels),
+                     np.count_nonzero((array == 150) & ~lesion & visible),
+                     np.count_nonzero(no_flow_pixels), ratio_limits)
     
     # Create final image
     final_image = np.copy(array)
@@ -130,11 +232,14 @@ def generate_cardiac_image(
             blood_pool_color=blood_pool_color
         )
     
+    if not (show_plots or return_intermediates):
+        return final_image, {}
+
     # Store intermediate results
     results = {
         'original_image': array,
         'output_array': output_array,
-        'infarction_mask': infarction_mask,
+        'infarction_mask': output_array == 255,
         'closed_output': cv_closed_output,
         'filtered_output': filtered_output,
         'no_flow_image': image_with_no_flow,
@@ -180,7 +285,325 @@ def _plot_results(results: dict):
 
 
     
-def generate_multible_cardiac_images(
+def _generate_accepted_image(index: int, seed: int, all_masks: Dict[str, Any], generation_settings: Dict[str, Any],
+                             tuning: Dict[str, Any],
+                             slice_index: SliceIndex = None) -> Tuple[int, np.ndarray, Dict[str, Any], Dict[str, Any]]:
+    """
+    Run the accept/reject loop for image number `index` of a run until an image passes the stats check.
+    
+    The ratio limits of the bin are handed to `generate_cardiac_image`, so most bad
+    attempts stop at one of its staged checks. Attempts that fail with an exception
+    are rejected right away, and the ratios of every other attempt retune the
+    settings through `AdaptiveSampler.update`.
+    
+    Args:
+        index (int): Index of the image in the run
+        seed (int): Seed of the run
+        all_masks (Dict[str, Any]): Dictionary containing all masks organized by case
+        generation_settings (Dict[str, Any]): Keyword arguments of `generate_cardiac_image`
+        tuning (Dict[str, Any]): Ratio bin, limits and starting state from `AdaptiveSampler.tuning`
+        slice_index (SliceIndex): Optional slice metadata to sample valid slices only
+        
+    Returns:
+        Tuple containing:
+            - Index of the image
+            - Accepted image
+            - Its statistics from `StatsCalculator.process_mask`
+            - Attempt counters: worker pid, rejected and failed attempts, rejections and their
+              seconds per stage, elapsed seconds, the ratios of every attempt and the tuning
+              state after the accepted one
+    """
+    seed_random_generators(seed, index)
+    start_time = time.perf_counter()
+    stats_calculator = StatsCalculator(
+        infarction_val=generation_settings['infarction_color'],
+        myocardium_val=generation_settings['mayocardium_color'],
+        no_flow_val=generation_settings['no_flow_color']
+    )
+    state = tuning['state']
+    observations = []
+    rejections = dict.fromkeys(REJECTION_STAGES, 0)
+    rejected_seconds = dict.fromkeys(REJECTION_STAGES, 0.0)
+    accurate_gen = False
+    while not accurate_gen:
+        attempt_start = time.perf_counter()
+        try:
+            # Generate a single cardiac image
+            with profiler.stage('simulate'):
+                custom_image, custom_results = generate_cardiac_image(all_masks=all_masks,
+                                                                      ratio_limits=tuning['ratio_limits'],
+                                                                      slice_index=slice_index,
+                                                                      **dict(generation_settings, **state['settings']))
+            # Check if the generated image meets the criteria
+            with profiler.stage('stats'):
+                stats = stats_calculator.process_mask(custom_image, **tuning['ratio_limits'])
+            stage = 'final'
+        except RejectedAttempt as rejection:
+            stats, stage = rejection.stats, rejection.stage
+        except Exception as e:
+            logging.error(f"Error generating image {index}: {e}")
+            rejections['error'] += 1
+            rejected_seconds['error'] += time.perf_counter() - attempt_start
+            continue
+
+        noflow_to_infarct = stats['noflow_to_infarct']
+        observations.append((float(stats['infarct_to_myo']),
+                             float(noflow_to_infarct) if noflow_to_infarct is not None else None))
+        state = AdaptiveSampler.update(tuning, state, stats)
+        if stats["has_significant_infarct_or_noflow"]:
+            logging.warning(f"Image {index} has significant no-flow or infarct area ({stage} stage), regenerating...")
+            rejections[stage] += 1
+            rejected_seconds[stage] += time.perf_counter() - attempt_start
+            continue
+        accurate_gen = True
+
+    attempts = {
+        'worker': os.getpid(),
+        'rejected': sum(rejections.values()),
+        'errors': rejections['error'],
+        'rejections': rejections,
+        'rejected_seconds': rejected_seconds,
+        'elapsed': time.perf_counter() - start_time,
+        'bin': tuning['bin'],
+        'observations': observations,
+        'state': state
+    }
+    return index, custom_image, stats, attempts
+
+
+# Per-process corpus of the image workers, set once by `_init_image_worker`
+_worker_state = {}
+
+def _init_image_worker(all_masks: Dict[str, Any], slice_index: SliceIndex = None,
+                       profiler_settings: Dict[str, bool] = None) -> None:
+    """
+    Initialize an image worker process with the mask corpus.
+    
+    Args:
+        all_masks (Dict[str, Any]): Dictionary containing all masks organized by case
+        slice_index (SliceIndex): Optional slice metadata to sample valid slices only
+        profiler_settings (Dict[str, bool]): `Profiler.settings` of the main process
+    """
+    profiler.configure(**(profiler_settings or {}))
+    _worker_state['all_masks'] = all_masks
+    _worker_state['slice_index'] = slice_index
+
+def _image_worker_task(index: int, seed: int, generation_settings: Dict[str, Any],
+                       tuning: Dict[str, Any]) -> Tuple[int, np.ndarray, Dict[str, Any], Dict[str, Any]]:
+    """
+    Run `_generate_accepted_image` inside a worker process.
+
+    The worker's profiler snapshot is returned under 'profile' in the attempt counters while profiling.
+    """
+    index, image, stats, attempts = _generate_accepted_image(index, seed, _worker_state['all_masks'],
+                                                             generation_settings, tuning, _worker_state['slice_index'])
+    profile = profiler.drain()
+    if profile is not None:
+        attempts['profile'] = profile
+    return index, image, stats, attempts
+
+def _generate_accepted_group(group: int, indices: Sequence[int], group_indices: Sequence[int], seed: int,
+                             generation_settings: Dict[str, Any], group_limits: List[Dict[str, float]],
+                             group_bins: List[int],
+                             bin_edges: Sequence[float]) -> List[Tuple[int, np.ndarray, Dict[str, Any], Dict[str, Any]]]:
+    """
+    Run the batched accept/reject loop for the images of one group of consecutive indices.
+
+    `BatchSimulator` draws `len(group_indices)` images per call from the random stream of
+    the group. Each image that passes fills the first open index of the group whose ratio
+    bin it fits, so the image of every index only depends on the seed and its group, and
+    the same images come out whichever indices of the group are asked for. Images out of
+    bounds for every index count as rejected at the no-flow check, as the finished ratios
+    of the batch are checked there; images fitting only indices already filled or
+    not asked for are thrown away and count as rejected at the final check. So, as with
+    `_generate_accepted_image`, every attempt that is not an error is either returned or
+    rejected and leaves one ratio observation. Each observation counts for the ratio bin
+    its infarct ratio falls in (the nearest bin outside the band), the bin whose limits it
+    was tested against. The seconds per stage are the share of the batch time spent on
+    the rejected images.
+
+    Args:
+        group (int): Number of the group, seeds its random stream
+        indices (Sequence[int]): Indices of the group to return
+        group_indices (Sequence[int]): All indices of the group, in order
+        seed (int): Seed of the run
+        generation_settings (Dict[str, Any]): Keyword arguments of `BatchSimulator`
+        group_limits (List[Dict[str, float]]): Ratio limits of every index of the group
+        group_bins (List[int]): Ratio bin of every index of the group
+        bin_edges (Sequence[float]): Infarct ratio edges of the bins, `AdaptiveSampler.bin_edges`
+
+    Returns:
+        List[Tuple[int, np.ndarray, Dict[str, Any], Dict[str, Any]]]: The results of
+            `_generate_accepted_image` for `indices`; the attempt counters of the whole
+            group are reported with the first image, the ratios of every bin are shared out
+            among the images of that bin, and the ratios of bins without an image are
+            reported with the first image under 'other_observations' by bin
+    """
+    seed_random_generators(seed, group)
+    start_time = time.perf_counter()
+    simulator = BatchSimulator(**generation_settings)
+    batch_size = len(group_indices)
+    bounds = {key: np.array([limits[key] for limits in group_limits]) for key in group_limits[0]}
+    # The early infarct check keeps every image that fits the ratio bin of any index
+    loosest_limits = dict(
+        infarct_to_myo_lower_limit=float(bounds['infarct_to_myo_lower_limit'].min()),
+        infarct_to_myo_upper_limit=float(bounds['infarct_to_myo_upper_limit'].max()),
+        noflow_to_infarct_lower_limit=float(bounds['noflow_to_infarct_lower_limit'].min()),
+        noflow_to_infarct_upper_limit=float(bounds['noflow_to_infarct_upper_limit'].max()))
+    observations = []
+    rejections = dict.fromkeys(REJECTION_STAGES, 0)
+    rejected_seconds = dict.fromkeys(REJECTION_STAGES, 0.0)
+    simulated_seconds = 0.0
+    is_open = np.ones(batch_size, dtype=bool)
+    accepted = {}
+    wanted = set(indices)
+    while not wanted <= accepted.keys():
+        batch_start = time.perf_counter()
+        try:
+            with profiler.stage('simulate'):
+                images, info = simulator.generate(batch_size, ratio_limits=loosest_limits,
+                                                  return_intermediates=generation_settings['show_plots'])
+        except Exception as e:
+            logging.error(f"Error generating the images of group {group}: {e}")
+            rejections['error'] += batch_size
+            rejected_seconds['error'] += time.perf_counter() - batch_start
+            continue
+        if generation_settings['show_plots'] and len(images):
+            _plot_results({key: stack[0] for key, stack in info['intermediates'].items()})
+
+        with profiler.stage('stats'):
+            stats = info['stats']
+            infarct_to_myo, noflow_to_infarct = stats['infarct_to_myo'][:, None], stats['noflow_to_infarct'][:, None]
+            # (images, indices): whether each image fits the ratio bin of each index of the group
+            fits = ((infarct_to_myo < bounds['infarct_to_myo_upper_limit']) &
+                    (infarct_to_myo > bounds['infarct_to_myo_lower_limit']) &
+                    (noflow_to_infarct < bounds['noflow_to_infarct_upper_limit']) &
+                    (noflow_to_infarct > bounds['noflow_to_infarct_lower_limit']))
+        surplus = 0
+        for image in range(len(images)):
+            available = fits[image] & is_open
+            if not available.any():
+                surplus += bool(fits[image].any())
+            else:
+                position = int(np.argmax(available))
+                is_open[position] = False
+                accepted[group_indices[position]] = (images[image], {
+                    'infarct_to_myo': float(stats['infarct_to_myo'][image]),
+                    'noflow_to_infarct': float(stats['noflow_to_infarct'][image]),
+                    'has_significant_infarct': False,
+                    'has_significant_noflow': False,
+                    'has_significant_infarct_or_noflow': False
+                })
+
+        elapsed = time.perf_counter() - batch_start
+        infarct_rejected = len(info['rejected_infarct_to_myo'])
+        final_rejected = int(np.count_nonzero(~fits.any(axis=1)))
+        rejections['infarct'] += infarct_rejected
+        rejections['no_flow'] += final_rejected
+        rejections['final'] += surplus
+        rejected_seconds['infarct'] += elapsed * infarct_rejected / batch_size
+        rejected_seconds['no_flow'] += elapsed * final_rejected / batch_size
+        rejected_seconds['final'] += elapsed * surplus / batch_size
+        simulated_seconds += elapsed
+        observations.extend((float(ratio), None) for ratio in info['rejected_infarct_to_myo'])
+        observations.extend(zip(stats['infarct_to_myo'].tolist(), stats['noflow_to_infarct'].tolist()))
+
+    # Images of indices that were not asked for are thrown away like the surplus ones
+    unrequested = len(accepted) - len(indices)
+    rejections['final'] += unrequested
+    rejected_seconds['final'] += simulated_seconds * unrequested / max(len(observations), 1)
+    # Every ratio bin records the attempts whose infarct ratio fell in it
+    observation_bins = np.searchsorted(np.asarray(bin_edges)[1:-1],
+                                       [infarct_to_myo for infarct_to_myo, _ in observations], side='right')
+    bin_observations: Dict[int, List[Tuple[float, Optional[float]]]] = {}
+    for observation_bin, observation in zip(observation_bins.tolist(), observations):
+        bin_observations.setdefault(observation_bin, []).append(observation)
+    image_bins = [group_bins[group_indices.index(i)] for i in indices]
+    shares = [bin_observations.get(image_bin, [])[image_bins[:k].count(image_bin)::image_bins.count(image_bin)]
+              for k, image_bin in enumerate(image_bins)]
+    results = []
+    for k, i in enumerate(indices):
+        image, image_stats = accepted[i]
+        first = k == 0
+        results.append((i, image, image_stats, {
+            'worker': os.getpid(),
+            'rejected': sum(rejections.values()) if first else 0,
+            'errors': rejections['error'] if first else 0,
+            'rejections': rejections if first else dict.fromkeys(REJECTION_STAGES, 0),
+            'rejected_seconds': rejected_seconds if first else dict.fromkeys(REJECTION_STAGES, 0.0),
+            'elapsed': time.perf_counter() - start_time if first else 0.0,
+            'bin': image_bins[k],
+            'observations': shares[k],
+            'other_observations': {observation_bin: bin_ratios for observation_bin, bin_ratios in
+                                   bin_observations.items() if observation_bin not in image_bins} if first else {},
+            'state': None
+        }))
+    return results
+
+def _group_worker_task(*args) -> List[Tuple[int, np.ndarray, Dict[str, Any], Dict[str, Any]]]:
+    """
+    Run `_generate_accepted_group` inside a worker process.
+
+    The worker's profiler snapshot is returned under 'profile' in the attempt counters of the first image.
+    """
+    results = _generate_accepted_group(*args)
+    profile = profiler.drain()
+    if profile is not None:
+        results[0][3]['profile'] = profile
+    return results
+
+def _bounded_as_completed(executor: ProcessPoolExecutor, tasks, max_in_flight: int):
+    """
+    Submit tasks lazily with at most `max_in_flight` pending and yield their results as they finish.
+    
+    A task is only built when it is submitted, so it sees every result consumed before.
+    
+    Args:
+        executor (ProcessPoolExecutor): Pool the tasks run on
+        tasks: Iterable of (function, *arguments) tuples
+        max_in_flight (int): Maximum number of submitted but unfinished tasks
+    """
+    pending = set()
+    for task in tasks:
+        pending.add(executor.submit(*task))
+        if len(pending) >= max_in_flight:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    for future in as_completed(pending):
+        yield future.result()
+
+def _print_worker_summary(worker_counters: Dict[int, Dict[str, float]], elapsed: float) -> None:
+    """
+    Print accepted images, rejected attempts and throughput per worker.
+    
+    Args:
+        worker_counters (Dict[int, Dict[str, float]]): Counters keyed by worker pid
+        elapsed (float): Wall time of the whole run in seconds
+    """
+    total_accepted = sum(counters['accepted'] for counters in worker_counters.values())
+    total_rejected = sum(counters['rejected'] for counters in worker_counters.values())
+    print(f"Simulated images: {total_accepted} accepted, {total_rejected} rejected attempts "
+          f"in {elapsed:.1f}s ({total_accepted / max(elapsed, 1e-9):.2f} images/s)")
+    for worker, counters in sorted(worker_counters.items()):
+        print(f"- worker {worker}: {counters['accepted']} accepted, {counters['rejected']} rejected, "
+              f"{counters['accepted'] / max(counters['busy'], 1e-9):.2f} images/s")
+
+def _print_rejection_summary(rejections: Dict[str, int], rejected_seconds: Dict[str, float]) -> None:
+    """
+    Print the rejected attempts and the time spent on them per rejection stage.
+    
+    Args:
+        rejections (Dict[str, int]): Rejected attempts per stage of `REJECTION_STAGES`
+        rejected_seconds (Dict[str, float]): Seconds spent on the rejected attempts per stage
+    """
+    print("Rejected attempts by stage:")
+    for stage in REJECTION_STAGES:
+        print(f"- {stage}: {rejections[stage]} attempts, {rejected_seconds[stage]:.1f}s "
+              f"({1000 * rejected_seconds[stage] / max(rejections[stage], 1):.1f} ms each)")
+
+    
+def iter_cardiac_images(
     number_of_images: int,
     output_dir: str,
     all_masks: Dict[str, Any] = None,
@@ -203,59 +626,234 @@ def generate_multible_cardiac_images(
     infarct_to_myo_upper_limit: float = 0.6,
     infarct_to_myo_lower_limit: float = 0.2,
     noflow_to_infarct_upper_limit: float = 0.4,
-    noflow_to_infarct_lower_limit: float = 0.1
-    ):
+    noflow_to_infarct_lower_limit: float = 0.1,
+    workers: int = 1,
+    seed: int = None,
+    no_flow_energy_ratio: Tuple[float, float] = (0.05, 0.2),
+    adaptive_sampling: bool = False,
+    ratio_bins: int = 1,
+    early_rejection_margin: float = None,
+    slice_index: SliceIndex = None,
+    output_format: str = 'both',
+    output_writers: int = 1,
+    output_queue_size: int = 64,
+    output_shard_size: int = 1024,
+    mask_codec: str = None,
+    indices: Sequence[int] = None,
+    resume: bool = False,
+    checkpoint_every: int = 100,
+    engine: str = 'single',
+    engine_batch_size: int = 32
+    ) -> Iterator[Tuple[str, np.ndarray]]:
+    """
+    Generate cardiac images whose infarct and no-flow ratios fall inside the limits, one at a time.
+
+    Images are yielded in the order they are accepted and not kept afterwards; with workers
+    at most 2 x `workers` images are generated ahead, so memory does not grow with
+    `number_of_images`. The images are also written to `output_dir` unless `output_format`
+    is 'none'. The summaries are printed once every image was generated. A resumed run
+    skips, and does not yield, the images already on disk.
     
-    simulated_directory_path ="simulated_masks"
-    output_dir = os.path.join(output_dir, simulated_directory_path)
-    os.makedirs(output_dir, exist_ok=True)
-    stats_calculator = StatsCalculator(
-        infarction_val=infarction_color,
-        myocardium_val=mayocardium_color,
-        no_flow_val=no_flow_color
+    Args:
+        number_of_images: Number of images to generate
+        output_dir: Directory the simulated_masks folder is created in
+        workers: Number of worker processes, each running its own accept/reject loop;
+            1 generates in the current process
+        seed: Seed of the run; image i always gets the same random stream whatever the
+            number of workers. A random seed is drawn (and printed) when None
+        no_flow_energy_ratio: Initial range of the no-flow spreading energy relative to the cluster area
+        adaptive_sampling: Tune energy, number_of_seeds and no_flow_energy_ratio online from the
+            rejected attempts (see `AdaptiveSampler`). The starting settings of an image then
+            depend on the images finished before it, so runs are only reproducible with workers=1
+        ratio_bins: Number of equal infarct-to-myocardium bins that each get the same share of images
+        early_rejection_margin: Tolerance below the lower limit of the staged infarct ratio
+            check inside `generate_cardiac_image`; None (default) only rejects on that
+            check's upper limit, which no later stage can fix
+        slice_index: Optional slice metadata; real myocardium slices are then only drawn
+            from the slices that have one
+        output_format: Files written per image, 'npy', 'png' or 'both', or 'shards' to write
+            compressed shards of `output_shard_size` images (see `ShardedMaskDataset`); 'none'
+            only yields the images
+        output_writers: Background threads writing the images (see `MaskWriter`); 0 writes inline
+        output_queue_size: Maximum number of images waiting to be written
+        output_shard_size: Number of images per shard for 'shards'
+        mask_codec: 'rle' or 'bitplanes' to write encoded .mask files instead of .npy files
+        indices: Image indices to generate, e.g. the `shard_indices` of one shard of the run or
+            single images to regenerate; all of `range(number_of_images)` when None
+        resume: Record the progress in a `RunManifest` and only generate the images not yet
+            written by an earlier, interrupted run into the same `output_dir`
+        checkpoint_every: Written images between two manifest updates
+        engine: 'single' to simulate one image per attempt, or 'batched' to simulate
+            `engine_batch_size` images per call with `BatchSimulator` (simulated myocardia only,
+            no adaptive sampling). The batched engine draws the images of each group of
+            `engine_batch_size` consecutive indices from one random stream, so its images
+            differ from the single engine's but are the same for any workers, shards or resume
+        engine_batch_size: Images per `BatchSimulator` call, also the size of the index groups
+        (remaining arguments as in `generate_cardiac_image` and `StatsCalculator.process_mask`)
+
+    Yields:
+        Tuple[str, np.ndarray]: File name (without extension) and image
+    """
+    generation_settings = dict(
+        mayocardium_type=mayocardium_type,
+        image_size=image_size,
+        number_of_seeds=number_of_seeds,
+        energy=energy,
+        max_radius_step=max_radius_step,
+        max_theta_step=max_theta_step,
+        min_cluster_size=min_cluster_size,
+        min_no_flow_size=min_no_flow_size,
+        ring_thick_max=ring_thick_max,
+        ring_thick_min=ring_thick_min,
+        show_plots=show_plots,
+        background_color=background_color,
+        blood_pool_color=blood_pool_color,
+        mayocardium_color=mayocardium_color,
+        infarction_color=infarction_color,
+        no_flow_color=no_flow_color,
+        no_flow_energy_ratio=tuple(no_flow_energy_ratio),
+        early_rejection_margin=early_rejection_margin
+    )
+    ratio_limits = dict(
+        infarct_to_myo_upper_limit=infarct_to_myo_upper_limit,
+        infarct_to_myo_lower_limit=infarct_to_myo_lower_limit,
+        noflow_to_infarct_upper_limit=noflow_to_infarct_upper_limit,
+        noflow_to_infarct_lower_limit=noflow_to_infarct_lower_limit
     )
+    if engine not in SIMULATION_ENGINES:
+        raise ValueError(f"Unknown engine {engine!r}, expected one of {SIMULATION_ENGINES}")
+    if engine == 'batched':
+        if mayocardium_type != 'simulated':
+            raise ValueError("The batched engine only simulates myocardia, set mayocardium_type to 'simulated'")
+        if adaptive_sampling:
+            logging.warning("The batched engine does not tune its settings, generating without adaptive sampling")
+            adaptive_sampling = False
+        engine_batch_size = max(1, int(engine_batch_size))
+    indices = range(number_of_images) if indices is None else list(indices)
+    manifest = None
+    if output_format != 'none':
+        simulated_directory_path ="simulated_masks"
+        output_dir = os.path.join(output_dir, simulated_directory_path)
+        os.makedirs(output_dir, exist_ok=True)
+        if resume:
+            # Everything that changes the images, a resumed run must match it
+            run_settings = dict(generation_settings, **ratio_limits, adaptive_sampling=adaptive_sampling,
+                                ratio_bins=ratio_bins, slice_index=slice_index is not None, engine=engine)
+            if engine == 'batched':
+                run_settings['engine_batch_size'] = engine_batch_size
+            del run_settings['show_plots']
+            manifest = RunManifest.resume(output_dir, seed, number_of_images, run_settings, output_format,
+                                          mask_codec, checkpoint_every)
+            seed = manifest.seed
+            remaining = [index for index in indices if index not in manifest.completed]
+            print(f"Resuming simulated images in {output_dir}: {len(indices) - len(remaining)} already written, "
+                  f"{len(remaining)} to generate")
+            indices = remaining
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    print(f"Simulated images seed: {seed}")
+    if show_plots and workers > 1:
+        logging.warning("show_plots needs the main process, generating images with a single worker")
+        workers = 1
 
-    for i in range(number_of_images):
-        accurate_gen = False
-        while not accurate_gen:
-            try:
-                # Generate a single cardiac image
-                custom_image, custom_results = generate_cardiac_image ( 
-                    all_masks=all_masks,    
-                    mayocardium_type=mayocardium_type,
-                    image_size=image_size,
-                    number_of_seeds=number_of_seeds,
-                    energy=energy,
-                    max_radius_step=max_radius_step,
-                    max_theta_step=max_theta_step,
-                    min_cluster_size=min_cluster_size,
-                    min_no_flow_size=min_no_flow_size,
-                    ring_thick_max=ring_thick_max,
-                    ring_thick_min=ring_thick_min,
-                    show_plots=show_plots,
-                    background_color=background_color,
-                    blood_pool_color=blood_pool_color,
-                    mayocardium_color=mayocardium_color,
-                    infarction_color=infarction_color,
-                    no_flow_color=no_flow_color
-                )
-                # Check if the generated image meets the criteria
-                stats = stats_calculator.process_mask(custom_image, infarct_to_myo_upper_limit=infarct_to_myo_upper_limit, infarct_to_myo_lower_limit=infarct_to_myo_lower_limit,
-                                                       noflow_to_infarct_upper_limit=noflow_to_infarct_upper_limit, noflow_to_infarct_lower_limit=noflow_to_infarct_lower_limit)
-                if stats["has_significant_infarct_or_noflow"]:
-                    logging.warning(f"Image {i} has significant no-flow or infarct area, regenerating...")
-                    continue
-                accurate_gen = True
-            except Exception as e:
-                logging.error(f"Error generating image {i}: {e}")
-                time.sleep(1)
-        
-        # save the time the image was generated
-        timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S-%f")
-        # Save the image with a timestamp
-        print (int((stats['infarct_to_myo']*100)), int((stats['noflow_to_infarct']*100)))
-        cv2.imwrite(os.path.join(output_dir, f"{mayocardium_type}_simulated_{int(stats['infarct_to_myo']*100)}_{int(stats['noflow_to_infarct']*100)}_{timestamp}.png"), custom_image)
-        # save npy
-        np.save(os.path.join(output_dir, f"{mayocardium_type}_simulated_{int(stats['infarct_to_myo']*100)}_{int(stats['noflow_to_infarct']*100)}_{timestamp}.npy"), custom_image)
-        print(f"Image {i} saved successfully!")
-        # Save the image
+    sampler = AdaptiveSampler(generation_settings, ratio_limits, ratio_bins=ratio_bins, adaptive=adaptive_sampling)
+    worker_counters = {}
+    rejections = dict.fromkeys(REJECTION_STAGES, 0)
+    rejected_seconds = dict.fromkeys(REJECTION_STAGES, 0.0)
+    start_time = time.perf_counter()
+
+    if engine == 'batched':
+        # Each group of consecutive indices is one task, whichever of its indices are asked for
+        members: Dict[int, List[int]] = {}
+        for i in indices:
+            members.setdefault(i // engine_batch_size, []).append(i)
+        groups = []
+        for group, group_members in members.items():
+            group_indices = list(range(group * engine_batch_size,
+                                       min(number_of_images, (group + 1) * engine_batch_size)))
+            group_limits = [sampler.bin_limits(sampler.target_bin(i)) for i in group_indices]
+            group_bins = [sampler.target_bin(i) for i in group_indices]
+            groups.append((group, group_members, group_indices, seed, generation_settings,
+                           group_limits, group_bins, sampler.bin_edges))
+        if workers > 1:
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_image_worker,
+                                           initargs=(all_masks, slice_index, profiler.settings()))
+            tasks = ((_group_worker_task, *group) for group in groups)
+            results = itertools.chain.from_iterable(
+                _bounded_as_completed(executor, tasks, max_in_flight=2 * workers))
+        else:
+            executor = None
+            results = itertools.chain.from_iterable(_generate_accepted_group(*group) for group in groups)
+    elif workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_image_worker,
+                                       initargs=(all_masks, slice_index, profiler.settings()))
+        tasks = ((_image_worker_task, i, seed, generation_settings, sampler.tuning(sampler.target_bin(i)))
+                 for i in indices)
+        # Accepted images are streamed back as soon as any worker finishes one; keeping only a
+        # few tasks in flight lets later images start from the latest tuned settings
+        results = _bounded_as_completed(executor, tasks, max_in_flight=2 * workers)
+    else:
+        executor = None
+        results = (_generate_accepted_image(i, seed, all_masks, generation_settings,
+                                            sampler.tuning(sampler.target_bin(i)), slice_index)
+                   for i in indices)
+
+    writer = None
+    if output_format != 'none':
+        writer = MaskWriter(output_format, output_writers, output_queue_size, output_shard_size,
+                            label_values=(background_color, blood_pool_color, mayocardium_color,
+                                          infarction_color, no_flow_color),
+                            mask_codec=mask_codec, on_written=manifest.commit if manifest is not None else None)
+    try:
+        for i, custom_image, stats, attempts in results:
+            profiler.merge(attempts.pop('profile', None))
+            counters = worker_counters.setdefault(attempts['worker'], {'accepted': 0, 'rejected': 0, 'busy': 0.0})
+            counters['accepted'] += 1
+            counters['rejected'] += attempts['rejected']
+            counters['busy'] += attempts['elapsed']
+            for stage in REJECTION_STAGES:
+                rejections[stage] += attempts['rejections'][stage]
+                rejected_seconds[stage] += attempts['rejected_seconds'][stage]
+            sampler.record(attempts['bin'], attempts['observations'], attempts['errors'], attempts['state'])
+            for other_bin, other_observations in attempts.get('other_observations', {}).items():
+                sampler.record_attempts(other_bin, other_observations)
+
+            # Save the image under its index, which gives image i the same name in every run, worker and shard
+            file_name = (f"{mayocardium_type}_simulated_{int(stats['infarct_to_myo']*100)}_"
+                         f"{int(stats['noflow_to_infarct']*100)}_{i:06d}")
+            print (int((stats['infarct_to_myo']*100)), int((stats['noflow_to_infarct']*100)))
+            if writer is not None:
+                writer.submit(output_dir, file_name, custom_image)
+                print(f"Image {i} queued for writing")
+            yield file_name, custom_image
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        try:
+            if writer is not None:
+                # Waits for the queued images to be written
+                writer.close()
+        finally:
+            if manifest is not None:
+                manifest.save()
+
+    for stage in REJECTION_STAGES:
+        profiler.count(f"simulate.rejections.{stage}", rejections[stage])
+        profiler.count(f"simulate.rejected_seconds.{stage}", rejected_seconds[stage])
+    profiler.count("simulate.images", sum(counters['accepted'] for counters in worker_counters.values()))
+    _print_worker_summary(worker_counters, time.perf_counter() - start_time)
+    _print_rejection_summary(rejections, rejected_seconds)
+    sampler.print_summary()
+    if writer is not None:
+        writer.print_summary("Simulated images")
+
+
+def generate_multible_cardiac_images(number_of_images: int, output_dir: str, *args, **kwargs) -> None:
+    """
+    Generate and save cardiac images whose infarct and no-flow ratios fall inside the limits.
+
+    Args:
+        (as in `iter_cardiac_images`)
+    """
+    for _ in iter_cardiac_images(number_of_images, output_dir, *args, **kwargs):
+        pass
@@ -0,0 +1,181 @@
+import struct
+from pathlib import Path
+import numpy as np
+from typing import Dict, Any, Union
+
+# 'rle' stores runs of equal values, 'bitplanes' the bit-packed palette index of every pixel
+CODEC_METHODS = ('rle', 'bitplanes')
+MASK_EXTENSION = '.mask'
+# Marker key of a masks.npy dict whose masks are encoded
+CORPUS_CODEC_KEY = '__mask_codec__'
+
+_MAGIC = b'MSKC'
+# Magic, method, number of dimensions and dtype string of the mask, followed by its shape
+_HEADER = struct.Struct('<4sBB8s')
+
+
+def encode_mask(mask: np.ndarray, method: str = 'rle') -> np.ndarray:
+    """
+    Encode a mask (or a stack of masks) into a compact byte buffer.
+
+    Label maps are mostly background with a few thin structures, so both methods take
+    a fraction of the raw bytes: 'rle' stores the value and length of every run of the
+    flattened mask, 'bitplanes' stores the palette of distinct values and the packed
+    bits of every pixel's palette index (3 bits per pixel for 5 labels). Decoding
+    restores the exact array, dtype and shape.
+
+    Args:
+        mask (np.ndarray): Integer mask of any shape
+        method (str): One of `CODEC_METHODS`
+
+    Returns:
+        np.ndarray: uint8 buffer to store or pass to `decode_mask`
+    """
+    mask = np.asarray(mask)
+    if method not in CODEC_METHODS:
+        raise ValueError(f"Unknown mask codec '{method}', expected one of {CODEC_METHODS}")
+    if not (np.issubdtype(mask.dtype, np.integer) or mask.dtype == bool):
+        raise ValueError(f"Only integer masks can be encoded, got {mask.dtype}")
+    flat = mask.ravel()
+    header = _HEADER.pack(_MAGIC, CODEC_METHODS.index(method), mask.ndim, mask.dtype.str.encode())
+    shape = np.array(mask.shape, dtype='<u4').tobytes()
+    payload = _encode_rle(flat) if method == 'rle' else _encode_bitplanes(flat)
+    return np.frombuffer(header + shape + b''.join(payload), dtype=np.uint8)
+
+
+def decode_mask(buffer: Union[np.ndarray, bytes]) -> np.ndarray:
+    """
+    Decode a buffer written by `encode_mask`.
+
+    Args:
+        buffer (Union[np.ndarray, bytes]): Encoded mask
+
+    Returns:
+        np.ndarray: The original mask
+    """
+    buffer = memoryview(np.ascontiguousarray(np.frombuffer(buffer, dtype=np.uint8)))
+    magic, method, ndim, dtype = _HEADER.unpack_from(buffer)
+    if magic != _MAGIC:
+        raise ValueError("Not an encoded mask")
+    dtype = np.dtype(dtype.rstrip(b'\0').decode())
+    offset = _HEADER.size
+    shape = tuple(int(size) for size in np.frombuffer(buffer, dtype='<u4', count=ndim, offset=offset))
+    offset += 4 * ndim
+    size = int(np.prod(shape))
+    if CODEC_METHODS[method] == 'rle':
+        flat = _decode_rle(buffer, offset, dtype)
+    else:
+        flat = _decode_bitplanes(buffer, offset, dtype, size)
+    return flat.reshape(shape)
+
+
+def _encode_rle(flat: np.ndarray):
+    """
+    Runs of the flattened mask: run count, length width, run values and run lengths.
+    """
+    if flat.size:
+        starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+        lengths = np.diff(np.append(starts, flat.size))
+    else:
+        starts = lengths = np.zeros(0, dtype=np.int64)
+    length_dtype = np.dtype('<u2') if flat.size <= np.iinfo(np.uint16).max else np.dtype('<u4')
+    return (struct.pack('<IB', len(starts), length_dtype.itemsize), flat[starts].tobytes(),
+            lengths.astype(length_dtype).tobytes())
+
+
+def _decode_rle(buffer: memoryview, offset: int, dtype: np.dtype) -> np.ndarray:
+    runs, length_size = struct.unpack_from('<IB', buffer, offset)
+    offset += 5
+    values = np.frombuffer(buffer, dtype=dtype, count=runs, offset=offset)
+    lengths = np.frombuffer(buffer, dtype=f'<u{length_size}', count=runs, offset=offset + runs * dtype.itemsize)
+    return np.repeat(values, lengths)
+
+
+def _encode_bitplanes(flat: np.ndarray):
+    """
+    Palette size, bits per pixel, palette and the packed bit planes of the palette indices.
+    """
+    if flat.dtype == np.uint8:
+        # Cheaper than np.unique for the usual uint8 label maps
+        palette = np.flatnonzero(np.bincount(flat, minlength=256)).astype(np.uint8)
+        lookup = np.zeros(256, dtype=np.uint8)
+        lookup[palette] = np.arange(len(palette))
+        indices = lookup[flat]
+    else:
+        palette, indices = np.unique(flat, return_inverse=True)
+    bits = max(1, (len(palette) - 1).bit_length())
+    index_dtype = np.uint8 if bits <= 8 else np.intp
+    shifts = np.arange(bits, dtype=index_dtype)[:, np.newaxis]
+    planes = (indices.astype(index_dtype, copy=False)[np.newaxis, :] >> shifts) & 1
+    packed = np.packbits(planes.astype(np.uint8, copy=False), axis=1)
+    return struct.pack('<IB', len(palette), bits), palette.astype(flat.dtype).tobytes(), packed.tobytes()
+
+
+def _decode_bitplanes(buffer: memoryview, offset: int, dtype: np.dtype, size: int) -> np.ndarray:
+    colors, bits = struct.unpack_from('<IB', buffer, offset)
+    offset += 5
+    palette = np.frombuffer(buffer, dtype=dtype, count=colors, offset=offset)
+    offset += colors * dtype.itemsize
+    row_bytes = (size + 7) // 8
+    packed = np.frombuffer(buffer, dtype=np.uint8, count=bits * row_bytes, offset=offset)
+    planes = np.unpackbits(packed.reshape(bits, row_bytes), axis=1, count=size)
+    indices = planes[0].astype(np.uint8 if bits <= 8 else np.intp)
+    for bit in range(1, bits):
+        indices |= planes[bit].astype(indices.dtype) << bit
+    return palette[indices] if colors else np.zeros(size, dtype=dtype)
+
+
+def save_mask(path: Union[str, Path], mask: np.ndarray, method: str = 'rle') -> None:
+    """
+    Write an encoded mask file (`MASK_EXTENSION`).
+    """
+    encode_mask(mask, method).tofile(path)
+
+
+def load_mask(path: Union[str, Path]) -> np.ndarray:
+    """
+    Read a mask file written by `save_mask`.
+    """
+    return decode_mask(np.fromfile(path, dtype=np.uint8))
+
+
+def encode_corpus(all_masks: Dict[str, Any], method: str = 'rle') -> Dict[str, Any]:
+    """
+    Encode every slice of a masks.npy dict, marking the dict with `CORPUS_CODEC_KEY`.
+
+    Args:
+        all_masks (Dict[str, Any]): Dictionary containing all masks organized by case
+        method (str): One of `CODEC_METHODS`
+
+    Returns:
+        Dict[str, Any]: The same dict with encoded buffers in place of the slices
+    """
+    encoded = {CORPUS_CODEC_KEY: method}
+    for case_id, case_masks in all_masks.items():
+        encoded[case_id] = {mask_type: [encode_mask(mask, method) for mask in masks]
+                            for mask_type, masks in case_masks.items()}
+    return encoded
+
+
+def decode_corpus(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Decode a dict written by `encode_corpus`; plain dicts are returned unchanged.
+    """
+    if CORPUS_CODEC_KEY not in data:
+        return data
+    return {case_id: {mask_type: [decode_mask(buffer) for buffer in buffers]
+                      for mask_type, buffers in case_masks.items()}
+            for case_id, case_masks in data.items() if case_id != CORPUS_CODEC_KEY}
+
+
+def load_masks_npy(np_data_path: Union[str, Path]) -> Dict[str, Any]:
+    """
+    Load a masks.npy dict, decoding it if it was saved encoded.
+
+    Args:
+        np_data_path (Union[str, Path]): Path of the masks.npy corpus
+
+    Returns:
+        Dict[str, Any]: Dictionary containing all masks organized by case
+    """
+    return decode_corpus(np.load(np_data_path, allow_pickle=True).item())
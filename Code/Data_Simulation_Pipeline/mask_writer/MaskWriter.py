@@ -0,0 +1,265 @@
+import atexit
+import os
+import queue
+import threading
+import time
+import numpy as np
+import cv2
+from typing import Callable, Dict, List, Any, Optional, Sequence
+from mask_writer.ShardWriter import ShardWriter
+from mask_writer.ShardedMaskDataset import LABEL_VALUES, write_atomic
+from mask_writer.MaskCodec import CODEC_METHODS, MASK_EXTENSION, encode_mask
+from instrumentation.Profiler import profiler
+
+
+class MaskWriter:
+    """
+    Writes finished masks to disk as .npy and/or .png files, or in compressed shards,
+    off the generation loop.
+
+    Masks are put on a bounded queue and written by background threads; `np.save`
+    and the PNG encoding of `cv2.imwrite` release the GIL, so the writes overlap with
+    generation. A full queue blocks `submit`, which bounds the memory held by pending
+    masks. With `writers=0` every mask is written inline instead.
+
+    The 'shards' format groups the masks of every output directory into a
+    `ShardedMaskDataset` (see `ShardWriter`): shards are assembled in submission order
+    and each full shard is queued as one write; the last shards and the index are
+    written by `close`.
+
+    With a `mask_codec` the .npy files are replaced by encoded `.mask` files (see
+    `MaskCodec`).
+
+    Every file is written under a temporary name and renamed once complete, so an
+    interrupted run never leaves a truncated mask behind. `on_written` is called with
+    the output directory and file name of every mask once all its files (or its shard)
+    are on disk, from the writer threads.
+
+    `close` (or leaving the `with` block) waits until every queued mask is written and
+    re-raises the first write error; writers that were not closed are flushed at
+    interpreter exit. Submitted masks must not be modified afterwards.
+    """
+
+    OUTPUT_FORMATS = ('npy', 'png', 'both', 'shards')
+
+    def __init__(self, output_format: str = 'both', writers: int = 1, max_queue: int = 64,
+                 shard_size: int = 1024, label_values: Sequence[int] = LABEL_VALUES,
+                 mask_codec: Optional[str] = None, on_written: Callable[[str, str], None] = None):
+        """
+        Initialize the MaskWriter and start its writer threads.
+
+        Args:
+            output_format (str): 'npy', 'png', 'both' or 'shards'
+            writers (int): Number of writer threads; 0 writes synchronously in `submit`
+            max_queue (int): Maximum number of masks (shards for 'shards') waiting to be written
+            shard_size (int): Number of masks per shard for 'shards'
+            label_values (Sequence[int]): Background, blood pool, myocardium, infarct and
+                no-flow values counted per mask in the shard index
+            mask_codec (Optional[str]): 'rle' or 'bitplanes' to write encoded `.mask` files
+                instead of .npy files, None for plain .npy
+            on_written (Callable[[str, str], None]): Optional callback receiving the output
+                directory and file name of every mask written
+        """
+        if output_format not in self.OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output_format '{output_format}', expected one of {self.OUTPUT_FORMATS}")
+        if mask_codec is not None and mask_codec not in CODEC_METHODS:
+            raise ValueError(f"Unknown mask_codec '{mask_codec}', expected one of {CODEC_METHODS}")
+        self.mask_codec = mask_codec
+        self.on_written = on_written
+        self.output_format = output_format
+        self.writers = max(0, int(writers))
+        self.shard_size = shard_size
+        self.label_values = tuple(label_values)
+        self._shard_writers: Dict[str, ShardWriter] = {}
+        self._queue = queue.Queue(maxsize=max(1, int(max_queue)))
+        self._lock = threading.Lock()
+        self._errors: List[BaseException] = []
+        self._queue_depths: List[int] = []
+        self._write_seconds: List[float] = []
+        self._written = 0
+        self._latency_seconds: List[float] = []
+        self._blocked_seconds = 0.0
+        self._closed = False
+        self._threads = [threading.Thread(target=self._run, name=f"MaskWriter-{number}", daemon=True)
+                         for number in range(self.writers)]
+        for thread in self._threads:
+            thread.start()
+        atexit.register(self.close)
+
+    def submit(self, output_dir: str, file_name: str, mask: np.ndarray) -> None:
+        """
+        Queue a mask to be written as <output_dir>/<file_name>.npy (or .mask) and/or
+        .png, or under `file_name` in the shards of `output_dir`.
+
+        Args:
+            output_dir (str): Directory to write to
+            file_name (str): File name without extension
+            mask (np.ndarray): Mask to write
+        """
+        if self._closed:
+            raise RuntimeError("MaskWriter is closed")
+        if self.output_format == 'shards':
+            if output_dir not in self._shard_writers:
+                self._shard_writers[output_dir] = ShardWriter(output_dir, self.shard_size, self.label_values)
+            for shard in self._shard_writers[output_dir].add(file_name, mask):
+                self._enqueue(self._write_shard, shard)
+        else:
+            self._enqueue(self._write_files, (output_dir, file_name, mask))
+
+    def _enqueue(self, write, item) -> None:
+        """
+        Queue a write, or run it inline without writer threads.
+        """
+        if not self.writers:
+            self._write(write, item, time.perf_counter())
+            return
+        self._raise_errors()
+        depth = self._queue.qsize()
+        start = time.perf_counter()
+        self._queue.put((write, item, start))
+        with self._lock:
+            self._queue_depths.append(depth)
+            self._blocked_seconds += time.perf_counter() - start
+
+    def _run(self) -> None:
+        """
+        Write queued masks until the stop marker arrives.
+        """
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except BaseException as error:
+                with self._lock:
+                    self._errors.append(error)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, write, item, submitted: float) -> None:
+        """
+        Run one queued write and record its timings.
+        """
+        start = time.perf_counter()
+        with profiler.stage('write'):
+            written = write(item)
+        end = time.perf_counter()
+        with self._lock:
+            self._written += written
+            self._write_seconds.append(end - start)
+            self._latency_seconds.append(end - submitted)
+
+    def _write_files(self, item) -> int:
+        """
+        Write one mask as loose files in the configured formats.
+        """
+        output_dir, file_name, mask = item
+        path = os.path.join(output_dir, file_name)
+        if self.output_format in ('npy', 'both'):
+            if self.mask_codec is not None:
+                write_atomic(f"{path}{MASK_EXTENSION}", encode_mask(mask, self.mask_codec).tofile)
+            else:
+                write_atomic(f"{path}.npy", lambda file: np.save(file, mask))
+        if self.output_format in ('png', 'both'):
+            encoded, png = cv2.imencode('.png', mask)
+            if not encoded:
+                raise IOError(f"Could not write {path}.png")
+            write_atomic(f"{path}.png", png.tofile)
+        if self.on_written is not None:
+            self.on_written(output_dir, file_name)
+        return 1
+
+    def _write_shard(self, shard) -> int:
+        """
+        Write one shard returned by the `ShardWriter`.
+        """
+        written = ShardWriter.write_shard(shard)
+        if self.on_written is not None:
+            for name in shard[1]:
+                self.on_written(str(shard[0].parent), name)
+        return written
+
+    def _raise_errors(self) -> None:
+        with self._lock:
+            if self._errors:
+                error = self._errors[0]
+                self._errors.clear()
+                raise error
+
+    def flush(self) -> None:
+        """
+        Wait until every queued mask is written, re-raising the first write error.
+        """
+        if self.writers:
+            self._queue.join()
+        self._raise_errors()
+
+    def close(self) -> None:
+        """
+        Write the last shards, flush the queue, stop the writer threads and write the
+        shard indexes.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        try:
+            for shard_writer in self._shard_writers.values():
+                shard = shard_writer.finish()
+                if shard is not None:
+                    self._enqueue(self._write_shard, shard)
+            self.flush()
+        finally:
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+        # Only index shards once they are all on disk
+        for shard_writer in self._shard_writers.values():
+            shard_writer.write_index()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the write counters and timings.
+
+        Returns:
+            Dict[str, Any]: Written masks, mean and max queue depth seen by `submit`,
+                seconds `submit` was blocked on a full queue, and the mean and 95th
+                percentile of the write time and of the submit-to-written latency in ms
+                (per shard for 'shards')
+        """
+        with self._lock:
+            depths = np.array(self._queue_depths, dtype=np.float64)
+            write_ms = np.array(self._write_seconds) * 1000
+            latency_ms = np.array(self._latency_seconds) * 1000
+            blocked_seconds = self._blocked_seconds
+            written = self._written
+        return {
+            'written': written,
+            'mean_queue_depth': float(depths.mean()) if len(depths) else 0.0,
+            'max_queue_depth': int(depths.max()) if len(depths) else 0,
+            'blocked_seconds': blocked_seconds,
+            'mean_write_ms': float(write_ms.mean()) if len(write_ms) else 0.0,
+            'p95_write_ms': float(np.percentile(write_ms, 95)) if len(write_ms) else 0.0,
+            'mean_latency_ms': float(latency_ms.mean()) if len(latency_ms) else 0.0,
+            'p95_latency_ms': float(np.percentile(latency_ms, 95)) if len(latency_ms) else 0.0
+        }
+
+    def print_summary(self, label: Optional[str] = None) -> None:
+        """
+        Print the write counters and timings.
+        """
+        stats = self.stats()
+        mode = f"{self.writers} writer threads" if self.writers else "synchronous"
+        print(f"{label or 'Output'} writer ({self.output_format}, {mode}): {stats['written']} masks, "
+              f"write {stats['mean_write_ms']:.1f} ms mean / {stats['p95_write_ms']:.1f} ms p95, "
+              f"latency {stats['mean_latency_ms']:.1f} ms mean / {stats['p95_latency_ms']:.1f} ms p95, "
+              f"queue depth {stats['mean_queue_depth']:.1f} mean / {stats['max_queue_depth']} max, "
+              f"blocked {stats['blocked_seconds']:.2f}s")
+
+    def __enter__(self) -> "MaskWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
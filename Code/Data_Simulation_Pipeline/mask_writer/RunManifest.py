@@ -0,0 +1,179 @@
+import json
+import os
+import threading
+from pathlib import Path
+import numpy as np
+from typing import Dict, List, Any, Iterable, Optional, Set, Union
+from mask_writer.MaskCodec import MASK_EXTENSION
+from mask_writer.ShardedMaskDataset import ShardedMaskDataset, TEMP_SUFFIX, write_atomic
+
+MANIFEST_FILE = 'run_manifest.json'
+
+
+def mask_index(name: str) -> Optional[int]:
+    """
+    Get the mask index from an output name ending in `_<index>`, None for other names.
+    """
+    suffix = name.rsplit('_', 1)[-1]
+    return int(suffix) if suffix.isdigit() else None
+
+
+def index_ranges(indices: Iterable[int]) -> List[List[int]]:
+    """
+    Compress indices into sorted [first, last] runs of consecutive indices.
+    """
+    ranges = []
+    for index in sorted(indices):
+        if ranges and index == ranges[-1][1] + 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ranges
+
+
+def _to_json(value: Any) -> Any:
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class RunManifest:
+    """
+    Progress record of one generation step, for resuming an interrupted run.
+
+    `run_manifest.json` in the step's output directory holds the seed and the generation
+    settings of the run, the number of masks it was asked for and the indices of the
+    masks committed so far, as ranges. It is rewritten (atomically) every `checkpoint_every`
+    committed masks and when the step ends. A mask counts as committed once `MaskWriter`
+    has renamed all its files, or its shard, into place.
+
+    On restart `resume` checks that the settings are unchanged, takes over the seed and
+    returns the indices whose output is complete on disk: the files themselves are the
+    truth, so masks written after the last checkpoint are kept too, and masks whose
+    files were deleted are generated again. Leftover temporary files of masks that were
+    being written are removed.
+    """
+
+    def __init__(self, output_dir: Union[str, Path], seed: int, number: int, settings: Dict[str, Any],
+                 completed: Iterable[int] = (), checkpoint_every: int = 100):
+        """
+        Initialize the RunManifest.
+
+        Args:
+            output_dir (Union[str, Path]): Output directory of the step
+            seed (int): Seed of the step
+            number (int): Number of masks of the run
+            settings (Dict[str, Any]): Generation settings a resumed run must match
+            completed (Iterable[int]): Indices already on disk
+            checkpoint_every (int): Committed masks between two manifest writes
+        """
+        self.path = Path(output_dir) / MANIFEST_FILE
+        self.seed = seed
+        self.number = number
+        self.settings = json.loads(json.dumps(settings, default=_to_json))
+        self.completed: Set[int] = set(completed)
+        self.checkpoint_every = max(1, int(checkpoint_every))
+        self._uncommitted = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def resume(cls, output_dir: Union[str, Path], seed: Optional[int], number: int, settings: Dict[str, Any],
+               output_format: str, mask_codec: Optional[str] = None, checkpoint_every: int = 100) -> "RunManifest":
+        """
+        Open the manifest of an output directory, or start a new one.
+
+        Args:
+            output_dir (Union[str, Path]): Output directory of the step
+            seed (Optional[int]): Seed of the step; None takes the seed of the manifest, or
+                draws a new one for a new run
+            number (int): Number of masks of the run, may grow between restarts
+            settings (Dict[str, Any]): Generation settings of the step
+            output_format (str): 'npy', 'png', 'both' or 'shards', to find the complete masks
+            mask_codec (Optional[str]): Codec of the .mask files, None for .npy
+            checkpoint_every (int): Committed masks between two manifest writes
+
+        Returns:
+            RunManifest: Manifest with the seed to use and the indices already completed
+        """
+        manifest = cls(output_dir, seed, number, settings, checkpoint_every=checkpoint_every)
+        if not manifest.path.exists():
+            if manifest.seed is None:
+                manifest.seed = np.random.SeedSequence().entropy
+            manifest.save()
+            return manifest
+
+        with open(manifest.path) as file:
+            stored = json.load(file)
+        if stored['settings'] != manifest.settings:
+            changed = sorted(key for key in manifest.settings.keys() | stored['settings'].keys()
+                             if manifest.settings.get(key) != stored['settings'].get(key))
+            raise ValueError(f"{output_dir} holds a run with other settings ({', '.join(changed)}); "
+                             f"use another output_dir or set resume to false")
+        if seed is not None and seed != stored['seed']:
+            raise ValueError(f"{output_dir} holds a run with seed {stored['seed']}, not {seed}; "
+                             f"use another output_dir or set resume to false")
+        manifest.seed = stored['seed']
+        manifest.completed = cls.completed_on_disk(output_dir, output_format, mask_codec)
+        manifest.save()
+        return manifest
+
+    @staticmethod
+    def completed_on_disk(output_dir: Union[str, Path], output_format: str,
+                          mask_codec: Optional[str] = None) -> Set[int]:
+        """
+        Find the masks whose output is complete and remove partly written files.
+
+        Args:
+            output_dir (Union[str, Path]): Output directory of the step
+            output_format (str): 'npy', 'png', 'both' or 'shards'
+            mask_codec (Optional[str]): Codec of the .mask files, None for .npy
+
+        Returns:
+            Set[int]: Indices with every file of the format (or a shard entry) on disk
+        """
+        output_dir = Path(output_dir)
+        for entry in os.scandir(output_dir):
+            if entry.name.endswith(TEMP_SUFFIX):
+                os.remove(entry.path)
+        if output_format == 'shards':
+            names = ShardedMaskDataset.read_index(output_dir)['names'].astype(str)
+            return {index for index in map(mask_index, names) if index is not None}
+
+        extensions = []
+        if output_format in ('npy', 'both'):
+            extensions.append(MASK_EXTENSION if mask_codec is not None else '.npy')
+        if output_format in ('png', 'both'):
+            extensions.append('.png')
+        found = {extension: set() for extension in extensions}
+        for entry in os.scandir(output_dir):
+            name, extension = os.path.splitext(entry.name)
+            index = mask_index(name)
+            if extension in found and index is not None:
+                found[extension].add(index)
+        return set.intersection(*found.values())
+
+    def commit(self, output_dir: str, file_name: str) -> None:
+        """
+        Record a written mask, the `on_written` callback of `MaskWriter`.
+        """
+        index = mask_index(file_name)
+        if index is None:
+            return
+        with self._lock:
+            self.completed.add(index)
+            self._uncommitted += 1
+            if self._uncommitted < self.checkpoint_every:
+                return
+        self.save()
+
+    def save(self) -> None:
+        """
+        Write the manifest.
+        """
+        with self._lock:
+            self._uncommitted = 0
+            contents = {'seed': self.seed, 'number': self.number, 'completed_count': len(self.completed),
+                        'completed': index_ranges(self.completed), 'settings': self.settings}
+            write_atomic(self.path, lambda file: file.write(json.dumps(contents).encode()))
@@ -0,0 +1,111 @@
+from pathlib import Path
+import numpy as np
+from typing import List, Optional, Sequence, Tuple, Union
+from mask_writer.ShardedMaskDataset import (ShardedMaskDataset, INDEX_FILE, LABEL_COUNT, LABEL_VALUES,
+                                            label_counts, save_atomic, shard_file_name)
+
+# (shard path, names, stacked masks, label counts) of a shard ready to be written
+Shard = Tuple[Path, List[str], np.ndarray, np.ndarray]
+
+
+class ShardWriter:
+    """
+    Groups masks into fixed-size compressed shards of a `ShardedMaskDataset`.
+
+    `add` collects masks in submission order and hands back every shard it completes,
+    which the caller writes with `write_shard` (`MaskWriter` does this on its writer threads).
+    A mask whose shape or dtype differs from the collected ones closes the current
+    shard early. New shards are appended after the shards already in the directory;
+    `write_index` saves the index once all shards are written.
+    """
+
+    def __init__(self, output_dir: Union[str, Path], shard_size: int = 1024,
+                 label_values: Sequence[int] = LABEL_VALUES):
+        """
+        Initialize the ShardWriter, continuing after the shards already in `output_dir`.
+
+        Args:
+            output_dir (Union[str, Path]): Dataset directory
+            shard_size (int): Number of masks per shard
+            label_values (Sequence[int]): Background, blood pool, myocardium, infarct and
+                no-flow values counted per mask in the index
+        """
+        self.output_dir = Path(output_dir)
+        self.shard_size = max(1, int(shard_size))
+        self.label_values = tuple(label_values)
+        index = ShardedMaskDataset.read_index(self.output_dir)
+        self._names = [index['names'].astype(str)]
+        self._shards = [index['shards']]
+        self._positions = [index['positions']]
+        self._label_counts = [index['label_counts']]
+        shard_numbers = ShardedMaskDataset.shard_numbers(self.output_dir)
+        self._next_shard = shard_numbers[-1] + 1 if shard_numbers else 0
+        self._pending_names: List[str] = []
+        self._pending_masks: List[np.ndarray] = []
+        self._pending_counts: List[np.ndarray] = []
+
+    def add(self, name: str, mask: np.ndarray) -> List[Shard]:
+        """
+        Add a mask to the current shard.
+
+        Args:
+            name (str): Name of the mask (the file name it would get as a loose file)
+            mask (np.ndarray): Mask to store
+
+        Returns:
+            List[Shard]: Shards to write, completed or closed early by this mask
+        """
+        mask = np.asarray(mask)
+        shards = []
+        if self._pending_masks and (mask.shape != self._pending_masks[0].shape
+                                    or mask.dtype != self._pending_masks[0].dtype):
+            shards.append(self.finish())
+        self._pending_names.append(name)
+        self._pending_masks.append(mask)
+        self._pending_counts.append(label_counts(mask, self.label_values))
+        if len(self._pending_masks) >= self.shard_size:
+            shards.append(self.finish())
+        return shards
+
+    def finish(self) -> Optional[Shard]:
+        """
+        Close the current shard, even if it is not full.
+
+        Returns:
+            Optional[Shard]: Shard to write, None when no masks are pending
+        """
+        if not self._pending_masks:
+            return None
+        number = self._next_shard
+        self._next_shard += 1
+        count = len(self._pending_masks)
+        counts = np.array(self._pending_counts, dtype=np.int64).reshape(-1, LABEL_COUNT)
+        self._names.append(np.array(self._pending_names, dtype=str))
+        self._shards.append(np.full(count, number, dtype=np.int64))
+        self._positions.append(np.arange(count, dtype=np.int64))
+        self._label_counts.append(counts)
+        shard = (self.output_dir / shard_file_name(number), self._pending_names, np.stack(self._pending_masks), counts)
+        self._pending_names, self._pending_masks, self._pending_counts = [], [], []
+        return shard
+
+    @staticmethod
+    def write_shard(shard: Shard) -> int:
+        """
+        Write a shard returned by `add` or `finish`.
+
+        Returns:
+            int: Number of masks written
+        """
+        path, names, masks, counts = shard
+        save_atomic(path, masks=masks, names=np.array(names, dtype=str), label_counts=counts)
+        return len(names)
+
+    def write_index(self) -> None:
+        """
+        Save the index of all shards written so far.
+        """
+        if self._pending_masks:
+            raise RuntimeError("Masks are still pending, write the shard returned by finish() first")
+        save_atomic(self.output_dir / INDEX_FILE, names=np.concatenate(self._names),
+                    shards=np.concatenate(self._shards), positions=np.concatenate(self._positions),
+                    label_counts=np.concatenate(self._label_counts))
@@ -0,0 +1,247 @@
+import os
+import re
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+from typing import Dict, List, Any, BinaryIO, Callable, Iterator, Sequence, Union
+from mask_writer.MaskCodec import MASK_EXTENSION, load_mask
+
+# Label values counted per mask in the index: background, blood pool, myocardium, infarct, no-flow
+LABEL_VALUES = (0, 1, 2, 3, 4)
+LABEL_COUNT = len(LABEL_VALUES)
+INDEX_FILE = 'shard_index.npz'
+SHARD_PATTERN = re.compile(r'^shard_(\d+)\.npz$')
+# Suffix of files being written, renamed to their final name once complete
+TEMP_SUFFIX = '.tmp'
+
+
+def shard_file_name(shard: int) -> str:
+    """
+    Get the file name of a shard from its number.
+    """
+    return f"shard_{shard:05d}.npz"
+
+
+def label_counts(mask: np.ndarray, label_values: Sequence[int] = LABEL_VALUES) -> np.ndarray:
+    """
+    Count the pixels of every label of a mask, -1 for masks that are not label maps.
+
+    Args:
+        mask (np.ndarray): Mask to describe
+        label_values (Sequence[int]): Background, blood pool, myocardium, infarct and
+            no-flow values of the mask
+
+    Returns:
+        np.ndarray: (LABEL_COUNT,) pixel counts
+    """
+    mask = np.asarray(mask)
+    if not np.issubdtype(mask.dtype, np.integer):
+        return np.full(LABEL_COUNT, -1, dtype=np.int64)
+    return np.array([np.count_nonzero(mask == value) for value in label_values], dtype=np.int64)
+
+
+def write_atomic(path: Union[str, Path], write: Callable[[BinaryIO], None]) -> None:
+    """
+    Write a file through `write` to a temporary file and rename it over `path`, so readers
+    never see a partly written file; a crash only leaves a `TEMP_SUFFIX` file behind.
+    """
+    temp_path = f"{path}{TEMP_SUFFIX}"
+    with open(temp_path, 'wb') as file:
+        write(file)
+    os.replace(temp_path, path)
+
+
+def save_atomic(path: Union[str, Path], **arrays: np.ndarray) -> None:
+    """
+    Write compressed arrays with `write_atomic`.
+    """
+    write_atomic(path, lambda file: np.savez_compressed(file, **arrays))
+
+
+class ShardedMaskDataset:
+    """
+    Read-only view of masks written in shards by `ShardWriter`.
+
+    A dataset directory holds `shard_00000.npz`, `shard_00001.npz`, ... with the stacked
+    `masks` and their `names`, and `shard_index.npz` with the name, shard, position and
+    label pixel counts of every mask. Masks are accessed by index like a sequence; the
+    last few decompressed shards are kept, so reading in order decompresses every shard
+    once. A missing or outdated index is rebuilt from the shards.
+    """
+
+    def __init__(self, dataset_dir: Union[str, Path], cached_shards: int = 2):
+        """
+        Open a sharded dataset.
+
+        Args:
+            dataset_dir (Union[str, Path]): Directory of the shards
+            cached_shards (int): Number of decompressed shards kept in memory
+        """
+        self.dataset_dir = Path(dataset_dir)
+        index = self.read_index(self.dataset_dir)
+        self.names = index['names']
+        self.shards = index['shards']
+        self.positions = index['positions']
+        self.label_counts = index['label_counts']
+        self.cached_shards = max(1, int(cached_shards))
+        self._cache: "OrderedDict[int, np.ndarray]" = OrderedDict()
+        self._rows = None
+
+    @staticmethod
+    def is_sharded(dataset_dir: Union[str, Path]) -> bool:
+        """
+        Check whether a directory holds a sharded dataset.
+        """
+        dataset_dir = Path(dataset_dir)
+        return (dataset_dir / INDEX_FILE).exists() or bool(ShardedMaskDataset.shard_numbers(dataset_dir))
+
+    @staticmethod
+    def shard_numbers(dataset_dir: Union[str, Path]) -> List[int]:
+        """
+        Get the sorted numbers of the shards in a directory.
+        """
+        dataset_dir = Path(dataset_dir)
+        if not dataset_dir.is_dir():
+            return []
+        matches = (SHARD_PATTERN.match(entry.name) for entry in os.scandir(dataset_dir))
+        return sorted(int(match.group(1)) for match in matches if match)
+
+    @classmethod
+    def read_index(cls, dataset_dir: Union[str, Path]) -> Dict[str, np.ndarray]:
+        """
+        Load the index of a dataset, rebuilding and saving it when it does not cover
+        exactly the shards on disk (e.g. after an interrupted run).
+
+        Args:
+            dataset_dir (Union[str, Path]): Directory of the shards
+
+        Returns:
+            Dict[str, np.ndarray]: 'names', 'shards', 'positions' and 'label_counts' of all masks
+        """
+        dataset_dir = Path(dataset_dir)
+        shard_numbers = cls.shard_numbers(dataset_dir)
+        index_path = dataset_dir / INDEX_FILE
+        if index_path.exists():
+            with np.load(index_path) as data:
+                index = {key: data[key] for key in ('names', 'shards', 'positions', 'label_counts')}
+            if np.array_equal(np.unique(index['shards']), shard_numbers):
+                return index
+            print(f"Shard index {index_path} does not match the shards, rebuilding")
+        elif not shard_numbers:
+            return cls.empty_index()
+
+        names, shards, positions, counts = [], [], [], []
+        for shard in shard_numbers:
+            with np.load(dataset_dir / shard_file_name(shard)) as data:
+                names.append(data['names'].astype(str))
+                counts.append(data['label_counts'])
+            shards.append(np.full(len(names[-1]), shard, dtype=np.int64))
+            positions.append(np.arange(len(names[-1]), dtype=np.int64))
+        index = {'names': np.concatenate(names), 'shards': np.concatenate(shards),
+                 'positions': np.concatenate(positions),
+                 'label_counts': np.concatenate(counts).reshape(-1, LABEL_COUNT)}
+        save_atomic(index_path, **index)
+        return index
+
+    @staticmethod
+    def empty_index() -> Dict[str, np.ndarray]:
+        """
+        Get the index of a dataset without masks.
+        """
+        return {'names': np.array([], dtype=str), 'shards': np.zeros(0, dtype=np.int64),
+                'positions': np.zeros(0, dtype=np.int64),
+                'label_counts': np.zeros((0, LABEL_COUNT), dtype=np.int64)}
+
+    def _load_shard(self, shard: int) -> np.ndarray:
+        """
+        Get the stacked masks of a shard, decompressing it unless it is cached.
+        """
+        if shard in self._cache:
+            self._cache.move_to_end(shard)
+            return self._cache[shard]
+        with np.load(self.dataset_dir / shard_file_name(shard)) as data:
+            masks = data['masks']
+        self._cache[shard] = masks
+        while len(self._cache) > self.cached_shards:
+            self._cache.popitem(last=False)
+        return masks
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        """
+        Get a mask by its position in the dataset.
+        """
+        index = range(len(self))[index]
+        return self._load_shard(int(self.shards[index]))[self.positions[index]]
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def index_of(self, name: str) -> int:
+        """
+        Get the position of a mask from its name.
+        """
+        if self._rows is None:
+            self._rows = {str(name): row for row, name in enumerate(self.names)}
+        return self._rows[name]
+
+    def get(self, name: str) -> np.ndarray:
+        """
+        Get a mask by its name.
+        """
+        return self[self.index_of(name)]
+
+    def stats(self, index: int) -> Dict[str, Any]:
+        """
+        Get the index entry of a mask: name, shard, position and label pixel counts.
+        """
+        return {'name': str(self.names[index]), 'shard': int(self.shards[index]),
+                'position': int(self.positions[index]), 'label_counts': self.label_counts[index].tolist()}
+
+
+class MaskDirectory:
+    """
+    The same sequence interface over a directory of loose .npy or encoded `.mask` files,
+    sorted by name.
+    """
+
+    EXTENSIONS = ('.npy', MASK_EXTENSION)
+
+    def __init__(self, dataset_dir: Union[str, Path]):
+        self.dataset_dir = Path(dataset_dir)
+        files = sorted(entry.name for entry in os.scandir(self.dataset_dir)
+                       if os.path.splitext(entry.name)[1] in self.EXTENSIONS)
+        self.names = np.array([os.path.splitext(file_name)[0] for file_name in files], dtype=str)
+        self.files = files
+
+    def path_of(self, index: int) -> Path:
+        return self.dataset_dir / self.files[index]
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        path = self.path_of(range(len(self))[index])
+        return load_mask(path) if path.suffix == MASK_EXTENSION else np.load(path)
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        for index in range(len(self)):
+            yield self[index]
+
+
+def open_mask_dataset(dataset_dir: Union[str, Path]) -> Union[ShardedMaskDataset, MaskDirectory]:
+    """
+    Open a directory of generated masks, sharded or loose .npy or `.mask` files.
+
+    Args:
+        dataset_dir (Union[str, Path]): Output directory of the masks
+
+    Returns:
+        Union[ShardedMaskDataset, MaskDirectory]: Sequence of the masks with their `names`
+    """
+    if ShardedMaskDataset.is_sharded(dataset_dir):
+        return ShardedMaskDataset(dataset_dir)
+    return MaskDirectory(dataset_dir)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import os
+import json
 import subprocess
 
 MAIN_PY_PATH = "/usr/src/app/main.py"
@@ -18,6 +19,17 @@ def main():
     if not os.path.isfile(CONFIG_PATH):
         print(f"[run_app] WARNING: Config not found at {CONFIG_PATH} — app may fail.")
 
+    streaming = False
+    if os.path.isfile(CONFIG_PATH):
+        with open(CONFIG_PATH) as file:
+            streaming = json.load(file)['paths'].get('streaming', False)
+
+    if streaming:
+        # The simulator feeds its masks to the generator directly, in a single process
+        print(f"[run_app] Running simulator and generator model in streaming mode...")
+        subprocess.run(["python", MAIN_PY_PATH, CONFIG_PATH, "--generator-model", MODEL_PATH], check=True)
+        return
+
     print(f"[run_app] Running simulator...")
     subprocess.run(["python", MAIN_PY_PATH, CONFIG_PATH], check=True)
 
@@ -29,6 +29,21 @@ class StatsCalculator:
         myocardium_pixels = np.sum(mask == self.MYOCARDIUM)
         no_flow_pixels = np.sum(mask == self.NO_FLOW)
 
+        return self.ratios_from_counts(infarct_pixels, myocardium_pixels, no_flow_pixels)
+
+    @staticmethod
+    def ratios_from_counts(infarct_pixels, myocardium_pixels, no_flow_pixels):
+        """
+        Calculate the infarction and no flow ratios from pixel counts.
+        
+        Args:
+            infarct_pixels: Number of infarction pixels
+            myocardium_pixels: Number of healthy myocardium pixels
+            no_flow_pixels: Number of no flow pixels
+            
+        Returns:
+            Tuple of (infarct_to_myo, noflow_to_infarct)
+        """
         infarct_plus_noflow = infarct_pixels + no_flow_pixels
         myocardium_total = myocardium_pixels + infarct_plus_noflow
 
@@ -63,6 +78,39 @@ class StatsCalculator:
             "has_significant_infarct_or_noflow": has_significant_infarct_or_noflow
         }
 
+    def process_masks(self, masks, infarct_to_myo_upper_limit, infarct_to_myo_lower_limit,
+                      noflow_to_infarct_upper_limit, noflow_to_infarct_lower_limit):
+        """
+        Process a stack of masks at once, with the same checks as `process_mask`.
+        
+        Args:
+            masks: (N, H, W) mask stack
+            
+        Returns:
+            dict: The statistics of `process_mask` as (N,) arrays
+        """
+        masks = np.asarray(masks)
+        infarct_pixels = np.count_nonzero(masks == self.INFARCTION, axis=(1, 2))
+        myocardium_pixels = np.count_nonzero(masks == self.MYOCARDIUM, axis=(1, 2))
+        no_flow_pixels = np.count_nonzero(masks == self.NO_FLOW, axis=(1, 2))
+        infarct_plus_noflow = infarct_pixels + no_flow_pixels
+        myocardium_total = myocardium_pixels + infarct_plus_noflow
+
+        # Zero where the denominator is zero, as in ratios_from_counts
+        infarct_to_myo = np.divide(infarct_plus_noflow, myocardium_total, out=np.zeros(len(masks)),
+                                   where=myocardium_total > 0)
+        noflow_to_infarct = np.divide(no_flow_pixels, infarct_plus_noflow, out=np.zeros(len(masks)),
+                                      where=infarct_plus_noflow > 0)
+        has_significant_infarct = (infarct_to_myo >= infarct_to_myo_upper_limit) | (infarct_to_myo <= infarct_to_myo_lower_limit)
+        has_significant_noflow = (noflow_to_infarct >= noflow_to_infarct_upper_limit) | (noflow_to_infarct <= noflow_to_infarct_lower_limit)
+        return {
+            "infarct_to_myo": infarct_to_myo,
+            "noflow_to_infarct": noflow_to_infarct,
+            "has_significant_infarct": has_significant_infarct,
+            "has_significant_noflow": has_significant_noflow,
+            "has_significant_infarct_or_noflow": has_significant_infarct | has_significant_noflow
+        }
+
     def has_significant_infarct_or_noflow(self, mask, i):
         """
         Check if the mask has significant infarct or no flow areas.
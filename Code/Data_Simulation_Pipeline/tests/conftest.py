@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The pipeline modules are imported from the Data_Simulation_Pipeline directory, as main.py does
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
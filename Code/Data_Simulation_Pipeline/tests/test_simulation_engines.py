@@ -0,0 +1,92 @@
+"""
+Checks that the single and the batched simulation engines accept the same kind of
+images and account for their attempts the same way.
+"""
+import numpy as np
+import pytest
+from mask_simulator.AdaptiveSampler import AdaptiveSampler
+from mask_simulator.BatchSimulator import BatchSimulator
+from mask_simulator.generate_simulated_mask import _generate_accepted_group, _generate_accepted_image
+from stats_calculator.stats_calculator import StatsCalculator
+
+GENERATION_SETTINGS = dict(
+    mayocardium_type='simulated', image_size=(128, 128), number_of_seeds=80, energy=30, max_radius_step=2,
+    max_theta_step=np.pi / 4, min_cluster_size=70, min_no_flow_size=30, ring_thick_max=20, ring_thick_min=15,
+    show_plots=False, background_color=0, blood_pool_color=1, mayocardium_color=2, infarction_color=3,
+    no_flow_color=4, no_flow_energy_ratio=(0.05, 0.2), early_rejection_margin=None)
+RATIO_LIMITS = dict(infarct_to_myo_upper_limit=0.6, infarct_to_myo_lower_limit=0.2,
+                    noflow_to_infarct_upper_limit=0.4, noflow_to_infarct_lower_limit=0.1)
+IMAGES = 6
+SEED = 11
+
+
+def single_engine(sampler):
+    return [_generate_accepted_image(i, SEED, None, GENERATION_SETTINGS, sampler.tuning(sampler.target_bin(i)))
+            for i in range(IMAGES)]
+
+
+def batched_engine(sampler, indices=range(IMAGES)):
+    group_indices = list(range(IMAGES))
+    return _generate_accepted_group(0, list(indices), group_indices, SEED, GENERATION_SETTINGS,
+                                    [sampler.bin_limits(sampler.target_bin(i)) for i in group_indices],
+                                    [sampler.target_bin(i) for i in group_indices], sampler.bin_edges)
+
+
+def observation_count(attempts):
+    return len(attempts['observations']) + sum(map(len, attempts.get('other_observations', {}).values()))
+
+
+@pytest.fixture
+def sampler():
+    return AdaptiveSampler(GENERATION_SETTINGS, RATIO_LIMITS, ratio_bins=2)
+
+
+@pytest.mark.parametrize('engine', [single_engine, batched_engine])
+def test_engines_accept_valid_masks_in_their_bin(engine, sampler):
+    stats_calculator = StatsCalculator(infarction_val=3, myocardium_val=2, no_flow_val=4)
+    results = engine(sampler)
+    assert [i for i, *_ in results] == list(range(IMAGES))
+    for i, image, stats, attempts in results:
+        assert image.shape == (128, 128)
+        assert set(np.unique(image)) <= {0, 1, 2, 3, 4}
+        assert attempts['bin'] == sampler.target_bin(i)
+        checked = stats_calculator.process_mask(image, **sampler.bin_limits(attempts['bin']))
+        assert not checked['has_significant_infarct_or_noflow']
+        assert checked['infarct_to_myo'] == pytest.approx(stats['infarct_to_myo'])
+
+
+@pytest.mark.parametrize('engine', [single_engine, batched_engine])
+def test_engines_record_one_observation_per_attempt(engine, sampler):
+    results = engine(sampler)
+    observations = sum(observation_count(attempts) for *_, attempts in results)
+    rejected = sum(attempts['rejected'] - attempts['errors'] for *_, attempts in results)
+    # Every attempt that did not fail is either accepted or rejected, and leaves one observation
+    assert observations == rejected + len(results)
+    assert all(attempts['observations'] for *_, attempts in results)
+
+
+def test_batched_engine_images_do_not_depend_on_the_indices_asked_for(sampler):
+    full = {i: image for i, image, *_ in batched_engine(sampler)}
+    subset = batched_engine(sampler, indices=[1, 4])
+    assert [i for i, *_ in subset] == [1, 4]
+    for i, image, _, _ in subset:
+        np.testing.assert_array_equal(image, full[i])
+    observations = sum(observation_count(attempts) for *_, attempts in subset)
+    rejected = sum(attempts['rejected'] - attempts['errors'] for *_, attempts in subset)
+    assert observations == rejected + len(subset)
+
+
+def test_batched_engine_records_the_ratios_of_a_bin_under_that_bin(sampler):
+    bin_of = lambda ratio: int(np.searchsorted(sampler.bin_edges[1:-1], ratio, side='right'))
+    for _, _, _, attempts in batched_engine(sampler):
+        assert all(bin_of(ratio) == attempts['bin'] for ratio, _ in attempts['observations'])
+        for other_bin, observations in attempts['other_observations'].items():
+            assert other_bin != attempts['bin']
+            assert all(bin_of(ratio) == other_bin for ratio, _ in observations)
+
+
+def test_batched_engine_generates_an_empty_stack():
+    images, info = BatchSimulator(**GENERATION_SETTINGS).generate(0, RATIO_LIMITS, return_intermediates=True)
+    assert images.shape == (0, 128, 128)
+    assert len(info['stats']['infarct_to_myo']) == 0
+    assert all(len(stack) == 0 for stack in info['intermediates'].values())
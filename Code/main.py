@@ -1,5 +1,6 @@
 import sys
 import os
+import json
 import shutil
 import numpy as np
 from PyQt5.QtWidgets import (
@@ -9,6 +10,12 @@ from PyQt5.QtWidgets import (
 from PyQt5.QtGui import QPixmap, QImage
 from PyQt5.QtCore import Qt
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data_Simulation_Pipeline'))
+from mask_writer.ShardedMaskDataset import ShardedMaskDataset, open_mask_dataset
+
+# Keep/discard decisions of a sharded folder, whose masks cannot be moved
+DECISIONS_FILE = 'qc_decisions.json'
+
 class ImageFilterTool(QWidget):
     def __init__(self):
         super().__init__()
@@ -18,6 +25,9 @@ class ImageFilterTool(QWidget):
 
         self.image_dir = None
         self.mask_dir = None
+        self.image_dataset = None
+        self.mask_dataset = None
+        # Rows of the datasets still to be reviewed
         self.image_files = []
         self.mask_files = []
         self.index = 0
@@ -94,7 +104,7 @@ class ImageFilterTool(QWidget):
         folder = QFileDialog.getExistingDirectory(self, "Select Image NPY Folder")
         if folder:
             self.image_dir = folder
-            self.image_files = sorted([f for f in os.listdir(folder) if f.endswith('.npy')])
+            self.image_dataset, self.image_files = self.open_folder(folder)
             self.index = 0
             self.show_current_pair()
 
@@ -102,10 +112,32 @@ class ImageFilterTool(QWidget):
         folder = QFileDialog.getExistingDirectory(self, "Select Mask NPY Folder")
         if folder:
             self.mask_dir = folder
-            self.mask_files = sorted([f for f in os.listdir(folder) if f.endswith('.npy')])
+            self.mask_dataset, self.mask_files = self.open_folder(folder)
             self.index = 0
             self.show_current_pair()
 
+    def open_folder(self, folder):
+        # Loose .npy files or shards; decided masks of a sharded folder are skipped
+        dataset = open_mask_dataset(folder)
+        decided = self.load_decisions(folder) if isinstance(dataset, ShardedMaskDataset) else {}
+        rows = [row for row, name in enumerate(dataset.names) if str(name) not in decided]
+        return dataset, rows
+
+    def load_decisions(self, folder):
+        path = os.path.join(folder, DECISIONS_FILE)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as file:
+            return json.load(file)
+
+    def save_decision(self, folder, name, decision):
+        decisions = self.load_decisions(folder)
+        decisions[name] = decision
+        temp_path = os.path.join(folder, DECISIONS_FILE + '.tmp')
+        with open(temp_path, 'w') as file:
+            json.dump(decisions, file, indent=1)
+        os.replace(temp_path, os.path.join(folder, DECISIONS_FILE))
+
     def create_overlay_pixmap(self, image_array, mask_array):
         # Normalize image to 0–255
         norm_img = ((image_array + 1) / 2 * 255).clip(0, 255).astype(np.uint8)
@@ -143,22 +175,16 @@ class ImageFilterTool(QWidget):
         if self.index < 0 or self.index >= len(self.image_files):
             return
 
-        img_path = os.path.join(self.image_dir, self.image_files[self.index])
-        mask_path = os.path.join(self.mask_dir, self.mask_files[self.index])
+        img_arr = self.image_dataset[self.image_files[self.index]]
+        img_pixmap = self.array_to_qpixmap(img_arr, is_mask=False)
+        self.image_label.setPixmap(img_pixmap)
 
-        if os.path.exists(img_path):
-            img_arr = np.load(img_path)
-            img_pixmap = self.array_to_qpixmap(img_arr, is_mask=False)
-            self.image_label.setPixmap(img_pixmap)
+        mask_arr = self.mask_dataset[self.mask_files[self.index]]
+        mask_pixmap = self.array_to_qpixmap(mask_arr, is_mask=True)
+        self.mask_label.setPixmap(mask_pixmap)
 
-        if os.path.exists(mask_path):
-            mask_arr = np.load(mask_path)
-            mask_pixmap = self.array_to_qpixmap(mask_arr, is_mask=True)
-            self.mask_label.setPixmap(mask_pixmap)
-        
-        if os.path.exists(img_path) and os.path.exists(mask_path):
-            overlay_pixmap = self.create_overlay_pixmap(img_arr, mask_arr)
-            self.overlay_label.setPixmap(overlay_pixmap)
+        overlay_pixmap = self.create_overlay_pixmap(img_arr, mask_arr)
+        self.overlay_label.setPixmap(overlay_pixmap)
 
 
     def array_to_qpixmap(self, array, is_mask=False):
@@ -203,19 +229,8 @@ class ImageFilterTool(QWidget):
         if not (self.image_files and self.mask_files):
             return
 
-        image_name = self.image_files[self.index]
-        mask_name = self.mask_files[self.index]
-
-        target_img_dir = os.path.join(self.image_dir, decision)
-        target_mask_dir = os.path.join(self.mask_dir, decision)
-
-        os.makedirs(target_img_dir, exist_ok=True)
-        os.makedirs(target_mask_dir, exist_ok=True)
-
-        shutil.move(os.path.join(self.image_dir, image_name),
-                    os.path.join(target_img_dir, image_name))
-        shutil.move(os.path.join(self.mask_dir, mask_name),
-                    os.path.join(target_mask_dir, mask_name))
+        self.apply_decision(self.image_dir, self.image_dataset, self.image_files[self.index], decision)
+        self.apply_decision(self.mask_dir, self.mask_dataset, self.mask_files[self.index], decision)
 
         self.image_files.pop(self.index)
         self.mask_files.pop(self.index)
@@ -230,6 +245,16 @@ class ImageFilterTool(QWidget):
             self.mask_label.clear()
             QMessageBox.information(self, "Done", "All npy files have been processed.")
 
+    def apply_decision(self, folder, dataset, row, decision):
+        name = str(dataset.names[row])
+        if isinstance(dataset, ShardedMaskDataset):
+            self.save_decision(folder, name, decision)
+            return
+        source_path = dataset.path_of(row)
+        target_dir = os.path.join(folder, decision)
+        os.makedirs(target_dir, exist_ok=True)
+        shutil.move(source_path, os.path.join(target_dir, source_path.name))
+
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     window = ImageFilterTool()